@@ -0,0 +1,37 @@
+import sys
+
+from triple_draw_poker_full_output import *
+from draw_poker import add_dataset_store_shard
+from draw_poker import load_dataset_store_manifest
+from draw_poker import DATASET_STORE_DIR
+from draw_poker import PARALLEL_LOAD_WORKERS
+
+"""
+Parse and encode event CSV (self-play, or ACPC logs), and add it to the data set store as a new shard.
+Uses training format and input flags from triple_draw_poker_full_output. Only the new file is parsed.
+
+python add_to_dataset_store.py ../data/holdem/Slumbot_take2.csv Slumbot [opponent] [max_input]
+
+With no arguments, list shards already in the store.
+"""
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        manifest = load_dataset_store_manifest(DATASET_STORE_DIR)
+        for shard in manifest['shards']:
+            print('%s\t%s\t%s\t%d hands\t%s\t%s' % (shard['source'], shard['opponent'], shard['format'], shard['hands'], shard['added'], shard['filename']))
+        print('%d shards, %d hands' % (len(manifest['shards']), sum([shard['hands'] for shard in manifest['shards']])))
+        sys.exit(0)
+
+    filename = sys.argv[1]
+    source = sys.argv[2]
+    opponent = None
+    if len(sys.argv) >= 4:
+        opponent = sys.argv[3]
+    max_input = MAX_INPUT_SIZE
+    if len(sys.argv) >= 5:
+        max_input = int(sys.argv[4])
+
+    add_dataset_store_shard(filename, source, opponent=opponent, store_dir=DATASET_STORE_DIR, max_input=max_input, keep_all_data=(TRAINING_FORMAT != 'video'), format=TRAINING_FORMAT,
+                            include_num_draws=INCLUDE_NUM_DRAWS, include_full_hand=INCLUDE_FULL_HAND, include_hand_context=INCLUDE_HAND_CONTEXT,
+                            pack_inputs=PACKED_TRAINING_INPUTS, sparse_inputs=SPARSE_EVENT_INPUTS, seed=LOADER_RANDOM_SEED, workers=PARALLEL_LOAD_WORKERS)
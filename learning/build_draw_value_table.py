@@ -0,0 +1,60 @@
+import sys
+
+from triple_draw_poker_full_output import *
+from draw_value_table import all_canonical_hand_keys
+from draw_value_table import canonical_hand_from_key
+from draw_value_table import write_draw_value_table
+from draw_value_table import DRAW_TABLE_NUM_DRAWS
+from draw_value_table import DRAW_TABLE_NUM_VALUES
+from draw_value_table import DRAW_TABLE_VALUE_TYPE
+
+"""
+Run draw model over all canonical 5-card hands x draws left (1-3), and save the 32 draw values as a table.
+Then play with draw table (play_triple_draw.py --draw_table), instead of the draw model.
+
+python build_draw_value_table.py deuce_models/draw_model.pickle deuce_draw_table [--numpy_model]
+
+Writes deuce_draw_table_keys.npy and deuce_draw_table_values.npy
+"""
+
+DRAW_TABLE_BUILD_BATCH_SIZE = 2000 # hands per model call
+
+# Same draw model as for play in play_triple_draw. Compiled Theano (any batch size), or NumPy.
+def load_draw_model(filename, use_numpy_model = False):
+    with open(filename, 'rb') as f:
+        all_param_values = pickle.load(f)
+    print('loaded %s params' % len(all_param_values))
+    if use_numpy_model:
+        return (build_numpy_model(all_param_values), None)
+    expand_parameters_input_to_match(all_param_values, zero_fill = True)
+    output_layer, input_layer, layers = build_model(HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE, ARRAY_OUTPUT_LENGTH, batch_size=None)
+    lasagne.layers.set_all_param_values(output_layer, all_param_values)
+    return (output_layer, input_layer)
+
+# [hands x draws x 32] values, for canonical hands in keys order
+def draw_table_values(output_layer, input_layer, keys, batch_size = DRAW_TABLE_BUILD_BATCH_SIZE):
+    values = np.zeros((len(keys), len(DRAW_TABLE_NUM_DRAWS), DRAW_TABLE_NUM_VALUES), dtype=DRAW_TABLE_VALUE_TYPE)
+    now = time.time()
+    for start in range(0, len(keys), batch_size):
+        hand_strings = [hand_string(canonical_hand_from_key(long(key))) for key in keys[start:start + batch_size]]
+        for (draw, num_draws) in enumerate(DRAW_TABLE_NUM_DRAWS):
+            test_cases = [[hand_string_dealt, num_draws] for hand_string_dealt in hand_strings]
+            output = evaluate_batch_hands(output_layer, test_cases, input_layer = input_layer)
+            values[start:start + len(hand_strings), draw] = output[:len(hand_strings), :DRAW_TABLE_NUM_VALUES]
+        print('%d/%d hands\t%.1fs' % (start + len(hand_strings), len(keys), time.time() - now))
+        sys.stdout.flush()
+    return values
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python build_draw_value_table.py draw_model.pickle out_table [--numpy_model]')
+        sys.exit(0)
+
+    model_filename = sys.argv[1]
+    out_filename = sys.argv[2]
+    (output_layer, input_layer) = load_draw_model(model_filename, use_numpy_model = ('--numpy_model' in sys.argv))
+
+    keys = all_canonical_hand_keys()
+    print('%d canonical hands' % len(keys))
+    values = draw_table_values(output_layer, input_layer, keys)
+    write_draw_value_table(out_filename, keys, values)
@@ -0,0 +1,38 @@
+import sys
+
+from triple_draw_poker_full_output import *
+from numpy_model import write_model_store
+from numpy_model import NUMPY_MODEL_WEIGHT_TYPES
+
+"""
+Convert pickled model (from save_model) to a model store: directory with uncompressed .npy arrays and manifest.json.
+Input & output expansion (expand_parameters_input_to_match) is done here, once. Loading memory-maps the arrays read-only,
+so self-play workers on one host share one copy of each model, and skip unpickling and expansion.
+Converting again to the same out_dir replaces the store in place (out_dir is a symlink to a version directory, swapped atomically),
+so workers loading it at the same time see the old model or the new one.
+
+python convert_model_store.py nlh_events_..._700k.pickle nlh_events_..._700k.model [float16|int8]
+
+Then pass the directory as model file: play_triple_draw.py --numpy_model -CNN_model nlh_events_..._700k.model
+(Theano models load param values from the store too, but copy them into the compiled graph.)
+"""
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3 or (len(sys.argv) >= 4 and sys.argv[3] not in NUMPY_MODEL_WEIGHT_TYPES):
+        print('usage: python convert_model_store.py model.pickle out_dir [%s]' % '|'.join(NUMPY_MODEL_WEIGHT_TYPES))
+        sys.exit(0)
+
+    model_filename = sys.argv[1]
+    out_path = sys.argv[2]
+    weight_type = 'float32'
+    if len(sys.argv) >= 4:
+        weight_type = sys.argv[3]
+
+    with open(model_filename, 'rb') as f:
+        all_param_values = pickle.load(f)
+    expand_parameters_input_to_match(all_param_values, zero_fill = True)
+    all_param_values = [np.asarray(values, dtype=TRAINING_INPUT_TYPE) for values in all_param_values]
+    model = NumpyModel(all_param_values, leaky_units=DEFAULT_LEAKY_UNITS, weight_type=weight_type)
+    write_model_store(out_path, all_param_values, model,
+                      metadata={'source': os.path.basename(model_filename), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                'full_input_length': FULL_INPUT_LENGTH, 'output_length_expanded': ARRAY_OUTPUT_LENGTH})
@@ -32,6 +32,8 @@ import gzip
 import itertools
 import pickle
 import os
+import shutil
+import fcntl
 import sys
 import numpy as np
 import lasagne
@@ -42,6 +44,14 @@ import time
 import math
 import csv
 import ast # string parsing
+import hashlib
+import json
+import random
+import threading
+import Queue
+import collections
+import multiprocessing
+import resource
 from poker_lib import *
 from holdem_lib import *
 from poker_util import *
@@ -116,6 +126,11 @@ FUTURE_DISCOUNT = 0.9
 SAMPLE_RATE_DEUCE_EVENTS = 0.5 # 0.3 # 0.8 # 0.3 # 0.8 # 0.6 # 1.0 # 0.50 # 0.33
 IMPORTANT_CASES_SAMPLE_RATE = min(3.0 * SAMPLE_RATE_DEUCE_EVENTS, 1.0)
 
+# Share of events kept, when down-sampling at load time: (other events, important cases).
+# NOTE: Important cases are never dropped. IMPORTANT_CASES_SAMPLE_RATE only samples the count of them printed. See read_poker_csv_examples()
+def event_sample_rates(sample_rate = SAMPLE_RATE_DEUCE_EVENTS):
+    return (sample_rate, 1.0)
+
 # For DEUCE hands: are the some cases that are important, and should always be selected?
 LOW_STRAIGHTS_ARE_IMPORTANT = True
 PAT_DRAWS_ARE_IMPORTANT = True
@@ -144,6 +159,7 @@ PLAYERS_INCLUDE_DEUCE_EVENTS.add('nlh_sim') # If we want to train on simulation
 
 # returns numpy array 5x4x13, for card hand string like '[Js,6c,Ac,4h,5c]' or 'Tc,6h,Kh,Qc,3s'
 # if pad_to_fit... pass along to card input creator, to create 14x14 array instead of 4x13
+# NOTE: Rather than max_inputs > 1 (stores every suit scramble), use SUIT_PERMUTATION_AUGMENT to permute suits per minibatch.
 def cards_inputs_from_string(hand_string, pad_to_fit = PAD_INPUT, max_inputs=50,
                              include_num_draws=False, num_draws=None, include_full_hand = False, include_hand_context = False):
     hand_array = hand_string_to_array(hand_string)
@@ -361,6 +377,83 @@ def limit_bets_string_to_array(bets_string, pad_to_fit = PAD_INPUT):
     #print(output_array)
     return output_array
 
+# Memoize encoders for card and bet strings. Same hands, boards and bet strings come up again and again, in loading and in live play.
+# Bounded LRU cache per encoder, keyed by input strings (or cards) and flags. Returned arrays are read-only, since shared between callers.
+# Lists are copied on the way out, so callers can still append, etc. Use encoder_cache_stats() to see hit rates.
+ENCODER_CACHE_SIZE = 100000 # entries per encoder. 0 --> no caching
+ENCODER_CACHES = [] # stats for all memoized encoders
+
+def read_only_encoding(value):
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, list):
+        for item in value:
+            read_only_encoding(item)
+    elif isinstance(value, tuple):
+        for item in value:
+            read_only_encoding(item)
+    return value
+
+# Fresh lists around the shared (read-only) arrays and cards.
+def copy_encoding(value):
+    if isinstance(value, list):
+        return [copy_encoding(item) for item in value]
+    elif isinstance(value, tuple):
+        return tuple([copy_encoding(item) for item in value])
+    return value
+
+# Wrap pure encoder function in LRU cache. key_function(*args, **kwargs) returns hashable key, including all flags that change the output.
+def memoize_encoder(function, key_function = None, max_size = ENCODER_CACHE_SIZE):
+    if not max_size:
+        return function
+    cache = collections.OrderedDict()
+    stats = {'name': function.__name__, 'hits': 0, 'misses': 0, 'size': 0, 'max_size': max_size}
+    lock = threading.Lock() # streaming minibatches runs in a background thread
+    ENCODER_CACHES.append(stats)
+
+    def memoized_function(*args, **kwargs):
+        if key_function:
+            key = key_function(*args, **kwargs)
+        else:
+            key = (args, tuple(sorted(kwargs.items())))
+        with lock:
+            if key in cache:
+                value = cache.pop(key)
+                cache[key] = value # most recently used
+                stats['hits'] += 1
+                return copy_encoding(value)
+        value = read_only_encoding(function(*args, **kwargs))
+        with lock:
+            stats['misses'] += 1
+            cache[key] = value
+            if len(cache) > max_size:
+                cache.popitem(last=False)
+            stats['size'] = len(cache)
+        return copy_encoding(value)
+
+    memoized_function.__name__ = function.__name__
+    memoized_function.__doc__ = function.__doc__
+    memoized_function.cache_stats = stats
+    return memoized_function
+
+def encoder_cache_stats():
+    return [dict(stats, hit_rate=(stats['hits'] * 1.0 / max(stats['hits'] + stats['misses'], 1))) for stats in ENCODER_CACHES]
+
+def print_encoder_cache_stats():
+    for stats in encoder_cache_stats():
+        print('encoder cache %s:\t%d hits\t%d misses\t%.1f%% hit rate\t%d/%d entries' % (stats['name'], stats['hits'], stats['misses'], stats['hit_rate'] * 100.0, stats['size'], stats['max_size']))
+
+# Cards are not hashable by value. Key them by (suit, value) instead.
+def cards_cache_key(cards_array):
+    return tuple([(card.suit, card.value) for card in cards_array])
+
+hand_string_to_array = memoize_encoder(hand_string_to_array, key_function = lambda hand_string: hand_string)
+card_from_string = memoize_encoder(card_from_string, key_function = lambda card_str: card_str)
+holdem_cards_canonical_form = memoize_encoder(holdem_cards_canonical_form, key_function = lambda cards_array, flop_array, turn_array, river_array: (cards_cache_key(cards_array), cards_cache_key(flop_array), cards_cache_key(turn_array), cards_cache_key(river_array)))
+hand_to_matrix = memoize_encoder(hand_to_matrix, key_function = lambda poker_hand, pad_to_fit=False, pad_size=HAND_TO_MATRIX_PAD_SIZE, double_row=DOUBLE_ROW_HAND_MATRIX: (cards_cache_key(poker_hand), pad_to_fit, pad_size, double_row))
+card_to_matrix = memoize_encoder(card_to_matrix, key_function = lambda card, pad_to_fit=False: (card.suit, card.value, pad_to_fit))
+bets_string_to_array = memoize_encoder(bets_string_to_array, key_function = lambda bets_string, pad_to_fit = PAD_INPUT, format='deuce_events': (bets_string, pad_to_fit, format == 'nlh_events'))
+
 
 # Given entire hand betting string, chop into (previous_round, round_before, two_round_before)
 def get_previous_round_string(all_round_string, current_round_bets_string = '', format='deuce_events'):
@@ -451,57 +544,41 @@ def limit_get_previous_round_string(all_round_string, current_round_bets_string
     return (previous_round, round_before, two_round_before)
 
 # [xPosition, xPot, xBets [this street], xCardsKept, xOpponentKept]
-def hand_input_from_context(position=0, pot_size=0, bets_string='', cards_kept=0, opponent_cards_kept=0, pad_to_fit = PAD_INPUT, all_rounds_bets_string=None, format = 'deuce_events'):
-
-    position_input = card_to_matrix_fill(position, pad_to_fit = pad_to_fit)
+# Context planes [CONTEXT_LENGTH x 17 x 17] for a game situation. Every plane is selected from precomputed banks (see FILL_PLANE_BANK, etc)
+# Write into out buffer if given (for example, the context part of a full input), else a new array.
+def hand_input_from_context(position=0, pot_size=0, bets_string='', cards_kept=0, opponent_cards_kept=0, pad_to_fit = PAD_INPUT, all_rounds_bets_string=None, format = 'deuce_events', out = None):
+    assert pad_to_fit == PAD_INPUT, 'Context plane banks built for pad_to_fit=%s' % PAD_INPUT
+    if out is None:
+        out = np.empty((CONTEXT_LENGTH, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE), dtype=TRAINING_INPUT_TYPE)
+
+    # xPosition, xPot
+    out[0] = FILL_PLANE_BANK[int(position)]
     if format == 'nlh_events':
-        pot_size_input = bet_size_to_matrix(pot_size, NLH_POT_MATRIX_SCALE)
+        bet_size_to_plane(pot_size, NLH_POT_MATRIX_SCALE, out[1])
     else:
-        pot_size_input = pot_to_array(pot_size, pad_to_fit = pad_to_fit) # saved to single "card"
-    bets_string_input = bets_string_to_array(bets_string, pad_to_fit = pad_to_fit, format=format) # length 5
-    cards_kept_input = integer_to_card_array(cards_kept, max_integer = 5, pad_to_fit = pad_to_fit)
-    opponent_cards_kept_input = integer_to_card_array(opponent_cards_kept, max_integer = 5, pad_to_fit = pad_to_fit)
-    # If present...
-    # NOTE: This will extend context array. Flag to enable it. And change all 26-length dependencies!
-    #print('Attempting to dig up \'previous rounds bets\' from %s' % all_rounds_bets_string)
-    (previous_round, round_before, two_round_before) = get_previous_round_string(all_rounds_bets_string, current_round_bets_string=bets_string, format=format)
-    previous_round_bets_string = previous_round
-    #print('-->%s' % previous_round_bets_string)
-    previous_bets_string_input = bets_string_to_array(previous_round_bets_string, pad_to_fit = pad_to_fit, format=format) # Also, 5 bits
+        out[1] = POT_PLANE_BANK[pot_plane_index(pot_size)] # saved to single "card"
 
-    # NOTE: Use previous rounds... if requested.
-    round_before_string = round_before
-    round_before_string_input = bets_string_to_array(round_before_string, pad_to_fit = pad_to_fit, format=format) # Also, 5 bits
-    two_round_before_string = two_round_before
-    two_round_before_string_input = bets_string_to_array(two_round_before_string, pad_to_fit = pad_to_fit, format=format) # Also, 5 bits
+    # xBets for each round [current, previous, round before, two rounds before]. Order of planes depends on format.
+    # For deuce: [xPosition, xPot, xBets [this street], xCardsKept, xOpponentKept, xPreviousBets]
+    # For holdem and NLH: [xPosition, xPot, xBets [this street], ... , xPreviousBets] [to get "prev_round" to match]
+    # NOTE: This will extend context array. Flag to enable it. And change all 26-length dependencies!
+    bets = bets_columns_from_context(bets_string=bets_string, all_rounds_bets_string=all_rounds_bets_string, format=format)
+    if format == 'deuce_events':
+        bets_rounds_planes = [(0, 2), (1, 17)]
+    else:
+        bets_rounds_planes = [(0, 2), (3, 7), (2, 12), (1, 17)]
+    for (bets_round, plane) in bets_rounds_planes:
+        if format == 'nlh_events':
+            for i in range(5):
+                bet_size_to_plane(bets[bets_round][i], NLH_BETS_MATRIX_SCALE, out[plane + i])
+        else:
+            out[plane:plane + 5] = LIMIT_BETS_PLANES_BANK[limit_bets_index(bets[bets_round])]
 
-    if format == 'nlh_events':
-        # For nlh_events... include all rounds of betting. Take opportunity to re-organize (if needed)
-        # [xPosition, xPot, xBets [this street], ... , xPreviousBets]
-        # NOTE: We separate out NLH, to make sure "holdem_events" kept correctly. 
-        hand_context_input = np.array([position_input, pot_size_input, 
-                                   bets_string_input[0], bets_string_input[1], bets_string_input[2], bets_string_input[3], bets_string_input[4],
-                                   two_round_before_string_input[0], two_round_before_string_input[1], two_round_before_string_input[2], two_round_before_string_input[3], two_round_before_string_input[4],
-                                   round_before_string_input[0], round_before_string_input[1], round_before_string_input[2], round_before_string_input[3], round_before_string_input[4],
-                                   previous_bets_string_input[0], previous_bets_string_input[1], previous_bets_string_input[2], previous_bets_string_input[3], previous_bets_string_input[4]], TRAINING_INPUT_TYPE)
-    elif format == 'holdem_events':
-        # For holdem_events... swap out cards_kep, and swap in... previous rounds betting
-        # [xPosition, xPot, xBets [this street], ... , xPreviousBets]
-        # A bit confusing... but do pot and bets first, then previous round bets in the correct order [to get "prev_round" to match]
-        hand_context_input = np.array([position_input, pot_size_input, 
-                                   bets_string_input[0], bets_string_input[1], bets_string_input[2], bets_string_input[3], bets_string_input[4],
-                                   two_round_before_string_input[0], two_round_before_string_input[1], two_round_before_string_input[2], two_round_before_string_input[3], two_round_before_string_input[4],
-                                   round_before_string_input[0], round_before_string_input[1], round_before_string_input[2], round_before_string_input[3], round_before_string_input[4],
-                                   previous_bets_string_input[0], previous_bets_string_input[1], previous_bets_string_input[2], previous_bets_string_input[3], previous_bets_string_input[4]], TRAINING_INPUT_TYPE)
-    elif format == 'deuce_events':
-        # Put it all together...
-        # [xPosition, xPot, xBets [this street], xCardsKept, xOpponentKept, xPreviousBets]
-        hand_context_input = np.array([position_input, pot_size_input, 
-                                       bets_string_input[0], bets_string_input[1], bets_string_input[2], bets_string_input[3], bets_string_input[4],
-                                       cards_kept_input[0], cards_kept_input[1], cards_kept_input[2], cards_kept_input[3], cards_kept_input[4],
-                                       opponent_cards_kept_input[0], opponent_cards_kept_input[1], opponent_cards_kept_input[2], opponent_cards_kept_input[3], opponent_cards_kept_input[4],
-                                       previous_bets_string_input[0], previous_bets_string_input[1], previous_bets_string_input[2], previous_bets_string_input[3], previous_bets_string_input[4]], TRAINING_INPUT_TYPE)
-    return hand_context_input
+    # xCardsKept, xOpponentKept
+    if format == 'deuce_events':
+        out[7:12] = INTEGER_PLANES_BANK[integer_planes_index(cards_kept)]
+        out[12:17] = INTEGER_PLANES_BANK[integer_planes_index(opponent_cards_kept)]
+    return out
 
 # Return all legal actions (or the flipside) for given heads-up context
 def legal_actions_context(num_draws, position, bets_string, reverse = False, format='deuce_events'):
@@ -738,15 +815,394 @@ def read_holdem_poker_line(data_array, csv_key_map):
     # NOTE: No need for mask, since can just predict all values, including zeros. Mask only needed if known values change, input to input.
     return ([cards_input], output_category, output_values)
 
+#######################
+## Batch encoding of event inputs.
+##
+## Building (31,17,17) input one row at a time, through hand_to_matrix() and friends, is where most of the loading time goes.
+## Instead, parse each event line into a handful of numbers ("input columns"), then encode many rows at once,
+## by scatter writes into a pre-allocated (N,31,17,17) buffer. Output must match the row-by-row encoding exactly.
+##
+## Input columns, for N rows:
+## 'cards' --> (N,7) card indices [see card_to_index()] or -1 for no card. Deuce: 5-card hand. Holdem: [private x2, flop x3, turn, river]
+## 'num_draws' --> (N) draws left (or betting rounds left, for holdem)
+## 'position', 'cards_kept', 'opponent_cards_kept' --> (N) small integers
+## 'pot_size' --> (N) float, in chips
+## 'bets' --> (N,4,5) bets for [this round, previous round, round before, two rounds before]. 0/1 bits for limit, bet sizes for NLH
+#######################
+BATCH_ENCODE_EVENT_INPUTS = True # Parse event lines into columns, and encode inputs in large batches (much faster)
+EVENT_ENCODE_CHUNK_SIZE = 10000 # How many rows to encode at once
+EVENT_INPUT_MAX_CARDS = 7 # 5 for deuce, 2 + 5 for holdem
+EVENT_INPUT_NUM_BETS_ROUNDS = 4 # current round, and three previous rounds
+NUM_CARDS_PLANES = 5 + 1 # xCards (or holdem equivalent) planes, before xNumDraws
+NUM_DRAWS_PLANES = 3
+CONTEXT_PLANES_OFFSET = NUM_CARDS_PLANES + NUM_DRAWS_PLANES
+
+# Unique index for each card [0-51], in the same order as pot_to_array() deals out cards. 2c, 2d, 2h, 2s, 3c...
+def card_to_index(card):
+    return card.value * len(suitsArray) + suits_to_matrix[card.suit]
+
+# Templates for the scatter writes. Build these from the row-by-row encoders, so there is no chance of drift.
+all_cards_by_index = [Card(suit=suit, value=rank) for rank in ranksArray for suit in suitsArray]
+# Flat (17x17) positions of 1's for each card. One position, or two with DOUBLE_ROW_HAND_MATRIX.
+CARD_PLANE_INDICES = np.array([np.flatnonzero(card_to_matrix(card, pad_to_fit=PAD_INPUT)) for card in all_cards_by_index], dtype=np.int32)
+# Where card_to_matrix_fill() puts the fill.
+FILL_PLANE_MATRIX = card_to_matrix_fill(1, pad_to_fit=PAD_INPUT)
+# Every possible limit pot plane. Each $50 of pot is another card, up to a full deck.
+POT_PLANE_BANK = np.array([pot_to_array(50 * num_cards, pad_to_fit=PAD_INPUT) for num_cards in range(len(all_cards_by_index) + 1)], dtype=np.int32)
+# Flat positions filled by bet_size_to_matrix(), in the order that bet chunks are filled.
+def bet_matrix_cell_indices(pad_size=HAND_TO_MATRIX_PAD_SIZE, double_row=DOUBLE_ROW_BET_MATRIX):
+    cell_indices = []
+    num_cells = len(ranksArray) * len(suitsArray) * (2 if double_row else 1)
+    for cell in range(num_cells):
+        # Filling a cell with more than a single chunk, reveals the next cell in order.
+        matrix = bet_size_to_matrix(cell + 0.5, 1.0, pad_size=pad_size, double_row=double_row)
+        cell_indices.append(np.flatnonzero(matrix == 0.5)[0])
+    return np.array(cell_indices, dtype=np.int32)
+BET_CELL_INDICES = bet_matrix_cell_indices()
+
+# Banks of every possible context plane, also built from the row-by-row encoders. Read-only, and shared.
+# Encoding a context with these is just index selection, into a preallocated buffer. See hand_input_from_context()
+POT_PLANE_BANK = read_only_encoding(POT_PLANE_BANK)
+FILL_PLANE_BANK = read_only_encoding(np.array([card_to_matrix_fill(fill, pad_to_fit=PAD_INPUT) for fill in [0, 1]], dtype=np.int32))
+# integer_to_card_array(0-5). Encode 2 as 11000
+INTEGER_PLANES_BANK = read_only_encoding(np.array([integer_to_card_array(number, max_integer=5, pad_to_fit=PAD_INPUT) for number in range(5 + 1)], dtype=np.int32))
+# limit_bets_string_to_array() for all 32 strings of 5 bets. Index bit i == bet i
+LIMIT_BETS_PLANES_BANK = read_only_encoding(np.array([limit_bets_string_to_array(''.join([str((index >> i) & 1) for i in range(5)]), pad_to_fit=PAD_INPUT) for index in range(2**5)], dtype=np.int32))
+# bet_size_to_matrix() with k full chunks [0 to all cells]. Partial chunk written on top.
+BET_PLANE_BANK = read_only_encoding(np.array([bet_size_to_matrix(num_cells, 1.0) for num_cells in range(len(BET_CELL_INDICES) + 1)], dtype=np.float32))
+
+# Same as pot_to_array(): a card for each $50, up to a full deck.
+def pot_plane_index(pot_size):
+    return int(min(max(pot_size // 50, 0), len(all_cards_by_index)))
+
+def integer_planes_index(number, max_integer = 5):
+    return min(max(int(number), 0), max_integer)
+
+def limit_bets_index(bets_values):
+    return sum([(1 << i) for i in range(5) if bets_values[i]])
+
+# Same as bet_size_to_matrix(bet_size, scale), written into out plane.
+def bet_size_to_plane(bet_size, scale, out):
+    num_bets = (bet_size * 1.0) / scale
+    assert num_bets >= 0.0, 'Attempting to encode unknown bet size %s (scale %s)' % (bet_size, scale)
+    num_cells = len(BET_CELL_INDICES)
+    full_cells = int(min(math.floor(num_bets), num_cells))
+    out[:] = BET_PLANE_BANK[full_cells]
+    if full_cells < num_cells and num_bets > full_cells:
+        out.reshape(-1)[BET_CELL_INDICES[full_cells]] = num_bets - full_cells
+    return out
+
+# Suit permutations of card planes, for augmentation at minibatch time. Same invariance as storing hand_suit_scrambles() of every hand, with no extra storage.
+# For each of 24 suit permutations, row gather index for the 17x17 plane. Each suit's rows taken from card_to_matrix() [1 row, or 2 with DOUBLE_ROW_HAND_MATRIX]
+SUIT_PERMUTATION_AUGMENT = False # True # Random suit permutation per example, for draw games. Not holdem (canonical form instead)
+SUIT_PERMUTATION_FORMATS = set(['video', 'deuce', 'deuce_events'])
+SUIT_PERMUTATION_CARD_PLANES = NUM_CARDS_PLANES # 5 cards + full hand. Set to 5, if no full hand plane. Other planes are not suit symmetric (pot) or must not move (fills)
+def suit_permutation_rows(pad_to_fit=PAD_INPUT):
+    suit_rows = {}
+    for suit in suitsArray:
+        suit_rows[suit] = np.flatnonzero(card_to_matrix(Card(suit=suit, value=ranksArray[0]), pad_to_fit=pad_to_fit).any(axis=1))
+    num_rows = card_to_matrix(all_cards_by_index[0], pad_to_fit=pad_to_fit).shape[0]
+    permutation_rows = []
+    for suit_scramble in all_suit_scrambles_maps:
+        rows = np.arange(num_rows)
+        for suit in suitsArray:
+            rows[suit_rows[suit_scramble[suit]]] = suit_rows[suit]
+        permutation_rows.append(rows)
+    return np.array(permutation_rows, dtype=np.int32)
+SUIT_PERMUTATION_ROWS = suit_permutation_rows()
+
+# Apply random suit permutation to card planes of each example in the batch. All examples at once.
+# Returns a new array. Input is not changed, since it may be a view of the training set (or a read-only memmap).
+def permute_suits_batch(X_batch, num_planes = SUIT_PERMUTATION_CARD_PLANES, rng = np.random):
+    num_rows = X_batch.shape[0]
+    num_planes = min(num_planes, X_batch.shape[1])
+    rows = SUIT_PERMUTATION_ROWS[rng.randint(len(SUIT_PERMUTATION_ROWS), size=num_rows)]
+    out = X_batch.copy()
+    out[:, :num_planes] = X_batch[np.arange(num_rows)[:, np.newaxis, np.newaxis], np.arange(num_planes)[np.newaxis, :, np.newaxis], rows[:, np.newaxis, :]]
+    return out
+
+# Compact event record. Just the handful of values, from which all input planes are derived. ~100 bytes vs 36KB float inputs.
+# cards: card indices, -1 for missing [5 cards for deuce; private x2, flop x3, turn, river for holdem]
+# bets: bet sizes (or 0/1 bits for limit) for [current, previous, round before, two rounds before]
+EVENT_RECORD_DTYPE = np.dtype([('cards', np.int8, (EVENT_INPUT_MAX_CARDS,)),
+                               ('num_draws', np.int8),
+                               ('position', np.int8),
+                               ('pot_size', np.float64),
+                               ('bets', np.int32, (EVENT_INPUT_NUM_BETS_ROUNDS, 5)),
+                               ('cards_kept', np.int8),
+                               ('opponent_cards_kept', np.int8)])
+
+# Empty event records for N rows. Filled row by row, with set_event_record()
+def empty_event_records(num_rows):
+    records = np.zeros(num_rows, dtype=EVENT_RECORD_DTYPE)
+    records['cards'] = -1
+    return records
+
+# Copy a single input row (as returned by read_poker_event_line(encode_input=False)) into records.
+def set_event_record(records, index, input_row):
+    (cards_indices, num_draws, position, pot_size, bets, cards_kept, opponent_cards_kept) = input_row
+    records['cards'][index] = -1
+    records['cards'][index, :len(cards_indices)] = cards_indices
+    records['num_draws'][index] = num_draws
+    records['position'][index] = position
+    records['pot_size'][index] = pot_size
+    records['bets'][index] = bets
+    records['cards_kept'][index] = cards_kept
+    records['opponent_cards_kept'][index] = opponent_cards_kept
+
+# Card indices for deuce hand. Same as cards_input_from_string() [no canonical form for draw hands]
+def deuce_cards_indices_from_string(hand_string):
+    cards_indices = [card_to_index(card_from_string(card_str)) for card_str in hand_string_to_array(hand_string)]
+    assert len(cards_indices) == 5, hand_string
+    return cards_indices
+
+# Same as limit_bets_string_to_array(). But just the bits.
+def limit_bets_string_to_values(bets_string):
+    values = [0 for i in range(5)]
+    index = 0
+    for c in bets_string:
+        if index >= len(values):
+            break
+        if c == '0':
+            index += 1
+        elif c == '1':
+            values[index] = 1
+            index += 1
+        else:
+            assert (c == '1' or c == '0'), 'unknown char |%s| in bets string!' % c
+    return values
+
+# Same as big_bets_string_to_array(). But just the bet sizes.
+def big_bets_string_to_values(bets_string):
+    bet_sequence = []
+    bet_amount = 0
+    for bet in re.finditer('\S[0-9]*', bets_string):
+        bet_amount = bet.group(0)[1:]
+        if not bet_amount:
+            bet_amount = 0
+        bet_sequence.append(int(bet_amount))
+    # Exactly 5 bets. If too long, clip final 0.0 bet, then take the last five.
+    if len(bet_sequence) > 5 and bet_amount == 0.0:
+        bet_sequence = bet_sequence[:-1]
+    bet_sequence = bet_sequence[-5:]
+    return bet_sequence + [0 for i in range(5 - len(bet_sequence))]
+
+def bets_string_to_values(bets_string, format='deuce_events'):
+    if format=='nlh_events':
+        return big_bets_string_to_values(bets_string)
+    else:
+        return limit_bets_string_to_values(bets_string)
+
+# All four rounds of betting, as used by hand_input_from_context()
+def bets_columns_from_context(bets_string='', all_rounds_bets_string=None, format='deuce_events'):
+    (previous_round, round_before, two_round_before) = get_previous_round_string(all_rounds_bets_string, current_round_bets_string=bets_string, format=format)
+    return [bets_string_to_values(bets_string, format=format),
+            bets_string_to_values(previous_round, format=format),
+            bets_string_to_values(round_before, format=format),
+            bets_string_to_values(two_round_before, format=format)]
+
+# Card indices, and rounds left, for holdem hand. Same as holdem_cards_input_from_string() [including canonical form]
+def holdem_cards_indices_from_string(cards_string, flop_string, turn_string, river_string, use_canonical_form = CARDS_CANONICAL_FORM):
+    cards_array = [card_from_string(card_str) for card_str in hand_string_to_array(cards_string)]
+    flop_array = [card_from_string(card_str) for card_str in hand_string_to_array(flop_string)]
+    turn_array = [card_from_string(card_str) for card_str in hand_string_to_array(turn_string)]
+    river_array = [card_from_string(card_str) for card_str in hand_string_to_array(river_string)]
+    if use_canonical_form:
+        (cards_array, flop_array, turn_array, river_array) = holdem_cards_canonical_form(cards_array, flop_array, turn_array, river_array)
+
+    # Verify that the hand is legit
+    community = HoldemCommunityHand(flop = flop_array, turn = turn_array, river = river_array)
+    hand = HoldemHand(cards = cards_array, community = community)
+
+    # Fixed slots: [private x2, flop x3, turn, river]
+    cards_indices = [-1 for i in range(EVENT_INPUT_MAX_CARDS)]
+    for (offset, street_array) in [(0, cards_array), (2, flop_array), (5, turn_array), (6, river_array)]:
+        for i in range(len(street_array)):
+            cards_indices[offset + i] = card_to_index(street_array[i])
+    return (cards_indices, holdemRoundsLeft[community.round])
+
+# Set card indices into a plane. card_indices is (N,K) with -1 for missing cards.
+def scatter_cards_to_plane(out_flat, plane, card_indices):
+    rows, slots = np.nonzero(card_indices >= 0)
+    cards = card_indices[rows, slots]
+    for i in range(CARD_PLANE_INDICES.shape[1]):
+        out_flat[rows, plane, CARD_PLANE_INDICES[cards, i]] = 1
+
+# Same as card_to_matrix_fill(value) for each row.
+def fill_planes(out, plane, values):
+    out[:, plane, :, :] = FILL_PLANE_MATRIX * values[:, np.newaxis, np.newaxis]
+
+# Same as bet_size_to_matrix(bet_size, scale) for each row. Full chunks of 1.0 in order, then the remainder.
+def bet_sizes_to_planes(out_flat, plane, bet_sizes, scale):
+    num_bets = bet_sizes.astype(np.float64) / scale
+    assert (num_bets >= 0.0).all(), 'Attempting to encode unknown bet size %s (scale %s)' % (bet_sizes.min(), scale)
+    out_flat[:, plane, BET_CELL_INDICES] = np.clip(num_bets[:, np.newaxis] - np.arange(len(BET_CELL_INDICES)), 0.0, 1.0)
+
+# Encode N event records, directly into out buffer (N, FULL_INPUT_LENGTH, 17, 17). Overwrites the buffer.
+# Matches read_poker_event_line() encoding, bit for bit.
+def encode_event_inputs_batch(records, out, format = 'deuce_events'):
+    assert out.flags['C_CONTIGUOUS'], 'Need contiguous output buffer, for scatter writes.'
+    num_rows = out.shape[0]
+    out[:] = 0
+    out_flat = out.reshape((num_rows, out.shape[1], out.shape[2] * out.shape[3]))
+
+    # xCards [5 cards + full hand for deuce; private, flop, turn, river, community, all cards for holdem]
+    cards = records['cards'][:num_rows]
+    if not CARDS_INPUT_ALL_ZERO:
+        if format == 'deuce_events':
+            for i in range(5):
+                scatter_cards_to_plane(out_flat, i, cards[:, i:i+1])
+            scatter_cards_to_plane(out_flat, 5, cards[:, 0:5])
+        elif format == 'holdem_events' or format == 'nlh_events':
+            for (plane, start, end) in [(0, 0, 2), (1, 2, 5), (2, 5, 6), (3, 6, 7), (4, 2, 7), (5, 0, 7)]:
+                scatter_cards_to_plane(out_flat, plane, cards[:, start:end])
+        else:
+            assert False, 'unknown hand format %s' % format
+
+    # xNumDraws [encoded back to front, see num_draws_input_from_string()]
+    if not NUM_DRAWS_ALL_ZERO:
+        num_draws = records['num_draws'][:num_rows]
+        for i in range(NUM_DRAWS_PLANES):
+            fill_planes(out, NUM_CARDS_PLANES + i, (num_draws >= (NUM_DRAWS_PLANES - i)).astype(np.int32))
+
+    if CONTEXT_ALL_ZERO:
+        return out
+
+    # xPosition, xPot, xBets [this street]
+    offset = CONTEXT_PLANES_OFFSET
+    fill_planes(out, offset, records['position'][:num_rows].astype(np.int32))
+    pot_size = records['pot_size'][:num_rows]
+    if format == 'nlh_events':
+        bet_sizes_to_planes(out_flat, offset + 1, pot_size, NLH_POT_MATRIX_SCALE)
+    else:
+        num_pot_cards = np.clip(pot_size // 50, 0, len(all_cards_by_index)).astype(np.int32)
+        out[:, offset + 1, :, :] = POT_PLANE_BANK[num_pot_cards]
+
+    # Bets for each round. Order of rounds depends on format. See hand_input_from_context()
+    bets = records['bets'][:num_rows]
+    if format == 'deuce_events':
+        bets_rounds_planes = [(0, offset + 2), (1, offset + 17)]
+    else:
+        bets_rounds_planes = [(0, offset + 2), (3, offset + 7), (2, offset + 12), (1, offset + 17)]
+    for (bets_round, plane) in bets_rounds_planes:
+        for i in range(5):
+            if format == 'nlh_events':
+                bet_sizes_to_planes(out_flat, plane + i, bets[:, bets_round, i], NLH_BETS_MATRIX_SCALE)
+            else:
+                fill_planes(out, plane + i, bets[:, bets_round, i])
+
+    # xCardsKept, xOpponentKept [deuce only]
+    if format == 'deuce_events':
+        cards_kept = records['cards_kept'][:num_rows]
+        opponent_cards_kept = records['opponent_cards_kept'][:num_rows]
+        for i in range(5):
+            fill_planes(out, offset + 7 + i, (cards_kept > i).astype(np.int32))
+            fill_planes(out, offset + 12 + i, (opponent_cards_kept > i).astype(np.int32))
+
+    return out
+
+# Batch expander: event records -> (B, FULL_INPUT_LENGTH, 17, 17) float inputs.
+# Single source of truth for event encoding. Used for training, and by players at inference time (play_triple_draw, nlh_acpc_player)
+def expand_event_records(records, format = 'deuce_events', out = None):
+    if out is None:
+        out = np.empty((len(records), FULL_INPUT_LENGTH, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE), dtype=TRAINING_INPUT_TYPE)
+    return encode_event_inputs_batch(records, out, format=format)
+
+# Single row, as (FULL_INPUT_LENGTH, 17, 17) input.
+def event_input_from_row(input_row, format = 'deuce_events'):
+    records = empty_event_records(1)
+    set_event_record(records, 0, input_row)
+    return expand_event_records(records, format=format)[0]
+
+# Event record for a live game situation. Bets as strings, same as hand_input_from_context()
+def event_record_from_context(cards_indices, num_draws=0, position=0, pot_size=0, bets_string='', cards_kept=0, opponent_cards_kept=0, all_rounds_bets_string=None, format = 'deuce_events'):
+    records = empty_event_records(1)
+    bets = bets_columns_from_context(bets_string=bets_string, all_rounds_bets_string=all_rounds_bets_string, format=format)
+    set_event_record(records, 0, (cards_indices, num_draws, position, pot_size, bets, cards_kept, opponent_cards_kept))
+    return records
+
+# Hold training inputs compactly, and unpack to float one minibatch at a time, right before training.
+# Float32 inputs are ~36KB per example. Packed bits are ~1KB. Graded inputs (NLH bets & pot) ~2KB, see PACKED_GRADED_INPUT_DTYPE
+# Either way, unpacked inputs are exactly the inputs encoded. Same as the model sees at play time.
+PACKED_TRAINING_INPUTS = True
+SPARSE_EVENT_INPUTS = True # For events, keep just the event records (see EVENT_RECORD_DTYPE), and expand per minibatch
+TRAINING_INPUT_SHAPE = (FULL_INPUT_LENGTH, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE)
+TRAINING_INPUT_SIZE = FULL_INPUT_LENGTH * HAND_TO_MATRIX_PAD_SIZE * HAND_TO_MATRIX_PAD_SIZE
+PACKED_TRAINING_INPUT_BYTES = (TRAINING_INPUT_SIZE + 7) // 8
+
+# NLH bet & pot planes are chunks of bet (1.0 cells), and a remainder (see bet_size_to_plane). So each plane holds 0.0, 1.0 and at most one other value.
+# Store bits for 1.0 cells, bits for remainder cells, and the remainder value for each plane.
+PACKED_GRADED_INPUT_DTYPE = np.dtype([('ones', np.uint8, (PACKED_TRAINING_INPUT_BYTES,)),
+                                      ('fraction_cells', np.uint8, (PACKED_TRAINING_INPUT_BYTES,)),
+                                      ('fractions', TRAINING_INPUT_TYPE, (FULL_INPUT_LENGTH,))])
+
+# Are all inputs 0/1 for this format? Everything except NLH bet sizes and pot (chunks of bet, with a remainder)
+def training_inputs_are_binary(format = 'deuce_events'):
+    return format != 'nlh_events'
+
+# Empty storage for num_rows training inputs. Bits (num_rows, bytes), graded records (num_rows,) or float as before.
+def empty_training_inputs(num_rows, format = 'deuce_events', pack_inputs = PACKED_TRAINING_INPUTS):
+    if not pack_inputs:
+        return np.empty((num_rows,) + TRAINING_INPUT_SHAPE, dtype=TRAINING_INPUT_TYPE)
+    elif training_inputs_are_binary(format):
+        return np.zeros((num_rows, PACKED_TRAINING_INPUT_BYTES), dtype=np.uint8)
+    else:
+        return np.zeros(num_rows, dtype=PACKED_GRADED_INPUT_DTYPE)
+
+# Write float inputs (N, 31, 17, 17) into N rows of storage from empty_training_inputs()
+def pack_training_inputs(inputs, out):
+    num_rows = inputs.shape[0]
+    if out.dtype == PACKED_GRADED_INPUT_DTYPE:
+        planes = inputs.reshape((num_rows, FULL_INPUT_LENGTH, -1))
+        ones = (planes == 1)
+        fraction_cells = ~ones & (planes != 0)
+        first_fraction_cells = fraction_cells.argmax(axis=2)
+        fractions = planes[np.arange(num_rows)[:, np.newaxis], np.arange(FULL_INPUT_LENGTH)[np.newaxis, :], first_fraction_cells] * fraction_cells.any(axis=2)
+        assert np.all(planes[fraction_cells] == np.broadcast_to(fractions[:, :, np.newaxis], planes.shape)[fraction_cells]), 'Can not pack plane with more than one value other than 0.0 and 1.0. Use float storage.'
+        out['ones'] = np.packbits(ones.reshape((num_rows, TRAINING_INPUT_SIZE)).astype(np.uint8), axis=1)
+        out['fraction_cells'] = np.packbits(fraction_cells.reshape((num_rows, TRAINING_INPUT_SIZE)).astype(np.uint8), axis=1)
+        out['fractions'] = fractions
+    elif out.dtype != np.uint8:
+        out[:] = inputs
+    else:
+        assert np.all((inputs == 0) | (inputs == 1)), 'Can not pack non-binary inputs into bits. Use graded storage.'
+        out[:] = np.packbits(inputs.reshape((num_rows, TRAINING_INPUT_SIZE)).astype(np.uint8), axis=1)
+    return out
+
+# Bits (N, bytes) --> float inputs (N, 31, 17, 17) of 0.0 and 1.0
+def unpack_training_input_bits(bits):
+    return np.unpackbits(bits, axis=1)[:, :TRAINING_INPUT_SIZE].reshape((bits.shape[0],) + TRAINING_INPUT_SHAPE).astype(TRAINING_INPUT_TYPE)
+
+# Float inputs (N, 31, 17, 17) for a slice of storage. Event records are expanded. Passes through inputs that were never packed.
+def unpack_training_inputs(stored, format = 'deuce_events'):
+    if isinstance(stored, np.ndarray) and stored.dtype == EVENT_RECORD_DTYPE:
+        return expand_event_records(stored, format=format)
+    if isinstance(stored, np.ndarray) and stored.dtype == PACKED_GRADED_INPUT_DTYPE:
+        inputs = unpack_training_input_bits(stored['ones'])
+        fraction_cells = unpack_training_input_bits(stored['fraction_cells'])
+        inputs += fraction_cells * stored['fractions'][:, :, np.newaxis, np.newaxis]
+        return inputs
+    if not isinstance(stored, np.ndarray) or stored.dtype != np.uint8:
+        return stored
+    return unpack_training_input_bits(stored)
+
+# Encode rows [start, end) of event records, into training inputs storage. Packed storage encodes via float buffer.
+def encode_event_inputs_to_storage(records, X_train, start, end, encode_buffer = None, format = 'deuce_events'):
+    if X_train.dtype != np.uint8 and X_train.dtype != PACKED_GRADED_INPUT_DTYPE:
+        return expand_event_records(records, format=format, out=X_train[start:end])
+    encoded = expand_event_records(records, format=format, out=encode_buffer[:end-start])
+    return pack_training_inputs(encoded, X_train[start:end])
+
 # Same output format as poker line... but encodes a poker event (bet/check/fold)
 # returns (hand_input, output_class, output_array):
 # hand_input --> X by 19 x 19 padded cards and bits
 # output_class --> index of event actually taken
 # output_array --> 32-length output... but only the 'output_class' index matters. The rest are zero
 # Thus, we can train on the same model as 3-round draw decisions... resulting good initialization.
+# NOTE: With encode_input=False, hand_input is instead returned as input row (see set_event_record()) to encode later, in batch.
 def read_poker_event_line(data_array, csv_key_map, format = 'deuce_events', pad_to_fit = PAD_INPUT, include_hand_context = False, 
                           num_draw_out_position = 0, num_draw_in_position = 0, actions_this_round = '', debug=DEBUG, 
-                          prev_line=None, peek_line=None): 
+                          prev_line=None, peek_line=None, encode_input = True): 
     if debug:
         print('')
         print(data_array) 
@@ -763,7 +1219,10 @@ def read_poker_event_line(data_array, csv_key_map, format = 'deuce_events', pad_
     # X x 19 x 19 input, including our hand, & num draws. 
     if not CARDS_INPUT_ALL_ZERO:
         # Deuce events: cards, num_draws
-        if format == 'deuce_events':
+        if format == 'deuce_events' and not encode_input:
+            cards_indices = deuce_cards_indices_from_string(data_array[csv_key_map['hand']])
+            cards_num_draws = int(data_array[csv_key_map['draws_left']])
+        elif format == 'deuce_events':
             cards_input = cards_input_from_string(data_array[csv_key_map['hand']], 
                                                   include_num_draws=True, num_draws=data_array[csv_key_map['draws_left']], 
                                                   include_full_hand = True)
@@ -788,7 +1247,10 @@ def read_poker_event_line(data_array, csv_key_map, format = 'deuce_events', pad_
                 assert False, 'unparsable turn-river string |%s|' % turn_river_string
 
             #print('attempting to create bits from %s' % [cards_string, flop_string, turn_string, river_string])
-            cards_input = holdem_cards_input_from_string(cards_string, flop_string, turn_string, river_string, include_hand_context = False)
+            if not encode_input:
+                (cards_indices, cards_num_draws) = holdem_cards_indices_from_string(cards_string, flop_string, turn_string, river_string)
+            else:
+                cards_input = holdem_cards_input_from_string(cards_string, flop_string, turn_string, river_string, include_hand_context = False)
             #print(cards_input.shape)
         else:
             assert False, 'unknown hand format %s' % format
@@ -796,6 +1258,8 @@ def read_poker_event_line(data_array, csv_key_map, format = 'deuce_events', pad_
     else:
         # If we want to focus on game structure and ignore cards, push cards all 0's... [still keep 3 bits for number of rounds]
         # TODO: "num_draws_input" should return np.array to avoid confusion about order, etc
+        cards_indices = []
+        cards_num_draws = int(data_array[csv_key_map['draws_left']])
         empty_bits_cards = np.zeros((5+1, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE), dtype=TRAINING_INPUT_TYPE)
         num_draws_input = num_draws_input_from_string(num_draws_string=data_array[csv_key_map['draws_left']], pad_to_fit=pad_to_fit)
         num_draws_array = np.array([num_draws_input[0], num_draws_input[1], num_draws_input[2]], TRAINING_INPUT_TYPE)
@@ -822,11 +1286,18 @@ def read_poker_event_line(data_array, csv_key_map, format = 'deuce_events', pad_
         #    print(['them', opponent_cards_kept, (num_draw_in_position if not position else num_draw_out_position)])
         opponent_cards_kept = max(opponent_cards_kept, (num_draw_in_position if not position else num_draw_out_position)) # update from outside, if better info)
         #print('Context: %s' % [num_draws, position, pot_size, bets_string, cards_kept, opponent_cards_kept])
-        hand_context_input = hand_input_from_context(position=position, pot_size=pot_size, bets_string=bets_string,
-                                                     cards_kept=cards_kept, opponent_cards_kept=opponent_cards_kept,
-                                                     all_rounds_bets_string=all_rounds_bets_string, format=format)
-
-        full_input = np.concatenate((cards_input, hand_context_input), axis = 0)
+        if not encode_input:
+            bets_columns = bets_columns_from_context(bets_string=bets_string, all_rounds_bets_string=all_rounds_bets_string, format=format)
+            full_input = (cards_indices, cards_num_draws, position, pot_size, bets_columns, cards_kept, opponent_cards_kept)
+        else:
+            # Context planes go directly into the full input.
+            full_input = np.empty((len(cards_input) + CONTEXT_LENGTH, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE), dtype=TRAINING_INPUT_TYPE)
+            full_input[:len(cards_input)] = cards_input
+            hand_input_from_context(position=position, pot_size=pot_size, bets_string=bets_string,
+                                    cards_kept=cards_kept, opponent_cards_kept=opponent_cards_kept,
+                                    all_rounds_bets_string=all_rounds_bets_string, format=format, out=full_input[len(cards_input):])
+    elif not encode_input:
+        full_input = (cards_indices, cards_num_draws, 0, 0.0, [[0] * 5] * EVENT_INPUT_NUM_BETS_ROUNDS, 0, 0)
     else:
         empty_bits_array = np.zeros((CONTEXT_LENGTH, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE), dtype=TRAINING_INPUT_TYPE)
         full_input = np.concatenate((cards_input, empty_bits_array), axis = 0)
@@ -836,7 +1307,7 @@ def read_poker_event_line(data_array, csv_key_map, format = 'deuce_events', pad_
     print(full_input)
     print('fully concatenated input %s, shape %s' % (type(full_input), full_input.shape))
     opt = np.get_printoptions()
-    np.set_printoptions(threshold='nan')
+    np.set_printoptions(threshold=sys.maxsize)
 
     # Get all bits for input... excluding padding bits that go to 17x17
     debug_input = full_input[:,6:10,2:15]
@@ -1148,7 +1619,7 @@ def read_poker_event_line(data_array, csv_key_map, format = 'deuce_events', pad_
         try:
             assert len(oppn_line) == len(data_array)
             oppn_cards = oppn_line[csv_key_map['hand']]
-            assert oppn_cards != cards_string
+            assert oppn_cards != data_array[csv_key_map['hand']]
             round = data_array[csv_key_map['draws_left']]
             oppn_round = oppn_line[csv_key_map['draws_left']]
             assert round == oppn_round
@@ -1332,23 +1803,49 @@ def read_poker_event_line(data_array, csv_key_map, format = 'deuce_events', pad_
         return (cards_input, output_category, output_array, output_mask_classes, important_training_case)
     
 # Read CSV lines, create giant numpy arrays of the input & output values.
-def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_best_class=True, keep_all_data=False, format='video', include_num_draws = False, include_full_hand = False, sample_by_hold_value = SAMPLE_BY_HOLD_VALUE, include_hand_context = False):
-    csv_reader = csv.reader(open(filename, 'rb'), lineterminator='\n') # 'rU')) "line contains NULL byte"
+# Random [0.0, 1.0) draw for a given line of the CSV. Same line, same draw, whatever order lines are read in.
+# (splitmix64 hash of seed and line number)
+def line_random(seed, line_number):
+    mask = 0xFFFFFFFFFFFFFFFF
+    x = ((seed << 32) ^ line_number) & mask
+    x = (x + 0x9E3779B97F4A7C15) & mask
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & mask
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & mask
+    x = x ^ (x >> 31)
+    return (x >> 11) * (1.0 / (1 << 53))
+
+# Parse, sample and yield training examples from CSV, one at a time: (line number, hand_input, output_class, output_array, output_mask)
+# With encode_input=False, events are yielded as event rows (see set_event_record()) to be encoded later, in batch.
+# Used by _load_poker_csv(), and for streaming examples without loading the whole data set.
+# NOTE: With a seed, sampling is keyed by line number. So the same lines are sampled, even if CSV is read in shards.
+# To read a shard: pass its csv_rows (followed by the next row in the file, for lookahead), csv_key, prev_line and first_line (line number before the shard)
+def read_poker_csv_examples(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, keep_all_data=False, format='video', include_num_draws = False, include_full_hand = False, sample_by_hold_value = SAMPLE_BY_HOLD_VALUE, include_hand_context = False, encode_input = True, seed = None,
+                            csv_rows = None, csv_key = None, prev_line = None, first_line = 0, sample_events = True):
+    if csv_rows is None:
+        csv_reader = csv.reader(open(filename, 'rb'), lineterminator='\n') # 'rU')) "line contains NULL byte"
+    else:
+        csv_reader = iter(csv_rows)
 
-    csv_key = None
     csv_key_map = None
-
-    # Can't grow numpy arrays. So instead, be lazy and grow array to be turned into numpy arrays.
-    X_train_not_np = [] # all input data (multi-dimension nparrays)
-    # use this to create empty numpy array of the right size... and then add each line as needed
-    # TODO: Fix hardcoding of input sizes...
-    X_train = np.empty((max_input, FULL_INPUT_LENGTH, 17, 17), dtype=TRAINING_INPUT_TYPE)
-    y_train_not_np = [] # "best category" for each item
-    z_train_not_np = [] # ARRAY_OUTPUT_LENGTH-length vectors for all weights
-    m_train_not_np = [] # ARRAY_OUTPUT_LENGTH-length "mask" for which weights matter. 1 = yes 0 = N/A or ??
+    if csv_key:
+        csv_key_map = CreateMapFromCSVKey(csv_key)
+
+    # Sampling draw for current line. Unseeded, just use the random module.
+    def sample_random():
+        if seed is None:
+            return random.random()
+        return line_random(seed, lines)
+
+    # Per-hand state, reset at every blind post.
+    num_draw_out_position = 0
+    num_draw_in_position = 0
+    actions_this_round = ''
+
+    # Events may be returned unencoded, as event rows.
+    event_rows = (not encode_input) and (format == 'deuce_events' or format == 'holdem_events' or format == 'nlh_events')
     hands = 0
     last_hands_print = -1
-    lines = 0
+    lines = first_line
     important_training_cases = 0 # How many cases do we include, ignoring sampling, since worth training focus (pat hands, etc)
 
     # Sample down even harder, if outputting equivalent hands by permuted suit (fewer examples for flushes)
@@ -1359,16 +1856,12 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
     else:
         sampling_policy = DATA_SAMPLING_REDUCE_KEEP_TWO 
 
-    # compute histogram of how many hands, output "correct draw" to each of 32 choices
-    y_count_by_bucket = [0 for i in range(ARRAY_OUTPUT_LENGTH)] 
-
     # Sometimes we need to remember the next or previous input row from csv_reader. 
     # A. Save 'previous' and 'next' item. Clear these, if from a different hand
     # B. Use generator to track these update, via .next()
     # C. Don't worry about rare boundary conditions, like mid-hand CSV, last line in file, or mangled/missing data
     # D. Do handle it if we don't have the correct stats.
     # NOTE: Fix going forward with more output to CSV line. But needs backward-compatible.
-    prev_line = None
     line = csv_reader.next()
     peek_line = csv_reader.next()
     while line:
@@ -1390,6 +1883,7 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
         else:
             # Skip any mail-formed lines.
             try:
+                important_training_case = False
                 # hand_inputs represents array of *equivalent* inputs (in case we want to permute inputs, to get more data)
                 if format == 'video' or format == 'deuce':
                     hand_inputs_all, output_class, output_array = read_poker_line(line, csv_key_map, adjust_floats = format, include_num_draws=include_num_draws, include_full_hand = include_full_hand, include_hand_context = include_hand_context)
@@ -1412,7 +1906,7 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
                     # For less confusion, if input data is "events" ie bets, checks, etc... 
                     # Data gets zipped into the same training format, trained with same shape, but just initialize it differently
                     # (re-use sub functions for encoding a hand, etc, whereever possible)
-                    hand_input, output_class, output_array, output_mask_classes, important_training_case = read_poker_event_line(line, csv_key_map, format = format, include_hand_context = include_hand_context, num_draw_out_position = num_draw_out_position, num_draw_in_position = num_draw_in_position, actions_this_round = actions_this_round, prev_line=prev_line, peek_line=peek_line)
+                    hand_input, output_class, output_array, output_mask_classes, important_training_case = read_poker_event_line(line, csv_key_map, format = format, include_hand_context = include_hand_context, num_draw_out_position = num_draw_out_position, num_draw_in_position = num_draw_in_position, actions_this_round = actions_this_round, prev_line=prev_line, peek_line=peek_line, encode_input = not event_rows)
 
                     # Now, after line processed, upate # of cards drawn, if applicable
                     if format == 'deuce_events' and line and line[csv_key_map['action']]:
@@ -1477,13 +1971,13 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
                 # B. Faster training
                 if format == 'video' and sampling_policy:
                     output_percent = sampling_policy[output_class]
-                    if random.random() > output_percent:
+                    if sample_random() > output_percent:
                         continue
                 elif format == 'deuce' and sample_by_hold_value:
                     # Alternatively, sample by the *value* of class[31] (keep all)
                     # Example: down-sample all, except dealt pairs, or dealt flushes, etc
                     sample_rate = sample_rate_for_hold_value(hold_value)
-                    if random.random() > sample_rate:
+                    if sample_random() > sample_rate:
                         #if (hands % 5000) == 0 and hands != last_hands_print:
                         #    print(line)
                         #    print('Skipping item with %s hold value!\n' % hold_value)
@@ -1493,12 +1987,14 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
                     # NOTE: We do this, to cover more hands, and to not over-train on specific hand situation.
                     # TODO: Control this by flag, or pre-compute data before choosing sample policy
                     # TODO: Sample differently by "sim", "man", "cnn" actors...
+                    # NOTE: If not sample_events, keep every row. Weight important cases when sampling minibatches instead.
+                    # NOTE: Important cases always kept. Store sampler weights them the same way (see event_sample_rates)
                     sample_rate = SAMPLE_RATE_DEUCE_EVENTS
                     important_cases_sample_rate = max(sample_rate, IMPORTANT_CASES_SAMPLE_RATE)
-                    if not important_training_case and random.random() > sample_rate:
+                    if not important_training_case and sample_events and sample_random() > sample_rate:
                         #print('\nskipping from sample %s\n' % sample_rate)
                         continue
-                    elif important_training_case and random.random() <= important_cases_sample_rate:
+                    elif important_training_case and sample_random() <= important_cases_sample_rate:
                         important_training_cases += 1
 
                 # We can also add output "mask" for which of the "output_array" values matter.
@@ -1541,20 +2037,25 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
                     print('\nLoaded %d hands... (of these %d are important cases)\n' % (hands, important_training_cases))
                     print(line)
                     print('Loaded in canonical form? %s' % CARDS_CANONICAL_FORM)
-                    #print(hand_input)
-                    print(hand_input.shape)
+                    # Input may not be encoded yet (if encoding in batch)
+                    if event_rows:
+                        debug_hand_input = event_input_from_row(hand_input, format=format)
+                    else:
+                        debug_hand_input = hand_input
+                    #print(debug_hand_input)
+                    print(debug_hand_input.shape)
 
                     # Attempt to show debug of the input... without the padding...
                     if HAND_TO_MATRIX_PAD_SIZE == 17:
                         opt = np.get_printoptions()
-                        np.set_printoptions(threshold='nan')
+                        np.set_printoptions(threshold=sys.maxsize)
 
                         # Get all bits for input... excluding padding bits that go to 17x17
                         # Show 8 rows for NLH (need more space to encode bets, and (2x) redundant encode for cards)
                         if (format=='nlh_events' and DOUBLE_ROW_BET_MATRIX) or DOUBLE_ROW_HAND_MATRIX:
-                            debug_input = hand_input[:,4:12,2:15]
+                            debug_input = debug_hand_input[:,4:12,2:15]
                         else:
-                            debug_input = hand_input[:,6:10,2:15]
+                            debug_input = debug_hand_input[:,6:10,2:15]
                         print(debug_input)
                         print(debug_input.shape)
 
@@ -1575,20 +2076,10 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
 
                     #time.sleep(5)
 
-                # count class, if item chosen
-                y_count_by_bucket[output_class] += 1
-
-                # X_train_not_np.append(hand_input) # no longer needed...
-                X_train[hands,:,:,:] = hand_input # Add row to final X_train numpy array directly.
-
-                # TODO: Put the other data into numpy directly also. Will save just a little memory, but still.
-                y_train_not_np.append(output_class)
-                z_train_not_np.append(output_array)
-                m_train_not_np.append(output_mask)
-
                 hands += 1
+                yield (lines, hand_input, output_class, output_array, output_mask, important_training_case)
 
-            if hands >= max_input:
+            if max_input and hands >= max_input:
                 break
 
             # Look ahead to the next line, from the generator
@@ -1598,6 +2089,166 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
 
             #sys.exit(-3)
 
+# Parse event CSV in parallel. Split into shards at hand boundaries (blind posts), where all per-hand state is reset.
+# Each worker process parses and samples a shard. Results come back in file order, so output matches serial loading exactly.
+# NOTE: Needs a seed, since sampling then depends only on line number. See line_random()
+LOADER_RANDOM_SEED = 1234 # None --> unseeded sampling
+PARALLEL_LOAD_WORKERS = 0 # 0 --> serial loading
+PARALLEL_LOAD_SHARD_BLINDS = 10000 # blind posts per shard (two per hand, heads-up)
+
+# Same test as read_poker_csv_examples() uses to reset per-hand state. Malformed rows never reset it.
+def is_blind_post_row(row, csv_key_map):
+    action_index = csv_key_map['action']
+    if not row or len(row) <= action_index or not row[action_index]:
+        return False
+    action = actionNameToAction.get(row[action_index])
+    return bool(action) and action in ALL_BLINDS_SET
+
+# Split event CSV into shards: (first_line, prev_line, rows). Rows end with the next row in file (if any), for lookahead.
+# Mirrors the serial reader: stop at first empty row, and the final row of the file (with nothing to peek at) is never parsed.
+def poker_csv_event_shards(filename, shard_blinds = PARALLEL_LOAD_SHARD_BLINDS):
+    csv_reader = csv.reader(open(filename, 'rb'), lineterminator='\n')
+    csv_key = csv_reader.next()
+    csv_key_map = CreateMapFromCSVKey(csv_key)
+    first_line = 1 # line number of row before the shard (CSV key is line 1)
+    prev_line = csv_key
+    rows = []
+    blinds = 0
+    for row in csv_reader:
+        if rows and blinds >= shard_blinds and is_blind_post_row(row, csv_key_map):
+            yield (csv_key, first_line, prev_line, rows + [row])
+            first_line += len(rows)
+            prev_line = rows[-1]
+            rows = []
+            blinds = 0
+        if not row:
+            rows.append(row)
+            break
+        rows.append(row)
+        if is_blind_post_row(row, csv_key_map):
+            blinds += 1
+    if rows:
+        yield (csv_key, first_line, prev_line, rows)
+
+# Worker: all examples for one shard.
+def _read_poker_csv_shard(shard_and_args):
+    ((csv_key, first_line, prev_line, rows), loader_args) = shard_and_args
+    return list(read_poker_csv_examples(csv_rows=rows, csv_key=csv_key, prev_line=prev_line, first_line=first_line, max_input=None, **loader_args))
+
+# Same examples as read_poker_csv_examples(), in the same order. But parsed by a pool of worker processes.
+def parallel_poker_csv_examples(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, workers = PARALLEL_LOAD_WORKERS, shard_blinds = PARALLEL_LOAD_SHARD_BLINDS, **loader_args):
+    assert loader_args.get('seed') is not None, 'Parallel loading needs a seed, so that sampling does not depend on order of lines.'
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+    shards = poker_csv_event_shards(filename, shard_blinds=shard_blinds)
+    hands = 0
+    try:
+        while True:
+            # Keep a few shards in flight per worker, so as not to read the whole file into memory.
+            while len(pending) < 2 * workers:
+                shard = next(shards, None)
+                if shard is None:
+                    break
+                pending.append(pool.apply_async(_read_poker_csv_shard, ((shard, loader_args),)))
+            if not pending:
+                break
+            for example in pending.popleft().get():
+                yield example
+                hands += 1
+                if max_input and hands >= max_input:
+                    return
+    finally:
+        pool.terminate()
+
+# Compare parallel and serial loading for a file. Everything should match exactly.
+# NOTE: File must parse to some hands (current event CSV columns). Otherwise nothing is compared, so raise. See tests/test_parallel_load.py
+# python -c "import draw_poker; draw_poker.compare_parallel_load('events.csv', format='deuce_events', include_hand_context=True)"
+def compare_parallel_load(filename, format='deuce_events', max_input=MAX_INPUT_SIZE, workers=4, seed=LOADER_RANDOM_SEED, **loader_args):
+    serial_lines = []
+    serial = _load_poker_csv(filename=filename, max_input=max_input, format=format, seed=seed, sampled_lines=serial_lines, **loader_args)
+    parallel_lines = []
+    parallel = _load_poker_csv(filename=filename, max_input=max_input, format=format, seed=seed, sampled_lines=parallel_lines, workers=workers, **loader_args)
+    hands = serial[0]
+    if not hands and not parallel[0]:
+        raise ValueError('No hands loaded from %s, serial or parallel. Nothing to compare.' % filename)
+    assert parallel[0] == hands, 'Loaded %d hands in parallel, vs %d serial' % (parallel[0], hands)
+    assert parallel_lines == serial_lines, 'Different lines sampled in parallel'
+    for (name, serial_array, parallel_array) in zip(['X', 'y', 'z', 'm'], serial[1:], parallel[1:]):
+        assert np.array_equal(serial_array[:hands], parallel_array[:hands]), 'Parallel load does not match serial for %s' % name
+    print('parallel load with %d workers matches serial load: %d hands from %s' % (workers, hands, filename))
+    return hands
+
+def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_best_class=True, keep_all_data=False, format='video', include_num_draws = False, include_full_hand = False, sample_by_hold_value = SAMPLE_BY_HOLD_VALUE, include_hand_context = False, pack_inputs = False, sparse_inputs = False, seed = None, sampled_lines = None, workers = 0, shard_blinds = PARALLEL_LOAD_SHARD_BLINDS, sample_events = True, important_cases = None):
+    # Can't grow numpy arrays. So instead, be lazy and grow array to be turned into numpy arrays.
+    X_train_not_np = [] # all input data (multi-dimension nparrays)
+    # use this to create empty numpy array of the right size... and then add each line as needed
+    # TODO: Fix hardcoding of input sizes...
+    # For events, parse lines into event records, and encode these into X_train a chunk at a time. Much faster than row by row.
+    batch_encode_inputs = BATCH_ENCODE_EVENT_INPUTS and (format == 'deuce_events' or format == 'holdem_events' or format == 'nlh_events')
+    # If sparse_inputs, just keep the event records. If pack_inputs, store as bits (or bits and remainders, for graded inputs).
+    # Either way, use unpack_training_inputs() to get float inputs back, per minibatch.
+    sparse_inputs = sparse_inputs and batch_encode_inputs
+    if sparse_inputs:
+        X_train = empty_event_records(max_input)
+    else:
+        X_train = empty_training_inputs(max_input, format=format, pack_inputs=pack_inputs)
+    encode_chunks = batch_encode_inputs and not sparse_inputs
+    if encode_chunks:
+        input_records = empty_event_records(EVENT_ENCODE_CHUNK_SIZE)
+        encoded_hands = 0 # rows of X_train already encoded
+        encode_buffer = None
+        if pack_inputs:
+            encode_buffer = np.empty((EVENT_ENCODE_CHUNK_SIZE,) + TRAINING_INPUT_SHAPE, dtype=TRAINING_INPUT_TYPE)
+    y_train_not_np = [] # "best category" for each item
+    z_train_not_np = [] # ARRAY_OUTPUT_LENGTH-length vectors for all weights
+    m_train_not_np = [] # ARRAY_OUTPUT_LENGTH-length "mask" for which weights matter. 1 = yes 0 = N/A or ??
+    hands = 0
+
+    # compute histogram of how many hands, output "correct draw" to each of 32 choices
+    y_count_by_bucket = [0 for i in range(ARRAY_OUTPUT_LENGTH)] 
+
+    # Parse and sample the examples. Store each one, as it comes.
+    # Events can be parsed in parallel (sharded at hand boundaries), with exactly the same result.
+    if workers and (format == 'deuce_events' or format == 'holdem_events' or format == 'nlh_events'):
+        examples = parallel_poker_csv_examples(filename=filename, max_input=max_input, workers=workers, shard_blinds=shard_blinds, keep_all_data=keep_all_data, format=format, include_num_draws=include_num_draws, include_full_hand=include_full_hand,
+                                               sample_by_hold_value=sample_by_hold_value, include_hand_context=include_hand_context, encode_input=not batch_encode_inputs, seed=seed, sample_events=sample_events)
+    else:
+        examples = read_poker_csv_examples(filename=filename, max_input=max_input, keep_all_data=keep_all_data, format=format, include_num_draws=include_num_draws, include_full_hand=include_full_hand,
+                                           sample_by_hold_value=sample_by_hold_value, include_hand_context=include_hand_context, encode_input=not batch_encode_inputs, seed=seed, sample_events=sample_events)
+    for (line_number, hand_input, output_class, output_array, output_mask, important_training_case) in examples:
+        # count class, if item chosen
+        y_count_by_bucket[output_class] += 1
+
+        # X_train_not_np.append(hand_input) # no longer needed...
+        if sparse_inputs:
+            set_event_record(X_train, hands, hand_input) # Expanded later, one minibatch at a time
+        elif batch_encode_inputs:
+            set_event_record(input_records, hands - encoded_hands, hand_input) # Encoded below, with the rest of the chunk
+        else:
+            pack_training_inputs(np.asarray(hand_input)[np.newaxis], X_train[hands:hands+1]) # Add row to final X_train numpy array directly.
+
+        # TODO: Put the other data into numpy directly also. Will save just a little memory, but still.
+        y_train_not_np.append(output_class)
+        z_train_not_np.append(output_array)
+        m_train_not_np.append(output_mask)
+
+        hands += 1
+        # Record which lines were sampled, if asked.
+        if sampled_lines is not None:
+            sampled_lines.append(line_number)
+        if important_cases is not None:
+            important_cases.append(important_training_case)
+
+        # Encode full chunk of inputs, directly into X_train
+        if encode_chunks and hands - encoded_hands >= EVENT_ENCODE_CHUNK_SIZE:
+            encode_event_inputs_to_storage(input_records, X_train, encoded_hands, hands, encode_buffer=encode_buffer, format=format)
+            encoded_hands = hands
+
+    # Encode any remaining inputs
+    if encode_chunks and hands > encoded_hands:
+        encode_event_inputs_to_storage(input_records, X_train, encoded_hands, hands, encode_buffer=encode_buffer, format=format)
+        encoded_hands = hands
+
     # Show histogram... of counts by 32 categories.
     if format == 'deuce_events' or format == 'holdem_events' or format == 'nlh_events':
         for action in ALL_ACTION_CATEGORY_SET:
@@ -1608,7 +2259,7 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
         for i in range(len(HOLDEM_VALUE_KEYS)):
             action = HOLDEM_VALUE_KEYS[i]
             DRAW_VALUE_KEYS[i] = action
-    print('count ground truth for 32 categories:\n%s\n' % ('\n'.join([str([DRAW_VALUE_KEYS[i],y_count_by_bucket[i],'%.1f%%' % (y_count_by_bucket[i]*100.0/hands)]) for i in range(STANDARD_OUTPUT_LENGTH)])))
+    print('count ground truth for 32 categories:\n%s\n' % ('\n'.join([str([DRAW_VALUE_KEYS[i],y_count_by_bucket[i],'%.1f%%' % (y_count_by_bucket[i]*100.0/max(hands, 1))]) for i in range(STANDARD_OUTPUT_LENGTH)])))
 
     #X_train = np.array(X_train_not_np)
     y_train = np.array(y_train_not_np)
@@ -1619,14 +2270,507 @@ def _load_poker_csv(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_bes
     #print(X_train)
     #print(y_train)
     print('num_examples (train) %s' % X_train.shape[0])
-    print('input_dimensions %s' % X_train.shape[1])
+    print('input_dimensions %s' % FULL_INPUT_LENGTH)
     print('X_train object is type %s of shape %s' % (type(X_train), X_train.shape))
+    print('X_train storage %s, %.1f MB' % (X_train.dtype, X_train.nbytes / (1024.0 * 1024.0)))
     print('y_train object is type %s of shape %s' % (type(y_train), y_train.shape))
     print('z_train object is type %s of shape %s' % (type(z_train), z_train.shape))
     print('m_train object is type %s of shape %s' % (type(m_train), m_train.shape))
+    print_encoder_cache_stats()
 
     return (hands, X_train, y_train, z_train, m_train)
 
+# Cache the output of _load_poker_csv() to disk, as .npy files plus a JSON manifest. Next run can memory-map in seconds.
+# Cached data set is keyed by source file checksum, and every flag that changes parsing, sampling or encoding.
+DATASET_CACHE_DIR = '../data/cache'
+DATASET_CACHE_VERSION = 4 # bump, if changing encoding or loader, to invalidate old artifacts
+DATASET_CACHE_ARRAYS = ['X', 'y', 'z', 'm', 'lines', 'important'] # lines == CSV line numbers, sampled into the data set. important == important training case (pat draws, etc)
+
+# Checksum for large file, in chunks.
+def file_checksum(filename, chunk_size = 2**20):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# Everything that determines the loaded data. If any of it changes, the cached artifact is not valid.
+def dataset_cache_key(filename, max_input, output_best_class, keep_all_data, format, include_num_draws, include_full_hand,
+                      sample_by_hold_value, include_hand_context, pack_inputs, sparse_inputs, seed, sample_events = True):
+    return {'version': DATASET_CACHE_VERSION,
+            'source': os.path.basename(filename),
+            'checksum': file_checksum(filename),
+            'format': format,
+            'max_input': max_input,
+            'output_best_class': output_best_class,
+            'keep_all_data': keep_all_data,
+            'include_num_draws': include_num_draws,
+            'include_full_hand': include_full_hand,
+            'include_hand_context': include_hand_context,
+            'sample_by_hold_value': sample_by_hold_value,
+            'pack_inputs': pack_inputs,
+            'sparse_inputs': sparse_inputs,
+            'seed': seed,
+            'sample_events': sample_events,
+            'cards_canonical_form': CARDS_CANONICAL_FORM,
+            'sample_rate_deuce_events': SAMPLE_RATE_DEUCE_EVENTS,
+            'important_cases_sample_rate': IMPORTANT_CASES_SAMPLE_RATE,
+            'data_sampling_policy': DATA_SAMPLING_REDUCE_KEEP_TWO,
+            'important_cases': [LOW_STRAIGHTS_ARE_IMPORTANT, PAT_DRAWS_ARE_IMPORTANT, RIVER_CALLS_ARE_IMPORTANT, RIVER_RAISES_ARE_IMPORTANT,
+                                HOLDEM_TWO_PAIR_ARE_IMPORTANT, HOLDEM_RIVER_PLAY_BOARD_ARE_IMPORTANT, NLH_BIG_BETS_ARE_IMPORTANT, NLH_BIG_POTS_ARE_IMPORTANT],
+            'players_include_deuce_events': sorted(PLAYERS_INCLUDE_DEUCE_EVENTS),
+            'inputs_all_zero': [CARDS_INPUT_ALL_ZERO, NUM_DRAWS_ALL_ZERO, CONTEXT_ALL_ZERO],
+            'full_input_length': FULL_INPUT_LENGTH,
+            'training_input_type': str(TRAINING_INPUT_TYPE),
+            'double_row_bet_matrix': DOUBLE_ROW_BET_MATRIX,
+            'nlh_matrix_scale': [NLH_BETS_MATRIX_SCALE, NLH_POT_MATRIX_SCALE]}
+
+# One directory per artifact. Named for the source file, and hash of the key.
+def dataset_cache_path(filename, cache_key, cache_dir = DATASET_CACHE_DIR):
+    key_hash = hashlib.sha1(json.dumps(cache_key, sort_keys=True)).hexdigest()[:16]
+    return os.path.join(cache_dir, '%s_%s' % (os.path.basename(filename), key_hash))
+
+# Write (hands, X, y, z, m) and sampled lines. Into temp directory first, so that partial artifacts are never loaded.
+# If another process wrote the same artifact first, keep theirs. Returns False in that case.
+def save_dataset_artifact(path, cache_key, data, sampled_lines, important_cases):
+    (hands, X_train, y_train, z_train, m_train) = data
+    arrays = {'X': X_train[:hands], 'y': y_train[:hands], 'z': z_train[:hands], 'm': m_train[:hands],
+              'lines': np.array(sampled_lines[:hands], dtype=np.int64), 'important': np.array(important_cases[:hands], dtype=np.bool_)}
+    temp_path = '%s.tmp%d' % (path, os.getpid())
+    if not os.path.isdir(temp_path):
+        os.makedirs(temp_path)
+    for name in DATASET_CACHE_ARRAYS:
+        np.save(os.path.join(temp_path, '%s.npy' % name), arrays[name])
+    manifest = {'key': cache_key, 'hands': hands,
+                'arrays': dict([(name, {'dtype': str(arrays[name].dtype), 'shape': list(arrays[name].shape)}) for name in DATASET_CACHE_ARRAYS])}
+    with open(os.path.join(temp_path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=2)
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # Can't rename over non-empty directory. Another writer won (same key, so same data)
+        if not os.path.isdir(path):
+            raise
+        shutil.rmtree(temp_path)
+        print('data set artifact %s already saved by another process' % path)
+        return False
+    print('saved data set artifact with %d hands to %s' % (hands, path))
+    return True
+
+# Memory-map cached (hands, X, y, z, m) if artifact exists and matches the key. Else None.
+def load_dataset_artifact(path, cache_key):
+    manifest_file = os.path.join(path, 'manifest.json')
+    if not os.path.isfile(manifest_file):
+        return None
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+    if manifest['key'] != json.loads(json.dumps(cache_key)):
+        print('data set artifact %s does not match current flags. Ignoring it.' % path)
+        return None
+    arrays = {}
+    for name in DATASET_CACHE_ARRAYS:
+        arrays[name] = np.load(os.path.join(path, '%s.npy' % name), mmap_mode='r')
+        assert list(arrays[name].shape) == manifest['arrays'][name]['shape'], 'Corrupt data set artifact %s (%s)' % (path, name)
+    print('loaded data set artifact with %d hands from %s' % (manifest['hands'], path))
+    return (manifest['hands'], arrays['X'], arrays['y'], arrays['z'], arrays['m'])
+
+# Memory-map one of the other arrays ('lines' or 'important') from a data set artifact.
+def load_dataset_artifact_array(path, name):
+    return np.load(os.path.join(path, '%s.npy' % name), mmap_mode='r')
+
+# Same as _load_poker_csv(), but cached. First run parses the CSV and saves the artifact, later runs memory-map it.
+# NOTE: Needs a seed. Sampling then depends only on line numbers (see line_random), and never touches the global random state.
+# So random & np.random are in the same state after loading, whether or not the artifact was cached.
+def load_poker_csv_cached(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, output_best_class=True, keep_all_data=False, format='video', include_num_draws = False, include_full_hand = False, sample_by_hold_value = SAMPLE_BY_HOLD_VALUE, include_hand_context = False, pack_inputs = False, sparse_inputs = False, seed = LOADER_RANDOM_SEED, cache_dir = DATASET_CACHE_DIR):
+    assert seed is not None, 'Cached data set needs a seed, so that sampling is reproducible.'
+    now = time.time()
+    cache_key = dataset_cache_key(filename, max_input, output_best_class, keep_all_data, format, include_num_draws, include_full_hand,
+                                  sample_by_hold_value, include_hand_context, pack_inputs, sparse_inputs, seed)
+    path = dataset_cache_path(filename, cache_key, cache_dir = cache_dir)
+    data = load_dataset_artifact(path, cache_key)
+    if data:
+        print('%.2fs to load cached data set' % (time.time() - now))
+        return data
+
+    sampled_lines = []
+    important_cases = []
+    data = _load_poker_csv(filename=filename, max_input=max_input, output_best_class=output_best_class, keep_all_data=keep_all_data, format=format,
+                           include_num_draws=include_num_draws, include_full_hand=include_full_hand, sample_by_hold_value=sample_by_hold_value,
+                           include_hand_context=include_hand_context, pack_inputs=pack_inputs, sparse_inputs=sparse_inputs, seed=seed, sampled_lines=sampled_lines, important_cases=important_cases)
+    if not save_dataset_artifact(path, cache_key, data, sampled_lines, important_cases):
+        # Use the artifact saved first, so all processes share the same memory-mapped arrays.
+        data = load_dataset_artifact(path, cache_key) or data
+    print('%.2fs to load and cache data set' % (time.time() - now))
+    return data
+
+# Stream minibatches to train(), in bounded memory. Minibatches are shuffled and encoded in a background thread,
+# and handed over through a bounded queue. So the next batch is ready while the model trains on the current one.
+# Examples come from CSV directly, or from stored arrays (such as memory-mapped data set artifact).
+STREAM_SHUFFLE_BUFFER_SIZE = 50000 # examples kept in buffer, to shuffle the stream
+STREAM_PREFETCH_BATCHES = 10 # finished minibatches waiting in queue
+STREAM_CHUNK_SIZE = 10000 # read stored arrays in chunks (in random order), to keep reads sequential
+
+# Examples (hand_input, output_class, output_array, output_mask) straight from the CSV. Events as event rows, encoded per minibatch.
+# Skip the first skip_examples (validation and test sets, if loaded from the same file with the same seed)
+def csv_example_stream(filename=DATA_FILENAME, max_input=MAX_INPUT_SIZE, keep_all_data=False, format='video', include_num_draws = False, include_full_hand = False, sample_by_hold_value = SAMPLE_BY_HOLD_VALUE, include_hand_context = False, seed = None, skip_examples = 0):
+    examples = read_poker_csv_examples(filename=filename, max_input=max_input, keep_all_data=keep_all_data, format=format, include_num_draws=include_num_draws, include_full_hand=include_full_hand,
+                                       sample_by_hold_value=sample_by_hold_value, include_hand_context=include_hand_context, encode_input=False, seed=seed)
+    for (line_number, hand_input, output_class, output_array, output_mask, important_training_case) in itertools.islice(examples, skip_examples, None):
+        yield (hand_input, output_class, output_array, output_mask)
+
+# Collapse duplicate training examples (same encoded input, or same event record) into one example. Preflop and common spots repeat a lot.
+# Count is folded into the mask, which already weights every output in the loss (see value_action_error): sum of masks,
+# and mask-weighted average of targets, for each output. Squared error summed over the duplicates is the same, up to a constant.
+# Examples with bet targets and with draw targets are never merged, since the loss masks these differently.
+# Returns (X, y, z, m, counts) for unique examples, in order of first appearance. y (best class) from first appearance.
+def deduplicate_training_data(X, y, z, m, chunk_size = STREAM_CHUNK_SIZE):
+    now = time.time()
+    num_rows = len(y)
+    bet_categories = sorted(ALL_ACTION_CATEGORY_SET)
+    unique_keys = {}
+    first_rows = []
+    unique_index = np.empty(num_rows, dtype=np.int64)
+    for start in range(0, num_rows, chunk_size):
+        end = min(start + chunk_size, num_rows)
+        X_chunk = np.ascontiguousarray(X[start:end])
+        bet_targets = np.asarray(z[start:end])[:, bet_categories].sum(axis=1) > 0.0
+        for i in range(end - start):
+            key = (hashlib.sha1(X_chunk[i:i+1].tobytes()).digest(), bet_targets[i])
+            index = unique_keys.get(key)
+            if index is None:
+                index = len(first_rows)
+                unique_keys[key] = index
+                first_rows.append(start + i)
+            unique_index[start + i] = index
+    first_rows = np.array(first_rows, dtype=np.int64)
+    num_unique = len(first_rows)
+
+    counts = np.bincount(unique_index, minlength=num_unique)
+    z = np.asarray(z, dtype=np.float64)
+    m = np.asarray(m, dtype=np.float64)
+    mask_sum = np.zeros((num_unique, m.shape[1]))
+    masked_target_sum = np.zeros((num_unique, z.shape[1]))
+    target_sum = np.zeros((num_unique, z.shape[1]))
+    np.add.at(mask_sum, unique_index, m)
+    np.add.at(masked_target_sum, unique_index, z * m)
+    np.add.at(target_sum, unique_index, z)
+    # Where no example has a mask, average over all of them. Not trained on directly, but action% loss looks at these values.
+    z_unique = np.where(mask_sum > 0.0, masked_target_sum / np.maximum(mask_sum, 1e-8), target_sum / counts[:, np.newaxis])
+
+    print('deduplicated %d training examples to %d unique (%.1f%%) in %.2fs. Most repeated: %d' % (num_rows, num_unique, num_unique * 100.0 / max(num_rows, 1), time.time() - now, counts.max() if num_unique else 0))
+    return (np.array(X[first_rows]), np.array(y[first_rows]), z_unique.astype(np.float32), mask_sum.astype(np.float32), counts)
+
+# Examples from stored arrays. Inputs as stored (event records, packed bits or float). Chunks in random order.
+def array_example_stream(X, y, z, m, chunk_size = STREAM_CHUNK_SIZE, rng = random):
+    num_examples = len(y)
+    chunks = [(X, y, z, m, start, min(start + chunk_size, num_examples)) for start in range(0, num_examples, chunk_size)]
+    rng.shuffle(chunks)
+    return chunk_example_stream(chunks)
+
+# Examples from list of (X, y, z, m, start, end) chunks, in the given order. Each chunk read (from memory-map) in one go.
+def chunk_example_stream(chunks):
+    for (X, y, z, m, start, end) in chunks:
+        (X_chunk, y_chunk, z_chunk, m_chunk) = (np.array(X[start:end]), np.array(y[start:end]), np.array(z[start:end]), np.array(m[start:end]))
+        for i in range(end - start):
+            yield (X_chunk[i], y_chunk[i], z_chunk[i], m_chunk[i])
+
+# Shuffle a stream, holding at most buffer_size examples.
+def shuffle_example_stream(examples, buffer_size = STREAM_SHUFFLE_BUFFER_SIZE, rng = random):
+    buffer = []
+    for example in examples:
+        if len(buffer) < buffer_size:
+            buffer.append(example)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = example
+    rng.shuffle(buffer)
+    for example in buffer:
+        yield example
+
+# Minibatch (X, y, z, m) ready for training, from list of examples. Expands event rows and records, unpacks packed inputs.
+def minibatch_from_examples(examples, format = 'deuce_events'):
+    (inputs, y_batch, z_batch, m_batch) = zip(*examples)
+    if isinstance(inputs[0], tuple):
+        records = empty_event_records(len(inputs))
+        for i in range(len(inputs)):
+            set_event_record(records, i, inputs[i])
+        X_batch = expand_event_records(records, format=format)
+    else:
+        X_batch = unpack_training_inputs(np.array(list(inputs), dtype=inputs[0].dtype), format=format)
+    return (lasagne.utils.floatX(X_batch), np.array(y_batch, dtype=np.int32), lasagne.utils.floatX(np.array(z_batch)), lasagne.utils.floatX(np.array(m_batch)))
+
+# Generator of (X, y, z, m) minibatches. Shuffled and encoded in background thread. Last partial batch is dropped, as in train().
+def stream_minibatches(examples, batch_size = BATCH_SIZE, format = 'deuce_events', shuffle_buffer_size = STREAM_SHUFFLE_BUFFER_SIZE, queue_size = STREAM_PREFETCH_BATCHES, seed = None):
+    batch_queue = Queue.Queue(maxsize=queue_size)
+    stop = threading.Event() # set if consumer goes away early
+    rng = random.Random(seed) # own random state, so as not to upset sampling of CSV examples
+
+    def put_batch(item):
+        while not stop.is_set():
+            try:
+                batch_queue.put(item, timeout=1.0)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def prepare_batches():
+        try:
+            batch = []
+            # Streams already drawn at random (see dataset_store_sampled_stream) need no shuffle buffer.
+            if shuffle_buffer_size:
+                examples_shuffled = shuffle_example_stream(examples, buffer_size=shuffle_buffer_size, rng=rng)
+            else:
+                examples_shuffled = examples
+            for example in examples_shuffled:
+                batch.append(example)
+                if len(batch) >= batch_size:
+                    if not put_batch(minibatch_from_examples(batch, format=format)):
+                        return
+                    batch = []
+            put_batch(None)
+        except Exception as e:
+            print('Error preparing minibatch: %s' % e)
+            put_batch(e)
+
+    thread = threading.Thread(target=prepare_batches)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = batch_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+# Incremental data set store. Each event CSV (self-play, or ACPC logs vs Slumbot, Tartanian7, etc) is parsed and encoded once,
+# and added to the store as a shard (same artifact as in the cache). store.json lists the shards, with source, opponent and hand count.
+# Training selects shards and mixture weights by source, and streams from them. Adding a new file only parses that file.
+DATASET_STORE_DIR = '../data/store'
+DATASET_STORE_MANIFEST = 'store.json'
+DATASET_STORE_LOCK = 'store.lock' # flock() held while reading, updating and renaming store.json
+
+def load_dataset_store_manifest(store_dir = DATASET_STORE_DIR):
+    manifest_file = os.path.join(store_dir, DATASET_STORE_MANIFEST)
+    if not os.path.isfile(manifest_file):
+        return {'shards': []}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+# Write to temp file, and rename. So that store.json is never partially written.
+def save_dataset_store_manifest(manifest, store_dir = DATASET_STORE_DIR):
+    temp_file = os.path.join(store_dir, '%s.tmp%d' % (DATASET_STORE_MANIFEST, os.getpid()))
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=2)
+    os.rename(temp_file, os.path.join(store_dir, DATASET_STORE_MANIFEST))
+
+# Exclusive lock on the store. Otherwise two writers both read store.json, and the last rename loses the other's shard.
+def lock_dataset_store(store_dir = DATASET_STORE_DIR):
+    lock_file = open(os.path.join(store_dir, DATASET_STORE_LOCK), 'a')
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+def unlock_dataset_store(lock_file):
+    fcntl.flock(lock_file, fcntl.LOCK_UN)
+    lock_file.close()
+
+# Parse and encode CSV, and add it to the store as a new shard. Nothing to do, if already stored with the same flags.
+# source == 'self_play', 'Slumbot', etc. Used to select shards for training, and to weight the mixture.
+# By default, keep every event row (no down-sampling). Sample by weight while training instead. See dataset_store_sampler()
+def add_dataset_store_shard(filename, source, opponent = None, store_dir = DATASET_STORE_DIR, max_input=MAX_INPUT_SIZE, output_best_class=True, keep_all_data=False, format='deuce_events', include_num_draws = False, include_full_hand = False, sample_by_hold_value = SAMPLE_BY_HOLD_VALUE, include_hand_context = False, pack_inputs = False, sparse_inputs = False, seed = LOADER_RANDOM_SEED, workers = PARALLEL_LOAD_WORKERS, sample_events = False):
+    now = time.time()
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    cache_key = dataset_cache_key(filename, max_input, output_best_class, keep_all_data, format, include_num_draws, include_full_hand,
+                                  sample_by_hold_value, include_hand_context, pack_inputs, sparse_inputs, seed, sample_events=sample_events)
+    path = dataset_cache_path(filename, cache_key, cache_dir = store_dir)
+    name = os.path.basename(path)
+    manifest = load_dataset_store_manifest(store_dir)
+    for shard in manifest['shards']:
+        if shard['name'] == name:
+            print('%s already in data set store, as shard %s' % (filename, name))
+            return shard
+
+    # Artifact may already exist, if interrupted before updating store.json
+    data = load_dataset_artifact(path, cache_key)
+    if not data:
+        sampled_lines = []
+        important_cases = []
+        data = _load_poker_csv(filename=filename, max_input=max_input, output_best_class=output_best_class, keep_all_data=keep_all_data, format=format,
+                               include_num_draws=include_num_draws, include_full_hand=include_full_hand, sample_by_hold_value=sample_by_hold_value,
+                               include_hand_context=include_hand_context, pack_inputs=pack_inputs, sparse_inputs=sparse_inputs, seed=seed, sampled_lines=sampled_lines,
+                               workers=workers, sample_events=sample_events, important_cases=important_cases)
+        save_dataset_artifact(path, cache_key, data, sampled_lines, important_cases)
+    important = int(np.sum(load_dataset_artifact_array(path, 'important')))
+    shard = {'name': name, 'source': source, 'opponent': opponent, 'filename': filename, 'format': format, 'hands': data[0], 'important': important,
+             'key': cache_key, 'added': time.strftime('%Y-%m-%d %H:%M:%S')}
+    # Parsing is done without the lock. Re-read store.json under the lock, since other writers may have added shards meanwhile.
+    lock_file = lock_dataset_store(store_dir)
+    try:
+        manifest = load_dataset_store_manifest(store_dir)
+        for stored_shard in manifest['shards']:
+            if stored_shard['name'] == name:
+                print('%s added to data set store by another process, as shard %s' % (filename, name))
+                return stored_shard
+        manifest['shards'].append(shard)
+        save_dataset_store_manifest(manifest, store_dir)
+    finally:
+        unlock_dataset_store(lock_file)
+    print('%.2fs to add %d hands from %s to data set store (%d shards)' % (time.time() - now, data[0], filename, len(manifest['shards'])))
+    return shard
+
+# Shards for any of the given sources (and opponents), in the order added. None --> all of them.
+def select_dataset_shards(manifest, sources = None, opponents = None, format = None):
+    shards = []
+    for shard in manifest['shards']:
+        if sources is not None and shard['source'] not in sources:
+            continue
+        if opponents is not None and shard['opponent'] not in opponents:
+            continue
+        if format is not None and shard['format'] != format:
+            continue
+        shards.append(shard)
+    return shards
+
+# Memory-map selected shards. Returns list of (shard, (hands, X, y, z, m), important). All shards must have the same input storage.
+def load_dataset_store_shards(shards, store_dir = DATASET_STORE_DIR):
+    shard_data = []
+    for shard in shards:
+        path = os.path.join(store_dir, shard['name'])
+        data = load_dataset_artifact(path, shard['key'])
+        assert data, 'Missing or corrupt shard %s in data set store %s' % (shard['name'], store_dir)
+        if shard_data:
+            (first_X, X) = (shard_data[0][1][1], data[1])
+            assert X.dtype == first_X.dtype and X.shape[1:] == first_X.shape[1:], 'Shard %s stored as %s %s, vs %s %s' % (shard['name'], X.dtype, X.shape[1:], first_X.dtype, first_X.shape[1:])
+        shard_data.append((shard, data, load_dataset_artifact_array(path, 'important')))
+    return shard_data
+
+# Hold out the first holdout examples (across shards, in order) for validation & test. Same examples for every mix of weights.
+# Returns (hands, X, y, z, m) for held out examples, and where training data starts in each shard.
+def dataset_store_holdout(shard_data, holdout):
+    held_out = [[], [], [], []]
+    starts = []
+    for (shard, (hands, X, y, z, m), important) in shard_data:
+        start = min(hands, holdout - sum([len(held_y) for held_y in held_out[1]]))
+        for (held, array) in zip(held_out, [X, y, z, m]):
+            held.append(np.array(array[:start]))
+        starts.append(start)
+    data = [np.concatenate(held) for held in held_out]
+    return ((len(data[1]),) + tuple(data), starts)
+
+# Examples per epoch, from store shards. Mixture weight by source: 2.0 --> every example twice, 0.5 --> random half (by chunks).
+def dataset_store_epoch_size(shard_data, mixture = None, starts = None, chunk_size = STREAM_CHUNK_SIZE):
+    return sum([end - start for (X, y, z, m, start, end) in dataset_store_chunks(shard_data, mixture=mixture, starts=starts, chunk_size=chunk_size, rng=random.Random(0))])
+
+def dataset_store_chunks(shard_data, mixture = None, starts = None, chunk_size = STREAM_CHUNK_SIZE, rng = random):
+    chunks = []
+    for (i, (shard, (hands, X, y, z, m), important)) in enumerate(shard_data):
+        weight = mixture.get(shard['source'], 0.0) if mixture else 1.0
+        first = starts[i] if starts else 0
+        shard_chunks = [(X, y, z, m, start, min(start + chunk_size, hands)) for start in range(first, hands, chunk_size)]
+        repeats = int(weight)
+        chunks += shard_chunks * repeats
+        chunks += rng.sample(shard_chunks, int(round((weight - repeats) * len(shard_chunks))))
+    rng.shuffle(chunks)
+    return chunks
+
+# Stream one epoch of examples from the store shards, mixed by source weights. Chunks in random order, as for array_example_stream()
+def dataset_store_example_stream(shard_data, mixture = None, starts = None, chunk_size = STREAM_CHUNK_SIZE, rng = random):
+    return chunk_example_stream(dataset_store_chunks(shard_data, mixture=mixture, starts=starts, chunk_size=chunk_size, rng=rng))
+
+# Weighted sampling from the store, with alias tables. Every row is stored once (no down-sampling when loading).
+# Each epoch's examples are drawn by weight: mixture weight per source, and extra weight for important cases (pat draws, river calls, etc)
+# Changing the mix only rebuilds a (tiny) table. Nothing to reload, and no data thrown away.
+# Weight for important cases: same balance vs other events, as down-sampling at load time.
+def important_cases_weight(sample_rate = SAMPLE_RATE_DEUCE_EVENTS):
+    (other_rate, important_rate) = event_sample_rates(sample_rate)
+    return important_rate / other_rate
+IMPORTANT_CASES_WEIGHT = important_cases_weight()
+STORE_SAMPLER_BLOCK_SIZE = 10000 # examples drawn (and read from shards) at once
+
+# Alias table (Walker, Vose) to sample index i with probability weights[i] / sum(weights), in constant time.
+def build_alias_table(weights):
+    weights = np.asarray(weights, dtype=np.float64)
+    assert weights.sum() > 0.0, 'Can not sample from zero weights %s' % weights
+    num_items = len(weights)
+    scaled = weights * num_items / weights.sum()
+    probability = np.ones(num_items)
+    alias = np.arange(num_items)
+    small = [i for i in range(num_items) if scaled[i] < 1.0]
+    large = [i for i in range(num_items) if scaled[i] >= 1.0]
+    while small and large:
+        (less, more) = (small.pop(), large.pop())
+        probability[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1.0 - scaled[less]
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+    # Whatever is left over is 1.0 (up to rounding)
+    return (probability, alias)
+
+def sample_alias_table(alias_table, size, rng = np.random):
+    (probability, alias) = alias_table
+    index = rng.randint(len(probability), size=size)
+    return np.where(rng.random_sample(size) < probability[index], index, alias[index])
+
+# Sampler over training rows of the store shards (after holdout). Rows grouped into buckets by (source, important case).
+# Bucket is chosen from alias table, then row uniformly within the bucket. So mixture weight == share of examples from that source.
+def dataset_store_sampler(shard_data, mixture = None, starts = None, important_weight = IMPORTANT_CASES_WEIGHT):
+    offsets = np.cumsum([0] + [data[0] for (shard, data, important) in shard_data]) # row index across all shards
+    bucket_rows = {}
+    for (i, (shard, (hands, X, y, z, m), important)) in enumerate(shard_data):
+        first = starts[i] if starts else 0
+        rows = np.arange(first, hands)
+        important_rows = np.array(important[first:hands], dtype=np.bool_)
+        for case in [False, True]:
+            bucket_rows.setdefault((shard['source'], case), []).append(offsets[i] + rows[important_rows == case])
+    buckets = []
+    weights = []
+    for source in sorted(set([source for (source, case) in bucket_rows.keys()])):
+        source_weight = mixture.get(source, 0.0) if mixture else 1.0
+        rows = [np.concatenate(bucket_rows[(source, case)]) for case in [False, True]]
+        case_weights = [len(rows[0]), important_weight * len(rows[1])]
+        for case in [False, True]:
+            if source_weight > 0.0 and len(rows[case]) > 0:
+                buckets.append(rows[case])
+                weights.append(source_weight * case_weights[case] / sum(case_weights))
+    print('store sampler with %d buckets, weights %s' % (len(buckets), ['%.3f' % (weight / sum(weights)) for weight in weights]))
+    return {'alias_table': build_alias_table(weights), 'buckets': buckets, 'offsets': offsets,
+            'num_rows': sum([len(rows) for rows in buckets])}
+
+# Draw num_examples rows (with replacement) from the sampler. Rows read in blocks, in sorted order, so that memory-mapped reads are local.
+def sample_dataset_store_rows(shard_data, sampler, num_examples, rng = np.random):
+    offsets = sampler['offsets']
+    for block_start in range(0, num_examples, STORE_SAMPLER_BLOCK_SIZE):
+        block_size = min(STORE_SAMPLER_BLOCK_SIZE, num_examples - block_start)
+        bucket_counts = np.bincount(sample_alias_table(sampler['alias_table'], block_size, rng=rng), minlength=len(sampler['buckets']))
+        rows = np.sort(np.concatenate([rows[rng.randint(len(rows), size=count)] for (rows, count) in zip(sampler['buckets'], bucket_counts)]))
+        shard_index = np.searchsorted(offsets, rows, side='right') - 1
+        block = []
+        for i in np.unique(shard_index):
+            (hands, X, y, z, m) = shard_data[i][1]
+            shard_rows = rows[shard_index == i] - offsets[i]
+            (X_rows, y_rows, z_rows, m_rows) = (X[shard_rows], y[shard_rows], z[shard_rows], m[shard_rows])
+            block += [(X_rows[j], y_rows[j], z_rows[j], m_rows[j]) for j in range(len(shard_rows))]
+        for j in rng.permutation(len(block)):
+            yield block[j]
+
+# Stream one epoch of examples from the store, drawn by weight. Epoch size defaults to number of training rows in the mix.
+def dataset_store_sampled_stream(shard_data, sampler, num_examples = None, seed = None):
+    if not num_examples:
+        num_examples = sampler['num_rows']
+    return sample_dataset_store_rows(shard_data, sampler, num_examples, rng=np.random.RandomState(seed))
+
 def load_data():
     """Get data with labels, split into training, validation and test set."""
     data = _load_poker_csv()
@@ -1796,32 +2940,70 @@ def create_iter_functions(dataset, output_layer,
         test=iter_test,
     )
 
+# Training minibatches (X, y, z, m) for one epoch. From dataset['train_stream'] if given (new stream each epoch), else by slicing arrays.
+def train_minibatches(dataset, batch_size=BATCH_SIZE):
+    input_format = dataset.get('input_format', 'deuce_events') # needed to expand event records, if stored sparse
+    permute_suits = SUIT_PERMUTATION_AUGMENT and input_format in SUIT_PERMUTATION_FORMATS
+    if 'train_stream' in dataset:
+        for (X_batch, y_batch, z_batch, m_batch) in dataset['train_stream']():
+            if permute_suits:
+                X_batch = permute_suits_batch(X_batch)
+            yield (X_batch, y_batch, z_batch, m_batch)
+        return
+    num_batches_train = dataset['num_examples_train'] // batch_size
+    for b in range(num_batches_train):
+        batch_slice = slice(b * batch_size, (b + 1) * batch_size)
+        X_batch = unpack_training_inputs(dataset['X_train'][batch_slice], format=input_format) # unpacked to float, if stored packed
+        if permute_suits:
+            X_batch = permute_suits_batch(X_batch)
+        yield (X_batch, dataset['y_train'][batch_slice], dataset['z_train'][batch_slice], dataset['m_train'][batch_slice])
+
+# Per-epoch profile of training, one JSON line per epoch. Time in each phase: waiting on training data ('fetch', includes encoding),
+# training calls ('train'), validation ('valid'), and saving (added by caller). Tells I/O & encoding from compute.
+def training_profile_filename(out_file):
+    return os.path.splitext(out_file)[0] + '_profile.jsonl'
+
+# Peak resident memory of this process, in MB. Linux reports in KB.
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def write_training_profile(out_file, epoch):
+    profile = dict(epoch['profile'])
+    profile.update({'epoch': epoch['number'], 'time': time.time(), 'train_loss': float(epoch['train_loss']), 'valid_loss': float(epoch['valid_loss']),
+                    'examples_per_second': profile['train_examples'] / max(profile['fetch_seconds'] + profile['train_seconds'], 1e-6),
+                    'peak_rss_mb': peak_rss_mb()})
+    with open(training_profile_filename(out_file), 'a') as f:
+        f.write(json.dumps(profile, sort_keys=True) + '\n')
+    print('  profile: fetch %.1fs, train %.1fs, valid %.1fs, save %.1fs. %.1f examples/s. Peak RSS %.0f MB' % (profile['fetch_seconds'], profile['train_seconds'], profile['valid_seconds'],
+                                                                                                       profile.get('save_seconds', 0.0), profile['examples_per_second'], profile['peak_rss_mb']))
+    return profile
+
 # Pass epoch_switch_adapt variable, to switch for adaptive training...
-def train(iter_funcs, dataset, batch_size=BATCH_SIZE, epoch_switch_adapt=10000):
+# Pass first_epoch, to continue numbering from a resumed checkpoint.
+def train(iter_funcs, dataset, batch_size=BATCH_SIZE, epoch_switch_adapt=10000, first_epoch=1):
     """Train the model with `dataset` with mini-batch training. Each
        mini-batch has `batch_size` recordings.
     """
-    num_batches_train = dataset['num_examples_train'] // batch_size
     num_batches_valid = dataset['num_examples_valid'] // batch_size
+    input_format = dataset.get('input_format', 'deuce_events') # needed to expand event records, if stored sparse
 
-    for epoch in itertools.count(1):
+    for epoch in itertools.count(first_epoch):
         batch_train_losses = []
+        profile = {'fetch_seconds': 0.0, 'train_seconds': 0.0, 'valid_seconds': 0.0, 'train_examples': 0}
 
         # Hack: after X number of runs... switch to adaptive training!
         if epoch <= epoch_switch_adapt:
             print('default train for epoch %d' % epoch)
             sys.stdout.flush()
-            for b in range(num_batches_train):
+            batch_start = time.time()
+            for (b, train_batch) in enumerate(train_minibatches(dataset, batch_size=batch_size)):
+                batch_fetched = time.time()
+                profile['fetch_seconds'] += batch_fetched - batch_start
                 #print('computing batch, for batch index %d' % b)
                 if b % 100 == 0:
                     sys.stdout.write('.')
                     sys.stdout.flush()
-                batch_index = b
-                batch_slice = slice(batch_index * batch_size,
-                                    (batch_index + 1) * batch_size)
-                X_batch = dataset['X_train'][batch_slice] # input bits
-                z_batch = dataset['z_train'][batch_slice] # results
-                m_batch = dataset['m_train'][batch_slice] # m == mask. Which results bits are known (actions taken or can be implied)
+                (X_batch, y_batch, z_batch, m_batch) = train_batch # input bits, best choice, results, mask [which results bits are known]
 
                 """
                 print(X_batch)
@@ -1836,6 +3018,9 @@ def train(iter_funcs, dataset, batch_size=BATCH_SIZE, epoch_switch_adapt=10000):
                 # TODO: Actually supply the batch... or better yet, set that as input for the network!
                 batch_train_loss = iter_funcs['train'](X_batch, z_batch, m_batch)
                 batch_train_losses.append(batch_train_loss)
+                batch_start = time.time()
+                profile['train_seconds'] += batch_start - batch_fetched
+                profile['train_examples'] += len(y_batch)
                 """
         else:
             print('adaptive training for epock %d' % epoch)
@@ -1847,6 +3032,7 @@ def train(iter_funcs, dataset, batch_size=BATCH_SIZE, epoch_switch_adapt=10000):
 
         avg_train_loss = np.mean(batch_train_losses)
 
+        valid_start = time.time()
         batch_valid_losses = []
         batch_valid_accuracies = []
         for b in range(num_batches_valid):
@@ -1854,7 +3040,7 @@ def train(iter_funcs, dataset, batch_size=BATCH_SIZE, epoch_switch_adapt=10000):
             batch_index = b
             batch_slice = slice(batch_index * batch_size,
                                 (batch_index + 1) * batch_size)
-            X_batch = dataset['X_valid'][batch_slice]
+            X_batch = unpack_training_inputs(dataset['X_valid'][batch_slice], format=input_format)
             y_batch = dataset['y_valid'][batch_slice] # "best choice" made by the algorithm
             z_batch = dataset['z_valid'][batch_slice] # results
             m_batch = dataset['m_valid'][batch_slice] # m == mask. Which results bits are known (actions taken or can be implied)
@@ -1864,12 +3050,14 @@ def train(iter_funcs, dataset, batch_size=BATCH_SIZE, epoch_switch_adapt=10000):
 
         avg_valid_loss = np.mean(batch_valid_losses)
         avg_valid_accuracy = np.mean(batch_valid_accuracies)
+        profile['valid_seconds'] = time.time() - valid_start
 
         yield {
             'number': epoch,
             'train_loss': avg_train_loss,
             'valid_loss': avg_valid_loss,
             'valid_accuracy': avg_valid_accuracy,
+            'profile': profile,
         }
 
 
@@ -0,0 +1,290 @@
+from __future__ import print_function
+
+import sys
+import time
+import threading
+import traceback
+import collections
+import Queue
+import numpy as np
+
+"""
+Micro-batching for model predictions, shared by many game loops (threads) in one process.
+Each game submits one encoded input at a time, and gets back a future. The broker thread collects
+requests until it has a full batch, or the oldest request waited long enough, then runs one predict() on the stack.
+One thread calls the model, so compiled Theano functions are never called concurrently.
+
+Brokers belong to the caller that runs games in threads (InferenceBrokerContext). Only threads run inside the context
+go through brokers. Anything else predicts directly, without waiting for a batch that will never fill.
+Self-play with brokers: play_triple_draw.py --tables N --threaded
+
+Or, run games in lockstep (LockstepBatcher): every game runs until it needs a prediction, then all
+predictions for the same model go as one batch. No deadline to wait for, and the same batches every time.
+"""
+
+INFERENCE_BROKER_BATCH_SIZE = 64 # flush batch at this many inputs...
+INFERENCE_BROKER_MAX_DELAY = 0.002 # ...or after first input in batch waited this long (seconds). Bounds per-decision latency.
+
+# Result of one submitted input. Python 2 has no concurrent.futures, so just an event and a value.
+class PredictionFuture(object):
+    def __init__(self):
+        self.done_event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set_result(self, value):
+        self.value = value
+        self.done_event.set()
+
+    def set_exception(self, error):
+        self.error = error
+        self.done_event.set()
+
+    def done(self):
+        return self.done_event.is_set()
+
+    # Wait for the batch to finish. Raises, if predict() raised.
+    def result(self, timeout = None):
+        if not self.done_event.wait(timeout):
+            raise RuntimeError('prediction not ready after %s seconds' % timeout)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+# Wraps any predictor with predict(batch) --> outputs (ModelPredictor, NumpyModel). Same predict() interface itself.
+class InferenceBroker(object):
+    def __init__(self, predictor, max_batch_size = INFERENCE_BROKER_BATCH_SIZE, max_delay = INFERENCE_BROKER_MAX_DELAY):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.requests = Queue.Queue()
+        self.stats = {'batches': 0, 'inputs': 0, 'predict_seconds': 0.0}
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True # don't keep process alive for the broker
+        self.thread.start()
+
+    # Single encoded input --> future for its output vector
+    def submit(self, single_input):
+        future = PredictionFuture()
+        self.requests.put((single_input, future))
+        return future
+
+    # Batch --> outputs, like the predictor. Rows are submitted separately, so may share a batch with other games.
+    def predict(self, batch):
+        futures = [self.submit(single_input) for single_input in batch]
+        return np.array([future.result() for future in futures])
+
+    # Stop broker thread, after requests already submitted.
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    # Take requests for next batch. Block for first one, then until batch full or deadline passed.
+    def next_batch(self):
+        request = self.requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+            except Queue.Empty:
+                break
+            if request is None:
+                self.requests.put(None) # finish this batch, then stop
+                break
+            batch.append(request)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            futures = [future for (single_input, future) in batch]
+            now = time.time()
+            try:
+                outputs = self.predictor.predict(np.array([single_input for (single_input, future) in batch]))
+            except Exception as error:
+                print('inference broker: predict failed for batch of %d: %s' % (len(batch), error))
+                sys.stdout.flush()
+                for future in futures:
+                    future.set_exception(error)
+                continue
+            self.stats['predict_seconds'] += time.time() - now
+            self.stats['batches'] += 1
+            self.stats['inputs'] += len(batch)
+            for (future, output) in zip(futures, outputs):
+                future.set_result(output)
+
+    def print_stats(self):
+        print('inference broker: %d inputs in %d batches (%.1f per batch), %.2fs predicting' % (self.stats['inputs'], self.stats['batches'],
+                                                                                             self.stats['inputs'] / float(max(self.stats['batches'], 1)), self.stats['predict_seconds']))
+
+# Broker context for this thread (if any). Set by InferenceBrokerContext.run_threads()
+BROKER_THREAD = threading.local()
+def current_broker_context():
+    return getattr(BROKER_THREAD, 'context', None)
+
+# Run games in threads, all sharing models. Context owns one broker per model (predictor), started on first use,
+# and closed once all the threads return.
+class InferenceBrokerContext(object):
+    def __init__(self, max_batch_size = INFERENCE_BROKER_BATCH_SIZE, max_delay = INFERENCE_BROKER_MAX_DELAY):
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.brokers = collections.OrderedDict() # id(predictor) --> (predictor, broker). Keeps predictor, so that id() is not reused.
+        self.lock = threading.Lock()
+        self.errors = [] # (thread, exc_info) for threads that raised
+
+    # From inside a thread: batch --> predictor outputs. Rows may share a batch with other threads.
+    def predict(self, predictor, batch):
+        with self.lock:
+            if id(predictor) not in self.brokers:
+                self.brokers[id(predictor)] = (predictor, InferenceBroker(predictor, max_batch_size=self.max_batch_size, max_delay=self.max_delay))
+            broker = self.brokers[id(predictor)][1]
+        return broker.predict(batch)
+
+    # Run functions (no arguments) in threads, until all of them return. Then stop the brokers.
+    # If any thread raised, re-raise the first error here (after all threads are done), so no failed game goes unnoticed.
+    def run_threads(self, functions):
+        threads = [threading.Thread(target=self.run_thread, args=(i, function)) for (i, function) in enumerate(functions)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.close()
+        if self.errors:
+            (index, (error_type, error, error_traceback)) = self.errors[0]
+            print('%d of %d broker threads failed. Raising error from thread %d' % (len(self.errors), len(threads), index))
+            raise error_type, error, error_traceback
+
+    def run_thread(self, index, function):
+        BROKER_THREAD.context = self
+        try:
+            function()
+        except Exception:
+            print('broker thread %d failed:' % index)
+            traceback.print_exc()
+            with self.lock:
+                self.errors.append((index, sys.exc_info()))
+        finally:
+            BROKER_THREAD.context = None
+
+    def close(self):
+        with self.lock:
+            brokers = self.brokers.values()
+        for (predictor, broker) in brokers:
+            broker.close()
+
+    def print_stats(self):
+        if not self.brokers:
+            print('inference brokers: no model calls')
+        for (predictor, broker) in self.brokers.values():
+            broker.print_stats()
+
+# Game running inside LockstepBatcher, for this thread (if any)
+LOCKSTEP_TABLE = threading.local()
+def current_lockstep_batcher():
+    return getattr(LOCKSTEP_TABLE, 'batcher', None)
+
+# Run K games ("tables") in lockstep, batching all their predictions. Each table is a thread, but only one runs at a time,
+# handing over turns like a coroutine. So game code needs no locks, and can share CSV writer, random state, etc.
+# Table runs until it asks for a prediction (predict() blocks), or finishes. Once no table can run, predict all
+# pending inputs, one batch per model, and let those tables continue. In order of requests, so same result for same seed.
+class LockstepBatcher(object):
+    def __init__(self):
+        self.pending = [] # (table, predictor, batch, result)
+        self.runnable = collections.deque()
+        self.table_turns = []
+        self.main_turn = threading.Event()
+        self.num_tables_alive = 0
+        self.errors = [] # (table, exc_info) for tables that raised
+        self.stats = {'batches': 0, 'inputs': 0, 'requests': 0, 'predict_seconds': 0.0}
+
+    # Run table_functions (no arguments) until all of them return. If any table raised, re-raise the first error here.
+    def run_tables(self, table_functions):
+        self.table_turns = [threading.Event() for function in table_functions]
+        threads = [threading.Thread(target=self.run_table, args=(table, function)) for (table, function) in enumerate(table_functions)]
+        for thread in threads:
+            thread.daemon = True
+        self.num_tables_alive = len(threads)
+        self.runnable.extend(range(len(threads)))
+        for thread in threads:
+            thread.start()
+        while self.num_tables_alive > 0:
+            if self.runnable:
+                self.take_turn(self.runnable.popleft())
+            elif self.pending:
+                self.flush()
+            else:
+                break
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            (table, (error_type, error, error_traceback)) = self.errors[0]
+            print('%d of %d lockstep tables failed. Raising error from table %d' % (len(self.errors), len(threads), table))
+            raise error_type, error, error_traceback
+
+    # Let table run, until it asks for prediction or finishes
+    def take_turn(self, table):
+        self.main_turn.clear()
+        self.table_turns[table].set()
+        self.main_turn.wait()
+
+    def run_table(self, table, function):
+        LOCKSTEP_TABLE.batcher = self
+        LOCKSTEP_TABLE.table = table
+        self.table_turns[table].wait()
+        try:
+            function()
+        except Exception:
+            print('lockstep table %d failed:' % table)
+            traceback.print_exc()
+            self.errors.append((table, sys.exc_info())) # only one table runs at a time
+        self.num_tables_alive -= 1
+        self.main_turn.set()
+
+    # From inside table: batch --> predictor outputs. Waits for the whole round of tables.
+    def predict(self, predictor, batch):
+        table = LOCKSTEP_TABLE.table
+        result = {}
+        self.pending.append((table, predictor, np.asarray(batch), result))
+        self.table_turns[table].clear()
+        self.main_turn.set()
+        self.table_turns[table].wait()
+        if 'error' in result:
+            raise result['error']
+        return result['output']
+
+    # Predict all pending requests, one batch per predictor
+    def flush(self):
+        pending = self.pending
+        self.pending = []
+        predictors = collections.OrderedDict()
+        for request in pending:
+            predictors.setdefault(id(request[1]), []).append(request)
+        for requests in predictors.values():
+            now = time.time()
+            predictor = requests[0][1]
+            try:
+                outputs = predictor.predict(np.concatenate([batch for (table, predictor, batch, result) in requests]))
+            except Exception as error:
+                for (table, predictor, batch, result) in requests:
+                    result['error'] = error
+                continue
+            self.stats['predict_seconds'] += time.time() - now
+            self.stats['batches'] += 1
+            self.stats['requests'] += len(requests)
+            start = 0
+            for (table, predictor, batch, result) in requests:
+                result['output'] = outputs[start:start + len(batch)]
+                start += len(batch)
+            self.stats['inputs'] += start
+        self.runnable.extend([request[0] for request in pending])
+
+    def print_stats(self):
+        print('lockstep batcher: %d requests (%d inputs) in %d batches (%.1f per batch), %.2fs predicting' % (self.stats['requests'], self.stats['inputs'], self.stats['batches'],
+                                                                                                          self.stats['inputs'] / float(max(self.stats['batches'], 1)), self.stats['predict_seconds']))
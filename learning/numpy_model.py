@@ -0,0 +1,369 @@
+from __future__ import print_function
+
+import os
+import json
+import pickle
+import shutil
+import time
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+"""
+Forward pass for trained models, in NumPy only. No Theano or Lasagne, nothing to compile.
+Rebuilds the networks from triple_draw_poker_full_output (build_model, build_nopool_model,
+build_fat_model, build_fully_connected_model) from the pickled param values. Same output, within float error.
+
+Convolutions as im2col (strided view of all windows, then one matrix multiply per layer), in [batch x height x width x filters] layout.
+
+Weights can be stored as float16, or int8 with a scale per unit (filter). See quantize_numpy_model.py
+Quantized weights are 2x (float16) or 4x (int8) smaller on disk and in memory. NumPy has no float16 or int8 matrix multiply,
+so each predict() still casts weights to float32, a block of rows at a time (WEIGHT_DOT_BLOCK_BYTES). Not faster than float32.
+
+Or convert to a model store (see convert_model_store.py): directory of uncompressed .npy arrays and manifest.json, memory-mapped on load.
+Store path is a symlink to the current version directory, so a store can be replaced while workers load it.
+"""
+
+# Layers for each network, in order. Param values come in (W, b) pairs for conv & dense. Pooling is 2x2, ignore_border=False.
+# Dropout is skipped (deterministic run).
+NUMPY_MODEL_LAYERS = {'model': ['conv', 'conv', 'pool', 'conv', 'conv', 'pool', 'dense', 'dense'],
+                      'nopool': ['conv', 'conv', 'conv', 'conv', 'conv', 'conv', 'dense', 'dense'],
+                      'fat': ['conv', 'conv', 'pool', 'conv', 'conv', 'dense', 'dense'],
+                      'fully_connected': ['dense', 'dense', 'dense']}
+
+# Which networks use leaky ReLU, if model built with use_leaky_units. Others always rectify.
+NUMPY_MODEL_LEAKY_ARCHITECTURES = set(['model', 'nopool'])
+NUMPY_MODEL_LEAKINESS = 0.01 # lasagne.nonlinearities.leaky_rectify default
+NUMPY_MODEL_WEIGHT_TYPES = ['float32', 'float16', 'int8']
+WEIGHT_DOT_BLOCK_BYTES = 2 ** 20 # cast quantized weights this much at a time (fits in cache), not a full float32 copy per predict()
+MODEL_STORE_MANIFEST = 'manifest.json'
+MODEL_STORE_VERSION = 1
+
+# Guess which network built the params. Same hack as when loading models for play: 6 params --> dense, 16 params --> nopool.
+# 'fat' and default model both have 12 params. 'fat' starts with 5x5 filters.
+def numpy_model_architecture(all_param_values):
+    if len(all_param_values) == 6:
+        return 'fully_connected'
+    elif len(all_param_values) == 16:
+        return 'nopool'
+    elif len(all_param_values) == 12 and all_param_values[0].shape[2:] == (5,5):
+        return 'fat'
+    elif len(all_param_values) == 12:
+        return 'model'
+    raise ValueError('no network known with %d param values' % len(all_param_values))
+
+# Quantize weight columns [inputs x units]. int8 is symmetric, with one scale per unit. float16 just cast, no scales.
+def quantize_weight_columns(W_columns, weight_type):
+    if weight_type == 'float16':
+        return (W_columns.astype(np.float16), None)
+    elif weight_type == 'int8':
+        scales = np.abs(W_columns).max(axis=0) / 127.0
+        scales[scales == 0.0] = 1.0
+        W_int8 = np.round(W_columns / scales).clip(-127, 127).astype(np.int8)
+        return (W_int8, scales.astype(W_columns.dtype))
+    assert weight_type == 'float32', 'unknown weight type %s' % weight_type
+    return (W_columns, None)
+
+# x.dot(W) for stored weights. NumPy has no int8 or float16 matrix multiply, so cast weights to x's type for the multiply
+# (stored weights stay small), then scale each unit's output. Cast and multiply a block of input rows at a time, and sum.
+# Row blocks are contiguous in W, so cast is one pass over memory, and the float32 copy stays small [block_bytes].
+def weight_dot(x, W_columns, scales = None, block_bytes = WEIGHT_DOT_BLOCK_BYTES):
+    if W_columns.dtype == x.dtype:
+        out = x.dot(W_columns)
+    else:
+        (num_inputs, num_units) = W_columns.shape
+        block_rows = max(block_bytes // (num_units * x.dtype.itemsize), 1)
+        out = x[:, :block_rows].dot(W_columns[:block_rows].astype(x.dtype))
+        for start in range(block_rows, num_inputs, block_rows):
+            out += x[:, start:start + block_rows].dot(W_columns[start:start + block_rows].astype(x.dtype))
+    if scales is not None:
+        out *= scales
+    return out
+
+# Valid convolution (no padding), in NHWC layout. Weights already flipped and flattened to [height x width x channels, filters].
+def conv2d_valid(x, W_columns, b, filter_size, scales = None):
+    (batch, height, width, channels) = x.shape
+    (filter_height, filter_width) = filter_size
+    out_height = height - filter_height + 1
+    out_width = width - filter_width + 1
+    strides = x.strides
+    windows = as_strided(x, shape=(batch, out_height, out_width, filter_height, filter_width, channels),
+                         strides=(strides[0], strides[1], strides[2], strides[1], strides[2], strides[3]))
+    columns = windows.reshape(batch * out_height * out_width, filter_height * filter_width * channels)
+    out = weight_dot(columns, W_columns, scales)
+    out += b
+    return out.reshape(batch, out_height, out_width, W_columns.shape[1])
+
+# 2x2 max pool, in NHWC layout. Like ignore_border=False, so odd rows and columns pooled by themselves.
+def max_pool_2x2(x):
+    (batch, height, width, channels) = x.shape
+    out_height = (height + 1) // 2
+    out_width = (width + 1) // 2
+    if height % 2 or width % 2:
+        padded = np.full((batch, out_height * 2, out_width * 2, channels), -np.inf, dtype=x.dtype)
+        padded[:, :height, :width, :] = x
+        x = padded
+    return x.reshape(batch, out_height, 2, out_width, 2, channels).max(axis=(2, 4))
+
+def rectify(x, leakiness = 0.0):
+    if leakiness:
+        return np.maximum(x, leakiness * x)
+    return np.maximum(x, 0.0)
+
+# Trained model, run in NumPy. Same interface as ModelPredictor: predict(batch) --> output vectors, for any batch size.
+# Layers are (layer_type, W, b, filter_size, scales). With weight_type 'float16' or 'int8', W is stored quantized (see quantize_weight_columns)
+class NumpyModel(object):
+    def __init__(self, all_param_values, architecture = None, leaky_units = True, dtype = np.float32, weight_type = 'float32'):
+        self.architecture = architecture or numpy_model_architecture(all_param_values)
+        self.leakiness = NUMPY_MODEL_LEAKINESS if (leaky_units and self.architecture in NUMPY_MODEL_LEAKY_ARCHITECTURES) else 0.0
+        self.dtype = dtype
+        self.weight_type = weight_type
+        self.num_input_planes = all_param_values[0].shape[1] if all_param_values[0].ndim == 4 else None
+        self.num_inputs = all_param_values[0].shape[0] if all_param_values[0].ndim == 2 else None
+        self.output_length = all_param_values[-1].shape[0]
+
+        # Prepare each layer's weights, once. Lasagne convolves (flips filters). We take dot product with windows, so flip here.
+        self.layers = []
+        params = list(all_param_values)
+        for layer_type in NUMPY_MODEL_LAYERS[self.architecture]:
+            if layer_type == 'pool':
+                self.layers.append((layer_type, None, None, None, None))
+                continue
+            W = np.asarray(params.pop(0), dtype=dtype)
+            b = np.asarray(params.pop(0), dtype=dtype)
+            if layer_type == 'conv':
+                (num_filters, channels, filter_height, filter_width) = W.shape
+                W_columns = np.ascontiguousarray(W[:, :, ::-1, ::-1].transpose(2, 3, 1, 0).reshape(filter_height * filter_width * channels, num_filters))
+                filter_size = (filter_height, filter_width)
+            else:
+                W_columns = np.ascontiguousarray(W)
+                filter_size = None
+            (W_columns, scales) = quantize_weight_columns(W_columns, weight_type)
+            self.layers.append((layer_type, W_columns, b, filter_size, scales))
+        assert not params, 'unused %d param values for network %s' % (len(params), self.architecture)
+
+    # Batch of inputs [batch x planes x 17 x 17] --> matrix of output vectors
+    # NOTE: If input has more planes than the model (older model), extra planes are ignored. Same as zero-fill in expand_parameters_input_to_match()
+    def predict(self, batch):
+        x = np.asarray(batch, dtype=self.dtype)
+        if self.num_input_planes:
+            assert x.shape[1] >= self.num_input_planes, 'input %d planes, model needs %d' % (x.shape[1], self.num_input_planes)
+            x = np.ascontiguousarray(x[:, :self.num_input_planes].transpose(0, 2, 3, 1)) # NHWC
+        else:
+            x = x.reshape(len(x), -1)[:, :self.num_inputs]
+        for (layer_type, W, b, filter_size, scales) in self.layers:
+            if layer_type == 'conv':
+                x = rectify(conv2d_valid(x, W, b, filter_size, scales), self.leakiness)
+            elif layer_type == 'pool':
+                x = max_pool_2x2(x)
+            else:
+                # Dense layer flattens input in [planes x height x width] order, same as Lasagne
+                if x.ndim == 4:
+                    x = x.transpose(0, 3, 1, 2).reshape(len(x), -1)
+                x = rectify(weight_dot(x, W, scales) + b, self.leakiness)
+        return x
+
+    # Memory for all weights, biases & scales
+    def weight_bytes(self):
+        return sum([sum([array.nbytes for array in (W, b, scales) if array is not None]) for (layer_type, W, b, filter_size, scales) in self.layers])
+
+# Load pickled param values (from save_model) into NumPy model. Or NumPy model saved with save_numpy_model() [quantized weights]
+def load_numpy_model(filename, architecture = None, leaky_units = True):
+    now = time.time()
+    with open(filename, 'rb') as f:
+        all_param_values = pickle.load(f)
+    if isinstance(all_param_values, NumpyModel):
+        model = all_param_values
+        print('loaded NumPy model %s (%s, %s weights, %d bytes) in %.2fs' % (filename, model.architecture, model.weight_type, model.weight_bytes(), time.time() - now))
+        return model
+    model = NumpyModel(all_param_values, architecture=architecture, leaky_units=leaky_units)
+    print('loaded NumPy model %s (%s, %d param values) in %.2fs' % (filename, model.architecture, len(all_param_values), time.time() - now))
+    return model
+
+# Pickle NumPy model, with weights as stored (float16, int8 and scales). Load with load_numpy_model().
+def save_numpy_model(filename, model):
+    with open(filename, 'wb') as f:
+        pickle.dump(model, f, -1)
+    print('saved NumPy model (%s weights, %d bytes) to %s' % (model.weight_type, model.weight_bytes(), filename))
+
+# Several trained models on the same input, in one pass. predict(batch) --> [batch x num_models x outputs]
+# If all models have the same network and shapes, stack weights along a models axis: input (and its im2col windows)
+# encoded once, first layer is one matrix multiply for all models, and later layers are batched matrix multiplies.
+# Otherwise (or quantized weights), just run each model on the same input.
+class NumpyEnsemble(object):
+    def __init__(self, models):
+        self.models = models
+        self.output_length = max([model.output_length for model in models])
+        self.stacked = len(set([model.architecture for model in models])) == 1 and len(set([model.leakiness for model in models])) == 1 and \
+            all([model.weight_type == 'float32' for model in models]) and \
+            all([[(layer[1].shape if layer[1] is not None else None) for layer in model.layers] ==
+                 [(layer[1].shape if layer[1] is not None else None) for layer in models[0].layers] for model in models])
+        if not self.stacked:
+            print('NumPy ensemble of %d models, with different networks (or quantized). Evaluate one by one.' % len(models))
+            return
+
+        # [models x ...] weights for every layer. First layer, concatenate filters (units) of all models, for one multiply.
+        first_model = models[0]
+        self.leakiness = first_model.leakiness
+        self.num_input_planes = first_model.num_input_planes
+        self.num_inputs = first_model.num_inputs
+        self.layers = []
+        for (i, (layer_type, W, b, filter_size, scales)) in enumerate(first_model.layers):
+            if layer_type == 'pool':
+                self.layers.append((layer_type, None, None, None))
+            elif i == 0:
+                self.layers.append((layer_type, np.ascontiguousarray(np.concatenate([model.layers[i][1] for model in models], axis=1)),
+                                    np.concatenate([model.layers[i][2] for model in models]), filter_size))
+            else:
+                self.layers.append((layer_type, np.array([model.layers[i][1] for model in models]),
+                                    np.array([model.layers[i][2] for model in models])[:, np.newaxis, :], filter_size))
+
+    def predict(self, batch):
+        if not self.stacked:
+            outputs = [model.predict(batch) for model in self.models]
+            padded_outputs = np.zeros((len(outputs[0]), len(outputs), self.output_length), dtype=outputs[0].dtype)
+            for (i, output) in enumerate(outputs):
+                padded_outputs[:, i, :output.shape[1]] = output
+            return padded_outputs
+
+        num_models = len(self.models)
+        x = np.asarray(batch, dtype=self.models[0].dtype)
+        batch_size = len(x)
+        if self.num_input_planes:
+            x = np.ascontiguousarray(x[:, :self.num_input_planes].transpose(0, 2, 3, 1))
+        else:
+            x = x.reshape(batch_size, -1)[:, :self.num_inputs]
+
+        # First layer, shared input. Split output by model --> [models x batch x ...]
+        (layer_type, W, b, filter_size) = self.layers[0]
+        if layer_type == 'conv':
+            x = rectify(conv2d_valid(x, W, b, filter_size), self.leakiness)
+            (_, height, width, channels) = x.shape
+            x = np.ascontiguousarray(x.reshape(batch_size, height, width, num_models, channels // num_models).transpose(3, 0, 1, 2, 4))
+        else:
+            x = rectify(x.dot(W) + b, self.leakiness)
+            x = np.ascontiguousarray(x.reshape(batch_size, num_models, -1).transpose(1, 0, 2))
+
+        for (layer_type, W, b, filter_size) in self.layers[1:]:
+            if layer_type == 'conv':
+                (_, _, height, width, channels) = x.shape
+                (filter_height, filter_width) = filter_size
+                out_height = height - filter_height + 1
+                out_width = width - filter_width + 1
+                strides = x.strides
+                windows = as_strided(x, shape=(num_models, batch_size, out_height, out_width, filter_height, filter_width, channels),
+                                     strides=(strides[0], strides[1], strides[2], strides[3], strides[2], strides[3], strides[4]))
+                columns = windows.reshape(num_models, batch_size * out_height * out_width, filter_height * filter_width * channels)
+                x = rectify(np.matmul(columns, W) + b, self.leakiness).reshape(num_models, batch_size, out_height, out_width, W.shape[2])
+            elif layer_type == 'pool':
+                (_, _, height, width, channels) = x.shape
+                x = max_pool_2x2(x.reshape(num_models * batch_size, height, width, channels))
+                x = x.reshape((num_models, batch_size) + x.shape[1:])
+            else:
+                if x.ndim == 5:
+                    x = x.transpose(0, 1, 4, 2, 3).reshape(num_models, batch_size, -1)
+                x = rectify(np.matmul(x, W) + b, self.leakiness)
+        return x.transpose(1, 0, 2)
+
+# Model store: directory with manifest.json (network, array shapes, where it came from) and one uncompressed .npy per array.
+# Holds param values (already expanded, for lasagne.layers.set_all_param_values) and the NumPy model's prepared layers
+# (flipped filters, maybe quantized). Loading memory-maps arrays read-only, so processes on one host share one copy in the page cache.
+# NOTE: Not .npz, since np.load() can not memory-map arrays inside a zip.
+# Path is a symlink to a version directory (path.v<time>_<pid>), next to it. Replacing a store writes a new version, then swaps the link.
+def write_model_store(path, all_param_values, model, metadata = {}):
+    path = os.path.normpath(path)
+    arrays = {}
+    for (i, values) in enumerate(all_param_values):
+        arrays['param_%d' % i] = np.asarray(values)
+    layers = []
+    for (i, (layer_type, W, b, filter_size, scales)) in enumerate(model.layers):
+        layer = {'type': layer_type, 'filter_size': filter_size, 'arrays': {}}
+        for (name, array) in [('W', W), ('b', b), ('scales', scales)]:
+            if array is not None:
+                layer['arrays'][name] = 'layer_%d_%s' % (i, name)
+                arrays[layer['arrays'][name]] = array
+        layers.append(layer)
+    manifest = dict(metadata)
+    manifest.update({'version': MODEL_STORE_VERSION, 'architecture': model.architecture, 'leakiness': model.leakiness,
+                     'weight_type': model.weight_type, 'dtype': np.dtype(model.dtype).name, 'num_input_planes': model.num_input_planes,
+                     'num_inputs': model.num_inputs, 'output_length': model.output_length, 'num_param_values': len(all_param_values), 'layers': layers,
+                     'arrays': dict([(name, {'dtype': str(array.dtype), 'shape': list(array.shape)}) for (name, array) in arrays.items()])})
+
+    # Write new version directory. Then point path at it: new symlink, renamed over path (atomic). Loaders see the old store or the new one,
+    # never a partial or missing one. Crash before the rename leaves the old store in place (and an unused version directory).
+    version_path = '%s.v%d_%d' % (path, int(time.time() * 1000), os.getpid())
+    os.makedirs(version_path)
+    for (name, array) in arrays.items():
+        np.save(os.path.join(version_path, '%s.npy' % name), np.ascontiguousarray(array))
+    with open(os.path.join(version_path, MODEL_STORE_MANIFEST), 'w') as f:
+        json.dump(manifest, f, sort_keys=True, indent=2)
+    link_path = '%s.link%d' % (path, os.getpid())
+    if os.path.lexists(link_path):
+        os.remove(link_path)
+    os.symlink(os.path.basename(version_path), link_path) # relative, so store and its versions can move together
+    old_version_path = None
+    if os.path.islink(path):
+        old_version_path = os.path.join(os.path.dirname(path), os.readlink(path))
+    elif os.path.isdir(path):
+        # Store written as plain directory (before versions). Can not rename link over a directory, so move it aside first.
+        old_version_path = '%s.old%d' % (path, os.getpid())
+        os.rename(path, old_version_path)
+    os.rename(link_path, path)
+    # Workers that loaded the old version keep their memory-mapped arrays. Loaders in the middle of it retry (see load_model_store_version)
+    if old_version_path:
+        shutil.rmtree(old_version_path, ignore_errors=True)
+    print('wrote model store %s --> %s (%s, %s weights, %d arrays)' % (path, os.path.basename(version_path), model.architecture, model.weight_type, len(arrays)))
+
+def is_model_store(path):
+    return os.path.isfile(os.path.join(path, MODEL_STORE_MANIFEST))
+
+def load_model_store_manifest(path):
+    with open(os.path.join(path, MODEL_STORE_MANIFEST), 'r') as f:
+        manifest = json.load(f)
+    assert manifest['version'] == MODEL_STORE_VERSION, 'model store %s version %s, expected %s' % (path, manifest['version'], MODEL_STORE_VERSION)
+    return manifest
+
+def load_model_store_array(path, name):
+    return np.load(os.path.join(path, '%s.npy' % name), mmap_mode='r')
+
+# load_function(version_path) for the store's current version. Resolve the link once, so manifest and arrays come from the same version.
+# If the store was replaced (and that version removed) while loading, load the new version.
+def load_model_store_version(path, load_function):
+    version_path = os.path.realpath(path)
+    try:
+        return load_function(version_path)
+    except (IOError, OSError):
+        if os.path.realpath(path) == version_path:
+            raise
+        print('model store %s replaced while loading, load again' % path)
+        return load_function(os.path.realpath(path))
+
+# Param values, as saved by save_model() but expanded to match input & output. Memory-mapped.
+def load_model_store_params(path):
+    return load_model_store_version(path, load_model_store_version_params)
+
+def load_model_store_version_params(path):
+    manifest = load_model_store_manifest(path)
+    return [load_model_store_array(path, 'param_%d' % i) for i in range(manifest['num_param_values'])]
+
+# NumPy model, with layers memory-mapped from the store. Nothing to prepare or copy.
+def load_model_store(path):
+    return load_model_store_version(path, load_model_store_version_model)
+
+def load_model_store_version_model(path):
+    now = time.time()
+    manifest = load_model_store_manifest(path)
+    model = NumpyModel.__new__(NumpyModel)
+    model.architecture = str(manifest['architecture'])
+    model.leakiness = manifest['leakiness']
+    model.dtype = np.dtype(manifest['dtype']).type
+    model.weight_type = str(manifest['weight_type'])
+    model.num_input_planes = manifest['num_input_planes']
+    model.num_inputs = manifest['num_inputs']
+    model.output_length = manifest['output_length']
+    model.layers = []
+    for layer in manifest['layers']:
+        arrays = dict([(name, load_model_store_array(path, array_name)) for (name, array_name) in layer['arrays'].items()])
+        filter_size = tuple(layer['filter_size']) if layer['filter_size'] else None
+        model.layers.append((str(layer['type']), arrays.get('W'), arrays.get('b'), filter_size, arrays.get('scales')))
+    print('loaded model store %s (%s, %s weights) in %.3fs' % (path, model.architecture, model.weight_type, time.time() - now))
+    return model
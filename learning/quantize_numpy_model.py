@@ -0,0 +1,96 @@
+import sys
+import json
+
+from triple_draw_poker_full_output import *
+from numpy_model import save_numpy_model
+from numpy_model import NUMPY_MODEL_WEIGHT_TYPES
+
+"""
+Export trained model (pickled param values) as NumPy model with quantized weights: float16, or int8 with a scale per filter/unit.
+Optionally, validate against full precision model on held-out events: value vectors, and action choices.
+
+Quantization saves space, not time. Weights are 2x (float16) or 4x (int8) smaller on disk and in memory (many workers per host),
+but predict() casts them back to float32 for every multiply (in small blocks, see weight_dot). So latency is the same or higher
+than float32: int8 about the same for batches, float16 slower (NumPy float16 cast is slow).
+
+python quantize_numpy_model.py nlh_events_..._700k.pickle nlh_events_..._700k_int8.pickle int8 [events.csv] [max_events]
+
+Play with quantized model: play_triple_draw.py --numpy_model -CNN_model nlh_events_..._700k_int8.pickle
+Report (if validated) saved next to output, as _report.json
+"""
+
+QUANTIZE_VALIDATION_SIZE = 20000 # held-out events to compare
+QUANTIZE_VALIDATION_CHUNK_SIZE = 1000
+
+# Encoded inputs for events in CSV. Same encoding as training (see load_data)
+def load_validation_inputs(filename, max_input = QUANTIZE_VALIDATION_SIZE):
+    (num_hands, X_all, y_all, z_all, m_all) = _load_poker_csv(filename=filename, max_input = max_input, keep_all_data=(TRAINING_FORMAT != 'video'), format=TRAINING_FORMAT,
+                                                              include_num_draws = INCLUDE_NUM_DRAWS, include_full_hand = INCLUDE_FULL_HAND, include_hand_context = INCLUDE_HAND_CONTEXT,
+                                                              pack_inputs = PACKED_TRAINING_INPUTS, sparse_inputs = SPARSE_EVENT_INPUTS, seed = LOADER_RANDOM_SEED)
+    return X_all[:num_hands]
+
+# Compare quantized model to full precision on the same inputs. Value vectors (all outputs, and bet values), and choices:
+# best action by value [bet, raise, check, call, fold], and most likely action by action% output.
+def validate_quantized_model(full_model, quantized_model, stored_inputs, chunk_size = QUANTIZE_VALIDATION_CHUNK_SIZE):
+    value_categories = sorted(ALL_ACTION_CATEGORY_SET)
+    action_categories = sorted(ALL_BET_ACTION_CATEGOY_SET)
+    errors = []
+    value_choices_same = 0
+    action_choices_same = 0
+    full_seconds = 0.0
+    quantized_seconds = 0.0
+    for start in range(0, len(stored_inputs), chunk_size):
+        inputs = unpack_training_inputs(stored_inputs[start:start + chunk_size], format=TRAINING_FORMAT)
+        now = time.time()
+        full_output = full_model.predict(inputs)
+        full_seconds += time.time() - now
+        now = time.time()
+        quantized_output = quantized_model.predict(inputs)
+        quantized_seconds += time.time() - now
+        errors.append(np.abs(quantized_output - full_output))
+        value_choices_same += np.sum(np.argmax(full_output[:, value_categories], axis=1) == np.argmax(quantized_output[:, value_categories], axis=1))
+        action_choices_same += np.sum(np.argmax(full_output[:, action_categories], axis=1) == np.argmax(quantized_output[:, action_categories], axis=1))
+    errors = np.concatenate(errors)
+    num_events = len(errors)
+    return {'events': num_events,
+            'weight_type': quantized_model.weight_type,
+            'full_weight_bytes': full_model.weight_bytes(),
+            'quantized_weight_bytes': quantized_model.weight_bytes(),
+            'max_abs_error': float(errors.max()),
+            'mean_abs_error': float(errors.mean()),
+            'values_max_abs_error': float(errors[:, value_categories].max()),
+            'values_mean_abs_error': float(errors[:, value_categories].mean()),
+            'value_choice_agreement': float(value_choices_same) / num_events,
+            'action_choice_agreement': float(action_choices_same) / num_events,
+            'full_seconds': full_seconds,
+            'quantized_seconds': quantized_seconds}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or sys.argv[3] not in NUMPY_MODEL_WEIGHT_TYPES:
+        print('usage: python quantize_numpy_model.py model.pickle out_model.pickle [%s] [events.csv] [max_events]' % '|'.join(NUMPY_MODEL_WEIGHT_TYPES))
+        print('(smaller weights on disk and in memory. Not faster than float32, see numpy_model.weight_dot)')
+        sys.exit(0)
+
+    model_filename = sys.argv[1]
+    out_filename = sys.argv[2]
+    weight_type = sys.argv[3]
+    with open(model_filename, 'rb') as f:
+        all_param_values = pickle.load(f)
+    expand_parameters_input_to_match(all_param_values, zero_fill = True) # same as loading for play, so no expansion needed there
+    full_model = build_numpy_model(all_param_values)
+    quantized_model = NumpyModel(all_param_values, leaky_units=DEFAULT_LEAKY_UNITS, weight_type=weight_type)
+    save_numpy_model(out_filename, quantized_model)
+
+    if len(sys.argv) >= 5:
+        max_input = QUANTIZE_VALIDATION_SIZE
+        if len(sys.argv) >= 6:
+            max_input = int(sys.argv[5])
+        report = validate_quantized_model(full_model, quantized_model, load_validation_inputs(sys.argv[4], max_input = max_input))
+        report['model'] = model_filename
+        report['events_file'] = sys.argv[4]
+        for key in sorted(report.keys()):
+            print('%s:\t%s' % (key, report[key]))
+        report_filename = '%s_report.json' % os.path.splitext(out_filename)[0]
+        with open(report_filename, 'w') as f:
+            json.dump(report, f, sort_keys=True, indent=2)
+        print('wrote report to %s' % report_filename)
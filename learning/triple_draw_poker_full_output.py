@@ -4,18 +4,49 @@ import lasagne
 import theano
 import theano.tensor as T
 import theano.printing as tp # theano.printing.pprint(variable) [tp.pprint(var)]
+import sys
 import time
 import pickle
 import os.path # checking file existence, etc
+import json
+import random
+import threading
+import hashlib
+import collections
 import numpy as np
 
 from poker_lib import *
 from holdem_lib import *
 from draw_poker import _load_poker_csv
+from draw_poker import load_poker_csv_cached
+from draw_poker import LOADER_RANDOM_SEED
+from draw_poker import stream_minibatches
+from draw_poker import csv_example_stream
+from draw_poker import array_example_stream
+from draw_poker import load_dataset_store_manifest
+from draw_poker import select_dataset_shards
+from draw_poker import load_dataset_store_shards
+from draw_poker import dataset_store_holdout
+from draw_poker import dataset_store_example_stream
+from draw_poker import dataset_store_epoch_size
+from draw_poker import dataset_store_sampler
+from draw_poker import dataset_store_sampled_stream
+from draw_poker import deduplicate_training_data
+from draw_poker import write_training_profile
 from draw_poker import cards_input_from_string
+from numpy_model import NumpyModel
+from numpy_model import NumpyEnsemble
+from numpy_model import is_model_store
+from numpy_model import load_model_store
+from numpy_model import load_model_store_params
+from inference_broker import current_broker_context
+from inference_broker import current_lockstep_batcher
 from draw_poker import holdem_cards_input_from_string
 from draw_poker import create_iter_functions
 from draw_poker import train
+from draw_poker import unpack_training_inputs
+from draw_poker import PACKED_TRAINING_INPUTS
+from draw_poker import SPARSE_EVENT_INPUTS
 
 """
 Use similar network... to learn triple draw poker!!
@@ -45,11 +76,28 @@ elif TRAINING_FORMAT == 'deuce':
 elif TRAINING_FORMAT == 'video':
     DATA_FILENAME = '../data/250k_full_sim_combined.csv' # 250k hands (exactly) for 32-item sim for video poker (Jacks or better) [from April]
 
+USE_DATASET_CACHE = True # Save parsed data set to ../data/cache, and memory-map it on later runs, if CSV and flags unchanged
+# Stream shuffled training minibatches, prepared in background thread? 
+# 'arrays' --> from loaded (or memory-mapped) data. 'csv' --> straight from CSV, each epoch. Only validation & test sets are loaded.
+STREAM_TRAINING_DATA = None # 'arrays' # 'csv'
+
+# Train on shards from the data set store (../data/store), instead of DATA_FILENAME. Select by source, with mixture weights.
+# Add CSVs to the store with add_to_dataset_store.py. Streamed in chunks: weight 2.0 --> see each example twice per epoch, 0.5 --> random half.
+DATASET_STORE_MIXTURE = None # {'Slumbot': 1.0, 'Tartanian7': 1.0, 'self_play': 0.5}
+# Instead, draw each epoch by weight (alias tables). Weight == share of examples per source. Important cases weighted up (see IMPORTANT_CASES_WEIGHT)
+DATASET_STORE_SAMPLER = True # False
+DATASET_STORE_EPOCH_SIZE = None # None --> as many examples as training rows in the selected shards
+
+# Collapse identical training inputs into one example, with count folded into the mask. Fewer (but heavier) examples per epoch, same objective.
+DEDUPLICATE_TRAINING_DATA = False # True
+
 MAX_INPUT_SIZE = 740000 # 700000 # 110000 # 120000 # 10000000 # Remove this constraint, as needed
 VALIDATION_SIZE = 40000
 TEST_SIZE = 0 # 5000
 NUM_EPOCHS = 10 # 100 # 100 # 20 # 50 # 100 # 500
 BATCH_SIZE = 100 # 50 #100
+INFERENCE_BATCH_SIZE = None # Build models for play with any batch size. Evaluate one event in one pass, not BATCH_SIZE copies.
+PREDICTION_CACHE_SIZE = 50000 # Per model, remember outputs for this many recent inputs. Same cards, board, bets... repeat a lot. 0 --> no cache
 BORDER_SHAPE = "valid" # "full" = pads to prev shape "valid" = shrinks [bad for small input sizes]
 NUM_FILTERS = 24 # 16 # 32 # 16 # increases 2x at higher level
 NUM_HIDDEN_UNITS = 1024 # 512 # 256 #512
@@ -74,6 +122,13 @@ ADAPTIVE_USE_RMSPROP = False # If use adaaptive, use RMSprop instead of AdaDelta
 if ADAPTIVE_USE_RMSPROP:
     ADA_DELTA_LEARNING_RATE = 0.001 # needs tiny learning rate for RMSprop, else gradient goes crazy
 
+# Checkpoint all training state (params, momentum & adaptive accumulators, epoch, random state) every X epochs.
+# Pass --resume to pick up from the checkpoint, after a crash or preemption.
+CHECKPOINT_EVERY_EPOCHS = 5 # 1
+
+# Write time per training phase, examples/sec and peak memory, as JSON lines next to the model.
+PROFILE_TRAINING = True # False
+
 NUM_FAT_FILTERS = NUM_FILTERS / 2
 if USE_FAT_MODEL:
     NUM_FILTERS = NUM_FAT_FILTERS
@@ -283,10 +338,22 @@ def value_action_error(output_matrix, target_matrix, format = TRAINING_FORMAT):
 
 # TODO: Include "empty" bits... so we can get a model started... which can be used as basis for next data?
 def load_data():
-    print('About to load up to %d items of data, for training format %s' % (MAX_INPUT_SIZE, TRAINING_FORMAT))
+    max_input = MAX_INPUT_SIZE
+    if STREAM_TRAINING_DATA == 'csv':
+        max_input = VALIDATION_SIZE + TEST_SIZE
+    print('About to load up to %d items of data, for training format %s' % (max_input, TRAINING_FORMAT))
     # Do *not* bias the data, or smooth out big weight values, as we would for video poker.
     # 'deuce' has its own adjustments...
-    data = _load_poker_csv(filename=DATA_FILENAME, max_input = MAX_INPUT_SIZE, keep_all_data=(TRAINING_FORMAT != 'video'), format=TRAINING_FORMAT, include_num_draws = INCLUDE_NUM_DRAWS, include_full_hand = INCLUDE_FULL_HAND, include_hand_context = INCLUDE_HAND_CONTEXT)
+    # See USE_DATASET_CACHE
+    if DATASET_STORE_MIXTURE:
+        # Load validation & test from the first selected shards. The rest is streamed for training, below.
+        store_shards = load_dataset_store_shards(select_dataset_shards(load_dataset_store_manifest(), sources=DATASET_STORE_MIXTURE.keys(), format=TRAINING_FORMAT))
+        assert store_shards, 'No shards in data set store, for sources %s' % DATASET_STORE_MIXTURE.keys()
+        (data, store_starts) = dataset_store_holdout(store_shards, VALIDATION_SIZE + TEST_SIZE)
+    elif USE_DATASET_CACHE:
+        data = load_poker_csv_cached(filename=DATA_FILENAME, max_input = max_input, keep_all_data=(TRAINING_FORMAT != 'video'), format=TRAINING_FORMAT, include_num_draws = INCLUDE_NUM_DRAWS, include_full_hand = INCLUDE_FULL_HAND, include_hand_context = INCLUDE_HAND_CONTEXT, pack_inputs = PACKED_TRAINING_INPUTS, sparse_inputs = SPARSE_EVENT_INPUTS)
+    else:
+        data = _load_poker_csv(filename=DATA_FILENAME, max_input = max_input, keep_all_data=(TRAINING_FORMAT != 'video'), format=TRAINING_FORMAT, include_num_draws = INCLUDE_NUM_DRAWS, include_full_hand = INCLUDE_FULL_HAND, include_hand_context = INCLUDE_HAND_CONTEXT, pack_inputs = PACKED_TRAINING_INPUTS, sparse_inputs = SPARSE_EVENT_INPUTS, seed = LOADER_RANDOM_SEED)
 
     # num_hands = total loaded, X = input, y = best cateogy, z = all categories, m = mask on all categories (if applicable)
     num_hands, X_all, y_all, z_all, m_all = data
@@ -331,19 +398,25 @@ def load_data():
     print('m_test %s %s' % (type(m_test), m_test.shape))
     print('m_train %s %s' % (type(m_train), m_train.shape))
 
+    # Training set only. Validation and test keep one example per row, so losses still compare across runs.
+    # NOTE: Streams from CSV or store are not deduplicated.
+    if DEDUPLICATE_TRAINING_DATA:
+        (X_train, y_train, z_train, m_train, _) = deduplicate_training_data(X_train, y_train, z_train, m_train) # counts already folded into masks (and ratio printed)
+
     #sys.exit(0)
 
     # We ignore validation & test for now.
     #X_valid, y_valid = data[1]
     #X_test, y_test = data[2]
 
-    return dict(
+    dataset = dict(
         # theano.shared() can't support huge amounts of data (more than 100k-300k examples (depending on size)
         #X_train=theano.shared(lasagne.utils.floatX(X_train), borrow=True),
         #y_train=T.cast(theano.shared(y_train, borrow=True), 'int32'),
         #z_train=theano.shared(lasagne.utils.floatX(z_train), borrow=True),
         #m_train=theano.shared(lasagne.utils.floatX(m_train), borrow=True),
-        X_train=lasagne.utils.floatX(X_train),
+        # Inputs may be packed (bits, or bits and remainders), or event records. train() unpacks to float, one minibatch at a time.
+        X_train=X_train,
         y_train=y_train,
         z_train=lasagne.utils.floatX(z_train),
         m_train=lasagne.utils.floatX(m_train),
@@ -352,12 +425,12 @@ def load_data():
         #y_valid=T.cast(theano.shared(y_valid, borrow=True), 'int32'),
         #z_valid=theano.shared(lasagne.utils.floatX(z_valid), borrow=True),
         #m_valid=theano.shared(lasagne.utils.floatX(m_valid), borrow=True),
-        X_valid=lasagne.utils.floatX(X_valid),
+        X_valid=X_valid,
         y_valid=y_valid.astype(np.int32),
         z_valid=lasagne.utils.floatX(z_valid),
         m_valid=lasagne.utils.floatX(m_valid),
 
-        X_test=theano.shared(lasagne.utils.floatX(X_test), borrow=True),
+        X_test=theano.shared(lasagne.utils.floatX(unpack_training_inputs(X_test, format=TRAINING_FORMAT)), borrow=True),
         y_test=T.cast(theano.shared(y_test, borrow=True), 'int32'),
         z_test=theano.shared(lasagne.utils.floatX(z_test), borrow=True),
         m_test=theano.shared(lasagne.utils.floatX(m_test), borrow=True),
@@ -365,12 +438,29 @@ def load_data():
         num_examples_train=X_train.shape[0],
         num_examples_valid=X_valid.shape[0],
         num_examples_test=X_test.shape[0],
-        input_height=X_train.shape[2],
-        input_width=X_train.shape[3],
+        input_height=HAND_TO_MATRIX_PAD_SIZE,
+        input_width=HAND_TO_MATRIX_PAD_SIZE,
         #input_dim=X_train.shape[1] * X_train.shape[2] * X_train.shape[3], # How much size per input?? 5x4x13 data (cards, suits, ranks)
         output_dim=ARRAY_OUTPUT_LENGTH, # output cases
+        input_format=TRAINING_FORMAT, # for expanding event records
     )
 
+    # train() takes a new stream of minibatches each epoch, if given.
+    # NOTE: CSV stream skips the validation & test examples. Matches the loaded data, since sampled with same seed.
+    if DATASET_STORE_MIXTURE and DATASET_STORE_SAMPLER:
+        store_sampler = dataset_store_sampler(store_shards, DATASET_STORE_MIXTURE, starts=store_starts)
+        dataset['train_stream'] = lambda: stream_minibatches(dataset_store_sampled_stream(store_shards, store_sampler, num_examples=DATASET_STORE_EPOCH_SIZE), batch_size=BATCH_SIZE, format=TRAINING_FORMAT, shuffle_buffer_size=0)
+        dataset['num_examples_train'] = DATASET_STORE_EPOCH_SIZE or store_sampler['num_rows']
+    elif DATASET_STORE_MIXTURE:
+        dataset['train_stream'] = lambda: stream_minibatches(dataset_store_example_stream(store_shards, DATASET_STORE_MIXTURE, starts=store_starts), batch_size=BATCH_SIZE, format=TRAINING_FORMAT)
+        dataset['num_examples_train'] = dataset_store_epoch_size(store_shards, DATASET_STORE_MIXTURE, starts=store_starts)
+    elif STREAM_TRAINING_DATA == 'arrays':
+        dataset['train_stream'] = lambda: stream_minibatches(array_example_stream(X_train, y_train, z_train, m_train), batch_size=BATCH_SIZE, format=TRAINING_FORMAT)
+    elif STREAM_TRAINING_DATA == 'csv':
+        dataset['train_stream'] = lambda: stream_minibatches(csv_example_stream(filename=DATA_FILENAME, max_input = MAX_INPUT_SIZE, keep_all_data=(TRAINING_FORMAT != 'video'), format=TRAINING_FORMAT, include_num_draws = INCLUDE_NUM_DRAWS, include_full_hand = INCLUDE_FULL_HAND, include_hand_context = INCLUDE_HAND_CONTEXT, seed = LOADER_RANDOM_SEED, skip_examples = VALIDATION_SIZE + TEST_SIZE), batch_size=BATCH_SIZE, format=TRAINING_FORMAT)
+
+    return dataset
+
 # Alternatively, compare to same input... but two fully connected layers
 def build_fully_connected_model(input_width, input_height, output_dim,
                                 batch_size=BATCH_SIZE, input_var = None):
@@ -384,7 +474,7 @@ def build_fully_connected_model(input_width, input_height, output_dim,
         input_var = input_var,
         )
     layers.append(l_in)
-    print('input layer shape %d x %d x %d x %d' % (batch_size, num_input_cards, input_height, input_width))
+    print('input layer shape %s x %d x %d x %d' % (batch_size, num_input_cards, input_height, input_width))
 
     l_hidden0 = lasagne.layers.DenseLayer(
         l_in, # l_conv2_2, #l_pool2,
@@ -435,7 +525,7 @@ def build_fat_model(input_width, input_height, output_dim,
         input_var = input_var,
         )
     layers.append(l_in)
-    print('input layer shape %d x %d x %d x %d' % (batch_size, num_input_cards, input_height, input_width))
+    print('input layer shape %s x %d x %d x %d' % (batch_size, num_input_cards, input_height, input_width))
     l_conv1 = lasagne.layers.Conv2DLayer(
         l_in,
         num_filters=NUM_FAT_FILTERS,
@@ -539,7 +629,7 @@ def build_nopool_model(input_width, input_height, output_dim,
             )
     layers.append(l_in)
 
-    print('input layer shape %d x %d x %d x %d' % (batch_size, num_input_cards, input_height, input_width))
+    print('input layer shape %s x %d x %d x %d' % (batch_size, num_input_cards, input_height, input_width))
 
     # Do we use rectified linear units, or a leaky version thereof? 
     # NOTE: Could mix this layer by layer... but better to keep it consistent.
@@ -668,7 +758,7 @@ def build_model(input_width, input_height, output_dim,
             )
     layers.append(l_in)
 
-    print('input layer shape %d x %d x %d x %d' % (batch_size, num_input_cards, input_height, input_width))
+    print('input layer shape %s x %d x %d x %d' % (batch_size, num_input_cards, input_height, input_width))
 
     # Do we use rectified linear units, or a leaky version thereof? 
     # NOTE: Could mix this layer by layer... but better to keep it consistent.
@@ -952,6 +1042,21 @@ def create_iter_functions_full_output(dataset, output_layer, side_output_layers
     # Fixed learning rate with Nesterov momentum, is still the default training function
     iter_train = iter_train_nesterov
 
+    # All shared variables that training updates: params, plus momentum and AdaDelta/RMSprop accumulators. In stable order.
+    # NOTE: Compare by id(). Theano variables don't do equality.
+    training_state = []
+    training_state_ids = set()
+    for updates in [updates_nesterov, updates_adadelta, updates_rmsprop]:
+        for variable in updates.keys():
+            if id(variable) not in training_state_ids:
+                training_state_ids.add(id(variable))
+                training_state.append(variable)
+    # Also dropout masks' random streams, so that a resumed run draws the same masks.
+    for variable in dropout_random_states([output_layer] + (side_output_layers or [])):
+        if id(variable) not in training_state_ids:
+            training_state_ids.add(id(variable))
+            training_state.append(variable)
+
     # Don't do adaptive training on fresh model. needs to run with learning & momentum first. Then... we delta
     if default_adaptive:
         if ADAPTIVE_USE_RMSPROP:
@@ -979,6 +1084,7 @@ def create_iter_functions_full_output(dataset, output_layer, side_output_layers
         train_nesterov=iter_train_nesterov,
         train_ada_delta=iter_train_ada_delta,
         valid=iter_valid,
+        training_state=training_state,
         #test=iter_test,
     )
 
@@ -1004,7 +1110,7 @@ def predict_model(output_layer, test_batch, format = 'deuce', input_layer = None
 
     # Print out entire predictions array
     opt = np.get_printoptions()
-    np.set_printoptions(threshold='nan')
+    np.set_printoptions(threshold=sys.maxsize)
     print('Prediciton: %s' % pred) 
     # Return options to previous settings...
     np.set_printoptions(**opt)
@@ -1054,11 +1160,151 @@ def predict_model(output_layer, test_batch, format = 'deuce', input_layer = None
     print(softmax_debug)
 
 
+# Compiled prediction, for one loaded model. Build the graph and compile theano.function once, then reuse it for every decision.
+# [get_output().eval() per call rebuilds the graph every time, takes seconds, and memory grows.]
+class ModelPredictor(object):
+    def __init__(self, output_layer, input_layer):
+        self.output_layer = output_layer
+        self.input_layer = input_layer
+        now = time.time()
+        pred = lasagne.layers.get_output(output_layer, deterministic=DETERMINISTIC_MODEL_RUN)
+        self.predict_function = theano.function([input_layer.input_var], pred, allow_input_downcast=True)
+        self.batch_size = input_layer.shape[0] # None --> any batch size
+        print('%.2fs to compile predictor' % (time.time() - now))
+
+    # Batch of inputs (any number) --> matrix of output vectors, one per input
+    def predict(self, batch):
+        return predict_in_batches(self.predict_function, lasagne.utils.floatX(batch), self.batch_size)
+
+# Call compiled function on the batch. If model built with fixed batch size, zero-pad (and split) to fit.
+def predict_in_batches(predict_function, batch, batch_size):
+    if not batch_size:
+        return predict_function(batch)
+    outputs = []
+    for start in range(0, len(batch), batch_size):
+        chunk = batch[start:start + batch_size]
+        padded_chunk = np.zeros((batch_size,) + chunk.shape[1:], dtype=chunk.dtype)
+        padded_chunk[:len(chunk)] = chunk
+        outputs.append(predict_function(padded_chunk)[:len(chunk)])
+    return np.concatenate(outputs)
+
+# Several models (output_layer, input_layer) on the same input, compiled into one function. predict(batch) --> [batch x num_models x outputs]
+# One input variable for all models, so input encoded and copied to device once, and one call for all of them.
+# NOTE: Models need the same output length (bets models all do), and the same batch size if fixed.
+class EnsemblePredictor(object):
+    def __init__(self, members):
+        self.members = members
+        now = time.time()
+        input_var = T.tensor4('ensemble_inputs')
+        preds = [lasagne.layers.get_output(output_layer, input_var, deterministic=DETERMINISTIC_MODEL_RUN) for (output_layer, input_layer) in members]
+        self.predict_function = theano.function([input_var], T.stack(preds, axis=1), allow_input_downcast=True)
+        self.batch_size = members[0][1].shape[0]
+        print('%.2fs to compile ensemble predictor for %d models' % (time.time() - now, len(members)))
+
+    def predict(self, batch):
+        return predict_in_batches(self.predict_function, lasagne.utils.floatX(batch), self.batch_size)
+
+# Load params into a NumPy model, built like build_model() and others here. No Theano graph, nothing to compile.
+# Pass it as output_layer (no input layer) to the evaluate functions below.
+def build_numpy_model(all_param_values):
+    return NumpyModel(all_param_values, leaky_units=DEFAULT_LEAKY_UNITS)
+
+# One predictor for several models [(output_layer, input_layer)], all evaluated in one pass. Pass it as output_layer (no input layer)
+# to evaluate_single_event(), and take the output row for the model you want. If all NumPy models, stack them in NumPy.
+def build_ensemble_predictor(members):
+    if all([isinstance(output_layer, NumpyModel) for (output_layer, input_layer) in members]):
+        return NumpyEnsemble([output_layer for (output_layer, input_layer) in members])
+    if not all([input_layer for (output_layer, input_layer) in members]):
+        print('Can not build ensemble, no input layer for some models.')
+        return None
+    return EnsemblePredictor(members)
+
+# Can we predict with compiled function (or NumPy)? Else, old get_output().eval() path.
+def has_predictor(output_layer, input_layer):
+    return bool(input_layer) or isinstance(output_layer, (NumpyModel, NumpyEnsemble, EnsemblePredictor))
+
+# LRU cache of output rows, by encoded input. Wraps any predictor, same predict() interface. Only inputs not in the cache go to the model.
+# Key is sha1 of the input bytes (float 31x17x17 input, ~36KB, hashes much faster than a forward pass).
+# NOTE: Cache the model output only. Noise and random choices in play are applied after, so play is the same.
+class PredictionCache(object):
+    def __init__(self, predictor, max_size = PREDICTION_CACHE_SIZE):
+        self.predictor = predictor
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    # Misses go to predict_misses(batch) if given (to batch them with other games), else to the wrapped predictor.
+    def predict(self, batch, predict_misses = None):
+        batch = np.ascontiguousarray(lasagne.utils.floatX(batch))
+        keys = [hashlib.sha1(single_input).digest() for single_input in batch]
+        outputs = [None] * len(batch)
+        with self.lock:
+            for (i, key) in enumerate(keys):
+                if key in self.cache:
+                    output = self.cache.pop(key)
+                    self.cache[key] = output # most recently used
+                    outputs[i] = output
+        missing = [i for i in range(len(batch)) if outputs[i] is None]
+        if missing:
+            missing_outputs = (predict_misses or self.predictor.predict)(batch[missing])
+        with self.lock:
+            self.stats['hits'] += len(batch) - len(missing)
+            self.stats['misses'] += len(missing)
+            for (i, output) in zip(missing, missing_outputs if missing else []):
+                output = np.array(output)
+                output.setflags(write=False) # shared with later callers
+                outputs[i] = output
+                self.cache[keys[i]] = output
+                if len(self.cache) > self.max_size:
+                    self.cache.popitem(last=False)
+        return np.array(outputs)
+
+    def print_stats(self):
+        total = max(self.stats['hits'] + self.stats['misses'], 1)
+        print('prediction cache:\t%d hits\t%d misses\t%.1f%% hit rate\t%d/%d entries' % (self.stats['hits'], self.stats['misses'], self.stats['hits'] * 100.0 / total,
+                                                                                        len(self.cache), self.max_size))
+
+# Predictors for models loaded so far, by output layer. Keeps a reference to the layer, so that id() is not reused.
+# With PREDICTION_CACHE_SIZE, repeated inputs are answered from cache. Only if model run is deterministic (no dropout).
+MODEL_PREDICTORS = {}
+MODEL_PREDICTORS_LOCK = threading.Lock()
+def model_predictor(output_layer, input_layer):
+    with MODEL_PREDICTORS_LOCK:
+        if id(output_layer) not in MODEL_PREDICTORS:
+            if isinstance(output_layer, (NumpyModel, NumpyEnsemble, EnsemblePredictor)):
+                predictor = output_layer
+            else:
+                predictor = ModelPredictor(output_layer, input_layer)
+            if PREDICTION_CACHE_SIZE and DETERMINISTIC_MODEL_RUN:
+                predictor = PredictionCache(predictor)
+            MODEL_PREDICTORS[id(output_layer)] = (output_layer, predictor)
+        return MODEL_PREDICTORS[id(output_layer)][1]
+
+def print_prediction_cache_stats():
+    for (output_layer, predictor) in MODEL_PREDICTORS.values():
+        if isinstance(predictor, PredictionCache):
+            predictor.print_stats()
+
+# Predict batch with this model. If called from a game in lockstep play, wait for predictions from other tables, and batch them together.
+# If called from a thread in InferenceBrokerContext.run_threads(), batch with other threads through the context's broker for this model.
+# Cache first: hits return right away, and only the misses wait for a batch.
+def predict_with_model(output_layer, input_layer, batch):
+    predictor = model_predictor(output_layer, input_layer)
+    batcher = current_lockstep_batcher() or current_broker_context()
+    if not batcher:
+        return predictor.predict(batch)
+    if isinstance(predictor, PredictionCache):
+        return predictor.predict(batch, predict_misses = lambda misses: batcher.predict(predictor.predictor, misses))
+    return batcher.predict(predictor, batch)
+
 # Get 0-BATCH_SIZE hands, evaluate, and return matrix of vectors
 def evaluate_batch_hands(output_layer, test_cases, include_hand_context = INCLUDE_HAND_CONTEXT, input_layer = None): 
     now = time.time()
-    for i in range(BATCH_SIZE - len(test_cases)):
-        test_cases.append(test_cases[0])
+    # Predictor takes any number of cases. Without input layer, need to fill the batch.
+    if not has_predictor(output_layer, input_layer):
+        for i in range(BATCH_SIZE - len(test_cases)):
+            test_cases.append(test_cases[0])
     
     # case = [hand_string, int(num_draws)]
     #print(test_cases)
@@ -1076,22 +1322,13 @@ def evaluate_batch_hands(output_layer, test_cases, include_hand_context = INCLUD
 
     # print('%.2fs to create BATCH_SIZE input' % (time.time() - now))
     #now = time.time()
-    if input_layer:
+    if has_predictor(output_layer, input_layer):
         #print('evaluating batch with input layer, so no grow in theano.shared()!')
-        pred = lasagne.layers.get_output(output_layer, deterministic=DETERMINISTIC_MODEL_RUN)
+        softmax_values = predict_with_model(output_layer, input_layer, test_batch)
     else:
         pred = lasagne.layers.get_output(output_layer, lasagne.utils.floatX(test_batch), deterministic=DETERMINISTIC_MODEL_RUN)
-    # print('%.2fs to get_output' % (time.time() - now))
-    #now = time.time()
-
-    #print('Prediciton: %s' % pred)
-    #print(tp.pprint(pred))
-    if input_layer:
-        softmax_values = pred.eval({input_layer.input_var: lasagne.utils.floatX(test_batch)})
-    else:
         softmax_values = pred.eval()
-    print('%.2fs to eval() output' % (time.time() - now))
-    now = time.time()
+    # print('%.2fs to predict output' % (time.time() - now))
 
     return softmax_values
 
@@ -1112,16 +1349,12 @@ def evaluate_single_holdem_hand(output_layer, input_layer, cards, flop, turn, ri
     # Just one case, and all zeros to fit the input.
     # TODO: Create side function to avoid this tostring, then back to array nonsense...
     test_case = holdem_cards_input_from_string(hand_string(cards), hand_string(flop), hand_string(turn), hand_string(river))
-    test_cases = [test_case]
-    for i in range(BATCH_SIZE - len(test_cases)):
-        test_cases.append(np.zeros_like(test_case))
-    test_batch = np.array(test_cases, TRAINING_INPUT_TYPE)
+    test_batch = np.array([test_case], TRAINING_INPUT_TYPE)
 
     # Get model prediction. Requires input layer.
-    pred = lasagne.layers.get_output(output_layer, deterministic=DETERMINISTIC_MODEL_RUN)
-    softmax_values = pred.eval({input_layer.input_var: lasagne.utils.floatX(test_batch)})
+    softmax_values = predict_with_model(output_layer, input_layer, test_batch)
     softmax_single_vector = softmax_values[0]
-    print('%.2fs to eval() output' % (time.time() - now))
+    # print('%.2fs to predict output' % (time.time() - now))
 
     # Return output vector for our single input.
     return softmax_single_vector
@@ -1129,22 +1362,20 @@ def evaluate_single_holdem_hand(output_layer, input_layer, cards, flop, turn, ri
 # Just give us the bits... expect 26x17x17 matrix...
 def evaluate_single_event(output_layer, event_input, input_layer = None):
     now = time.time()
-    test_batch = np.array([event_input for i in range(BATCH_SIZE)], TRAINING_INPUT_TYPE)
+    # Single input is enough for predictor. Without input layer, need to fill the batch.
+    if has_predictor(output_layer, input_layer):
+        test_batch = np.array([event_input], TRAINING_INPUT_TYPE)
+    else:
+        test_batch = np.array([event_input for i in range(BATCH_SIZE)], TRAINING_INPUT_TYPE)
     # print('%.2fs to create BATCH_SIZE input' % (time.time() - now))
     now = time.time()
-    if input_layer:
+    if has_predictor(output_layer, input_layer):
         #print('evaluating batch with input layer, so no grow in theano.shared()!')
-        pred = lasagne.layers.get_output(output_layer, deterministic=DETERMINISTIC_MODEL_RUN)
+        softmax_values = predict_with_model(output_layer, input_layer, test_batch)
     else:
         pred = lasagne.layers.get_output(output_layer, lasagne.utils.floatX(test_batch), deterministic=DETERMINISTIC_MODEL_RUN)
-    # print('%.2fs to get_output' % (time.time() - now))
-    now = time.time()
-    if input_layer:
-        softmax_values = pred.eval({input_layer.input_var: lasagne.utils.floatX(test_batch)})
-    else:
         softmax_values = pred.eval()
-    print('%.2fs to eval() output' % (time.time() - now))
-    now = time.time()
+    # print('%.2fs to predict output' % (time.time() - now))
 
     return softmax_values[0]
 
@@ -1161,6 +1392,86 @@ def save_model(out_file=None, output_layer=None):
         with open(out_file, 'wb') as f:
             pickle.dump(all_param_values, f, -1)
 
+# Checkpoint sits next to the model file.
+def checkpoint_filename(out_file):
+    return os.path.splitext(out_file)[0] + '_checkpoint.npz'
+
+# Write to temp file, and rename over the old checkpoint. So a crash mid-write never leaves us without a checkpoint.
+def write_checkpoint(path, arrays):
+    now = time.time()
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_path, path)
+    print('\nwrote checkpoint %s in %.2fs' % (path, time.time() - now))
+    sys.stdout.flush()
+
+# Shared random states of noise layers (dropout). Lasagne draws masks from MRG_RandomStreams. Each sampling op in the graph
+# has its own state (int32 array), advanced by every training call. Only populated once the (non-deterministic) graph is built.
+def dropout_random_states(output_layers):
+    states = []
+    for layer in lasagne.layers.get_all_layers(output_layers):
+        if hasattr(layer, '_srng'):
+            states += [update[0] for update in layer._srng.state_updates] # (state, new state, ...)
+    return states
+
+# Snapshot all training state (values copied now, since training keeps updating them), and write .npz in background thread.
+# Random state saved too: np.random, random, and lasagne.random.get_rng() if set to its own RandomState.
+# Dropout streams are in training_state (see dropout_random_states)
+# Waits for previous write to finish. Returns the writer thread.
+def save_checkpoint(out_file, training_state, epoch, writer = None):
+    arrays = {}
+    for (i, variable) in enumerate(training_state):
+        arrays['state_%d' % i] = variable.get_value(borrow=False)
+    np_random_state = np.random.get_state()
+    arrays['np_random_keys'] = np_random_state[1]
+    py_random_state = random.getstate()
+    arrays['py_random_state'] = np.array(py_random_state[1], dtype=np.int64)
+    metadata = {'epoch': epoch, 'format': TRAINING_FORMAT, 'saved': time.time(),
+                'state_names': [str(variable.name) for variable in training_state],
+                'np_random': [np_random_state[0], np_random_state[2], np_random_state[3], np_random_state[4]],
+                'py_random': [py_random_state[0], py_random_state[2]]}
+    lasagne_rng = lasagne.random.get_rng()
+    if lasagne_rng is not np.random:
+        lasagne_random_state = lasagne_rng.get_state()
+        arrays['lasagne_random_keys'] = lasagne_random_state[1]
+        metadata['lasagne_random'] = [lasagne_random_state[0], lasagne_random_state[2], lasagne_random_state[3], lasagne_random_state[4]]
+    arrays['metadata'] = np.array(json.dumps(metadata))
+
+    if writer:
+        writer.join()
+    writer = threading.Thread(target=write_checkpoint, args=(checkpoint_filename(out_file), arrays))
+    writer.start()
+    return writer
+
+# Restore training state from checkpoint. Network and optimizers must be built the same way. Returns epoch of the checkpoint.
+def load_checkpoint(out_file, training_state):
+    path = checkpoint_filename(out_file)
+    print('Resuming from checkpoint %s' % path)
+    with np.load(path) as data:
+        metadata = json.loads(str(data['metadata']))
+        assert len(metadata['state_names']) == len(training_state), 'checkpoint has %d state variables, network has %d' % (len(metadata['state_names']), len(training_state))
+        for (i, variable) in enumerate(training_state):
+            value = data['state_%d' % i]
+            current_value = variable.get_value(borrow=True)
+            assert value.shape == current_value.shape, 'checkpoint shape %s for %s, network expects %s' % (value.shape, metadata['state_names'][i], current_value.shape)
+            variable.set_value(value.astype(current_value.dtype))
+        np_random = metadata['np_random']
+        np.random.set_state((str(np_random[0]), data['np_random_keys'], np_random[1], np_random[2], np_random[3]))
+        py_random = metadata['py_random']
+        random.setstate((py_random[0], tuple([int(value) for value in data['py_random_state']]), py_random[1]))
+        if 'lasagne_random' in metadata:
+            lasagne_random = metadata['lasagne_random']
+            lasagne_rng = lasagne.random.get_rng()
+            if lasagne_rng is np.random:
+                lasagne_rng = np.random.RandomState()
+                lasagne.random.set_rng(lasagne_rng)
+            lasagne_rng.set_state((str(lasagne_random[0]), data['lasagne_random_keys'], lasagne_random[1], lasagne_random[2], lasagne_random[3]))
+    print('Restored %d state variables, at epoch %d' % (len(training_state), metadata['epoch']))
+    return metadata['epoch']
+
 # If input is < expected input... fill remaining rows with noise (for training)... or with zeros (production)
 def expand_parameters_input_to_match(all_param_values, zero_fill = False):
     # HACK: If input size doesn't match... pad the input (first) layer with random noise from working layers of the model.
@@ -1216,7 +1527,26 @@ def expand_parameters_input_to_match(all_param_values, zero_fill = False):
         print(all_param_values[-2].shape)
         print(all_param_values[-1].shape)
 
-def main(num_epochs=NUM_EPOCHS, out_file=None):
+# Param values for model file: pickle from save_model(), or model store (see convert_model_store.py) memory-mapped, and expanded already.
+def load_model_param_values(filename):
+    if is_model_store(filename):
+        return load_model_store_params(filename)
+    return np.load(filename)
+
+# Load model for play, as NumPy model. Pickled param values (expanded to match input & output, as for Theano models),
+# NumPy model saved by quantize_numpy_model.py (expanded already, weights as stored), or model store (memory-mapped).
+def load_numpy_play_model(filename):
+    if is_model_store(filename):
+        return load_model_store(filename)
+    with open(filename, 'rb') as f:
+        all_param_values = pickle.load(f)
+    if isinstance(all_param_values, NumpyModel):
+        print('loaded NumPy model %s (%s weights)' % (filename, all_param_values.weight_type))
+        return all_param_values
+    expand_parameters_input_to_match(all_param_values, zero_fill = True)
+    return build_numpy_model(all_param_values)
+
+def main(num_epochs=NUM_EPOCHS, out_file=None, resume=False):
     print("Loading data...")
     dataset = load_data()
 
@@ -1284,15 +1614,24 @@ def main(num_epochs=NUM_EPOCHS, out_file=None):
         input_var = input_var
         )
 
+    # Resume from checkpoint, if asked. Overrides params loaded above.
+    first_epoch = 1
+    if resume:
+        if os.path.isfile(checkpoint_filename(out_file)):
+            first_epoch = load_checkpoint(out_file, iter_funcs['training_state']) + 1
+        else:
+            print('No checkpoint to resume from %s' % checkpoint_filename(out_file))
+
     print("Starting training...")
     now = time.time()
+    checkpoint_writer = None
     try:
         # When do we switch to adaptive training? Problems with adapative training and events, so disable that.
         switch_adaptive_after = EPOCH_SWITCH_ADAPT
         switch_adaptive_after = 10000 # never
         if TRAINING_FORMAT == 'deuce_events' and DISABLE_EVENTS_EPOCH_SWITCH:
             switch_adaptive_after = 10000 # never
-        for epoch in train(iter_funcs, dataset, epoch_switch_adapt=switch_adaptive_after):
+        for epoch in train(iter_funcs, dataset, epoch_switch_adapt=switch_adaptive_after, first_epoch=first_epoch):
             sys.stdout.flush() # Helps keep track of output live in re-directed out
             print("Epoch {} of {} took {:.3f}s".format(
                 epoch['number'], num_epochs, time.time() - now))
@@ -1303,6 +1642,7 @@ def main(num_epochs=NUM_EPOCHS, out_file=None):
                     epoch['valid_accuracy'] * 100))
 
             # Save model, after every epoch.
+            save_start = time.time()
             save_model(out_file=out_file, output_layer=output_layer)
             
             # If training side tasks, save those paramaters also
@@ -1314,12 +1654,24 @@ def main(num_epochs=NUM_EPOCHS, out_file=None):
                 save_model(out_file=('side_oppn_values_'+out_file), output_layer=side_output_layers[1]) # oppn hand category probabilities
                 save_model(out_file=('side_win_prob_'+out_file), output_layer=side_output_layers[2]) # distribution of allin odds vs oppn
 
+            if epoch['number'] % CHECKPOINT_EVERY_EPOCHS == 0 or epoch['number'] >= num_epochs:
+                checkpoint_writer = save_checkpoint(out_file, iter_funcs['training_state'], epoch['number'], writer=checkpoint_writer)
+
+            # NOTE: Checkpoint written in background. Save time is for snapshot, and waiting on previous write.
+            if PROFILE_TRAINING:
+                epoch['profile']['save_seconds'] = time.time() - save_start
+                write_training_profile(out_file, epoch)
+
             if epoch['number'] >= num_epochs:
                 break
 
     except KeyboardInterrupt:
         pass
 
+    # Don't exit with checkpoint half written.
+    if checkpoint_writer:
+        checkpoint_writer.join()
+
     # Can we do something with final output model? Like show a couple of moves...
     #test_batch = dataset['X_test']
 
@@ -1386,4 +1738,4 @@ if __name__ == '__main__':
         output_layer_filename = '%striple_draw_conv_%.2f_learn_rate_%d_epoch_adaptive_%d_filters_%s_border_%d_num_draws%s_model.pickle' % (TRAINING_FORMAT, LEARNING_RATE, EPOCH_SWITCH_ADAPT, NUM_FILTERS, BORDER_SHAPE, INCLUDE_NUM_DRAWS, extra_flags)
     else:
         output_layer_filename = '%s_conv_%.2f_learn_rate_%d_epoch_adaptive_%d_filters_%s_border_%d_num_draws%s_model.pickle' % (TRAINING_FORMAT, LEARNING_RATE, EPOCH_SWITCH_ADAPT, NUM_FILTERS, BORDER_SHAPE, INCLUDE_NUM_DRAWS, extra_flags)
-    main(out_file=output_layer_filename)
+    main(out_file=output_layer_filename, resume=('--resume' in sys.argv))
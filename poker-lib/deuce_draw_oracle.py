@@ -0,0 +1,275 @@
+import sys
+import csv
+import time
+import math
+import itertools
+import numpy as np
+from poker_lib import *
+from poker_util import *
+
+"""
+Author: Nikolai Yakovenko
+Copyright: PokerPoker, LLC 2015
+
+Exact values for the final draw in 2-7 lowball (deuce to seven).
+
+On the last draw, the value of keeping a subset of our 5 cards depends only on the cards kept,
+and the cards we know to be dead (our own discards, plus anything else seen). So instead of
+asking a model (or sampling X times, as in simulate_draw_values), we can enumerate every possible
+set of replacement cards, for each of the 32 draw patterns, and count exact outcomes.
+
+Enumeration trick: in lowball, final hand depends only on ranks (and flush). So enumerate multisets
+of replacement ranks (at most 6188 for a 5-card draw), weigh each by the number of ways to deal it
+from the live cards, and separately count the (few) ways to make a flush.
+
+Results are cached by a canonical key for kept & dead cards (suit permutation invariant).
+So 7h5d4c3s + dead [Kd] and 7s5c4h3d + dead [Kc] share an entry.
+"""
+
+# Same scale as adjust_float_value(mode='deuce'), so that exact values can be compared to, or replace, 32-value model output.
+DEUCE_VALUE_SCALE = 0.001
+
+# Don't grow without bound, if we run through many hands in self-play. Just clear it when full.
+FINAL_DRAW_CACHE_MAX_SIZE = 200000
+final_draw_cache = {}
+final_draw_cache_hits = 0
+final_draw_cache_misses = 0
+
+# Lowball categories, in order best to worst. For output of category counts & odds.
+DEUCE_CATEGORIES = [DEUCE_WHEEL, DEUCE_SEVEN, DEUCE_EIGHT, DEUCE_NINE, DEUCE_TEN,
+                    DEUCE_JACK, DEUCE_QUEEN, DEUCE_KING, DEUCE_ACE_OR_BETTER]
+
+# Ways to choose k of n cards. Small table, since we never have more than 4 cards of a rank.
+choose_table = [[0 for k in range(6)] for n in range(5)]
+for n in range(5):
+    for k in range(6):
+        if k <= n:
+            choose_table[n][k] = math.factorial(n) / (math.factorial(k) * math.factorial(n - k))
+
+# Suits to use, when we need to build a (non-flush) final hand from ranks only.
+ranks_hand_suits = [CLUB, DIAMOND, HEART, SPADE]
+
+# Lowball outcome for a final hand, given sorted ranks, and whether it is a flush.
+# Returns (deuce_category, deuce_heuristic) for the hand.
+# NOTE: There are only ~6k rank combinations, so keep them all.
+ranks_outcome_cache = {}
+def final_ranks_outcome(ranks, is_flush=False):
+    key = (ranks, is_flush)
+    if key in ranks_outcome_cache:
+        return ranks_outcome_cache[key]
+
+    # Build a hand with those ranks. Pairs must use different suits. Flush only if requested.
+    cards = []
+    if is_flush:
+        cards = [Card(suit=CLUB, value=rank) for rank in ranks]
+    else:
+        seen_ranks = {}
+        for rank in ranks:
+            suit_index = seen_ranks.get(rank, 0)
+            seen_ranks[rank] = suit_index + 1
+            cards.append(Card(suit=ranks_hand_suits[suit_index], value=rank))
+        # Five unique ranks, all in clubs. Break the flush.
+        if len(seen_ranks) == 5:
+            cards[-1] = Card(suit=DIAMOND, value=ranks[-1])
+
+    rank = hand_rank_five_card(cards)
+    outcome = (hand_category_deuce(rank), deuce_heuristic_five_card(cards))
+    ranks_outcome_cache[key] = outcome
+    return outcome
+
+# Canonical key for kept cards, and dead cards (cards not in the deck, that aren't kept).
+# Suit by suit, record ranks kept & ranks dead. Then sort the suits. Equal under any suit permutation.
+def final_draw_canonical_key(kept_cards, dead_cards):
+    suit_signatures = []
+    for suit in suitsArray:
+        kept_ranks = tuple(sorted([card.value for card in kept_cards if card.suit == suit]))
+        dead_ranks = tuple(sorted([card.value for card in dead_cards if card.suit == suit]))
+        suit_signatures.append((kept_ranks, dead_ranks))
+    return tuple(sorted(suit_signatures))
+
+# Result of a draw pattern, with exact counts. Looks like HandSimResult, with respect to average_value & draw_cards.
+class FinalDrawResult(object):
+    def __init__(self, draw_index = 0, draw_cards = [], total = 0, category_counts = {}, heuristic_sum = 0):
+        self.draw_index = draw_index # int i in [32] row array of possible 5-card draws.
+        self.draw_cards = draw_cards # cards kept
+        self.draw_string = hand_string(draw_cards)
+
+        # Exact counts, over all possible replacement cards
+        self.total = total
+        self.category_counts = category_counts
+        self.heuristic_sum = heuristic_sum
+
+        # Average 0-1000 deuce heuristic value, and same on the model's scale
+        self.average_value = float(heuristic_sum) / total if total else 0.0
+        self.value = self.average_value * DEUCE_VALUE_SCALE
+
+    # Odds of making given lowball category (exactly)
+    def category_odds(self, category):
+        if not self.total:
+            return 0.0
+        return float(self.category_counts.get(category, 0)) / self.total
+
+    # Odds of making category or better.
+    def category_or_better_odds(self, category):
+        if not self.total:
+            return 0.0
+        count = 0
+        for deuce_category in DEUCE_CATEGORIES:
+            count += self.category_counts.get(deuce_category, 0)
+            if deuce_category == category:
+                break
+        return float(count) / self.total
+
+    def __str__(self):
+        return '[%s] %d outcomes:\t%.2f average\t%s' % (self.draw_string, self.total, self.average_value,
+                                                       ', '.join(['%s: %.3f' % (categoryName[c], self.category_odds(c)) for c in DEUCE_CATEGORIES if self.category_counts.get(c, 0)]))
+
+    def __lt__(self, draw_result_2):
+        return self.average_value < draw_result_2.average_value
+
+# Count all outcomes, for keeping kept_cards, and drawing the rest from a deck without dead_cards.
+# NOTE: dead_cards should include the kept cards, and the discards.
+# Returns (total, {category: count}, heuristic_sum)
+def count_final_draw_outcomes(kept_cards, dead_cards):
+    # Live cards, by rank and by suit.
+    dead_set = set([(card.suit, card.value) for card in dead_cards] + [(card.suit, card.value) for card in kept_cards])
+    live_by_rank = [[suit for suit in suitsArray if not((suit, rank) in dead_set)] for rank in ranksArray]
+    live_count = [len(suits) for suits in live_by_rank]
+
+    kept_ranks = [card.value for card in kept_cards]
+    kept_suits = set([card.suit for card in kept_cards])
+    num_draw = 5 - len(kept_cards)
+
+    # Suits in which a flush is still possible. All kept cards must be of that suit.
+    if len(kept_suits) > 1:
+        flush_suits = []
+    elif len(kept_suits) == 1:
+        flush_suits = list(kept_suits)
+    else:
+        flush_suits = suitsArray
+
+    total = 0
+    heuristic_sum = 0
+    category_counts = {}
+    for draw_ranks in itertools.combinations_with_replacement(ranksArray, num_draw):
+        # How many ways to deal these ranks, from live cards?
+        ways = 1
+        for rank in set(draw_ranks):
+            ways *= choose_table[live_count[rank]][draw_ranks.count(rank)]
+            if not ways:
+                break
+        if not ways:
+            continue
+
+        final_ranks = tuple(sorted(kept_ranks + list(draw_ranks)))
+
+        # Of these, how many are flushes? Needs 5 unique ranks, and every drawn card live in the flush suit.
+        flush_ways = 0
+        if flush_suits and len(set(final_ranks)) == 5:
+            for suit in flush_suits:
+                if all([(suit in live_by_rank[rank]) for rank in draw_ranks]):
+                    flush_ways += 1
+
+        if ways > flush_ways:
+            category, heuristic = final_ranks_outcome(final_ranks, is_flush=False)
+            category_counts[category] = category_counts.get(category, 0) + (ways - flush_ways)
+            heuristic_sum += heuristic * (ways - flush_ways)
+        if flush_ways:
+            category, heuristic = final_ranks_outcome(final_ranks, is_flush=True)
+            category_counts[category] = category_counts.get(category, 0) + flush_ways
+            heuristic_sum += heuristic * flush_ways
+        total += ways
+
+    return (total, category_counts, heuristic_sum)
+
+# Cached lookup of the above.
+def final_draw_outcomes(kept_cards, dead_cards):
+    global final_draw_cache_hits, final_draw_cache_misses
+    key = final_draw_canonical_key(kept_cards, dead_cards)
+    if key in final_draw_cache:
+        final_draw_cache_hits += 1
+        return final_draw_cache[key]
+    final_draw_cache_misses += 1
+    if len(final_draw_cache) >= FINAL_DRAW_CACHE_MAX_SIZE:
+        final_draw_cache.clear()
+    outcomes = count_final_draw_outcomes(kept_cards, dead_cards)
+    final_draw_cache[key] = outcomes
+    return outcomes
+
+# For dealt hand (5 cards), return exact result for every one of the 32 draw patterns.
+# Optionally, pass other known dead cards (previous discards, etc). Dealt cards are always dead.
+def exact_final_draw_results(hand_array, dead_cards = [], debug = False):
+    assert len(hand_array) == 5, 'Need 5-card hand for final draw! %s' % hand_string(hand_array)
+    # All dealt cards are dead, whether kept or discarded.
+    all_dead_cards = hand_array + [card for card in dead_cards if not (card in hand_array)]
+    results = []
+    for i in range(len(all_draw_patterns)):
+        draw_pattern = all_draw_patterns[i]
+        kept_cards = [hand_array[pos] for pos in sorted(draw_pattern)]
+        other_dead_cards = [card for card in all_dead_cards if not (card in kept_cards)]
+        total, category_counts, heuristic_sum = final_draw_outcomes(kept_cards, other_dead_cards)
+        result = FinalDrawResult(draw_index = i, draw_cards = kept_cards, total = total,
+                                 category_counts = category_counts, heuristic_sum = heuristic_sum)
+        if debug:
+            print('%d: %s' % (i, str(result)))
+        results.append(result)
+    return results
+
+# 32-length vector, in the same format (and scale) as evaluate_single_hand() for 'deuce' draw model.
+def exact_final_draw_values(hand_array, dead_cards = [], debug = False):
+    results = exact_final_draw_results(hand_array, dead_cards = dead_cards, debug = debug)
+    return np.array([result.value for result in results], dtype=np.float32)
+
+# Output, for training data at 1 draw left. Same columns as draw simulation (see POKER_FULL_SIM_HEADER)
+def output_exact_final_draw_csv(hand_array, header_map, dead_cards = []):
+    results = exact_final_draw_results(hand_array, dead_cards = dead_cards)
+    best_result = max(results)
+    output_map = {}
+    output_map['hand'] = hand_string(hand_array)
+    output_map['sample_size'] = best_result.total
+    output_map['pay_scheme'] = 'deuce_exact_final_draw'
+    output_map['best_value'] = best_result.average_value
+    output_map['best_draw'] = hand_string(best_result.draw_cards)
+    for i in range(len(all_draw_patterns)):
+        draw_pattern = all_draw_patterns[i]
+        draw_result = results[i]
+        draw_to_string = '[%s]' % ','.join([str(i) for i in list(draw_pattern)])
+        output_map['%s_value' % draw_to_string] = draw_result.average_value
+        output_map['%s_draw' % draw_to_string] = draw_result.draw_string
+    return VectorFromKeysAndSparseMap(keys=header_map, sparse_data_map=output_map, default_value = '')
+
+# Generate exact final draw values for random hands.
+def generate_exact_cases(sample_size, output_file_name):
+    start_time = time.time()
+    if output_file_name:
+        output_file = open(output_file_name, 'w')
+        csv_writer = csv.writer(output_file)
+        csv_header_map = CreateMapFromCSVKey(POKER_FULL_SIM_HEADER)
+    else:
+        csv_writer = None
+
+    for round in range(sample_size):
+        deck = PokerDeck(shuffle=True)
+        hand_array = deck.deal(5)
+        if csv_writer:
+            csv_writer.writerow(output_exact_final_draw_csv(hand_array, header_map=csv_header_map))
+        else:
+            exact_final_draw_results(hand_array, debug=True)
+        if round % 100 == 0:
+            print('%d rounds took %.1f seconds. Cache %d hits %d misses' % (round, time.time() - start_time,
+                                                                             final_draw_cache_hits, final_draw_cache_misses))
+
+    if csv_writer:
+        print('\nwrote %d rows to %s' % (sample_size, output_file_name))
+        output_file.close()
+
+if __name__ == '__main__':
+    samples = 10000
+    output_file_name = None
+    if len(sys.argv) >= 2:
+        output_file_name = sys.argv[1]
+    if len(sys.argv) >= 3:
+        samples = int(sys.argv[2])
+
+    print('will compute exact final draw values for %d hands, save to %s' % (samples, output_file_name))
+    generate_exact_cases(sample_size=samples, output_file_name=output_file_name)
@@ -0,0 +1,117 @@
+import sys
+import time
+import itertools
+import numpy as np
+from poker_lib import *
+from poker_util import *
+
+"""
+Draw model output, precomputed for every 5-card hand, and every number of draws left (1-3).
+
+The draw model sees only the 5 cards and num_draws. So run it once over all hands (see learning/build_draw_value_table.py),
+and play with table lookups, instead of a model call per draw decision.
+
+Hands are stored in canonical form: suits relabeled (suit permutation invariant), and cards ordered by rank.
+Only 134,459 canonical hands (of 2,598,960). Lookup remaps the 32 draw values, from canonical card positions
+back to the positions of cards in the hand as dealt. So [keep 0,2] means the same cards as from the model.
+
+Table is two .npy files (sorted canonical keys, and values [hands x 3 draws x 32]), memory-mapped on load.
+"""
+
+DRAW_TABLE_NUM_DRAWS = [1, 2, 3]
+DRAW_TABLE_NUM_VALUES = len(all_draw_patterns) # 32 draw values, as in DRAW_VALUE_KEYS
+DRAW_TABLE_VALUE_TYPE = np.float32
+
+# Index of each draw pattern [set of card positions kept], in the 32-value array
+DRAW_PATTERN_INDEX = {frozenset(pattern): index for (index, pattern) in enumerate(all_draw_patterns)}
+
+def draw_table_filenames(filename):
+    return ('%s_keys.npy' % filename, '%s_values.npy' % filename)
+
+# Sort key for one suit in the hand. Number of cards first, then ranks (bit mask). Sort suits by this, to relabel them.
+def suit_sort_value(ranks_mask, num_cards):
+    return (num_cards << 13) | ranks_mask
+
+# Canonical key for 5 cards. Same for any suit permutation, or order of the cards.
+# Returns (key, canonical_suits) where canonical_suits maps each suit in the hand, to its suit in canonical form.
+def canonical_hand_key(cards):
+    masks = {suit: 0 for suit in suitsArray}
+    counts = {suit: 0 for suit in suitsArray}
+    for card in cards:
+        masks[card.suit] |= 1 << card.value
+        counts[card.suit] += 1
+    # Stable sort, so suits with same ranks keep [CLUB, DIAMOND, HEART, SPADE] order. Either way, same canonical hand.
+    suits = sorted(suitsArray, key=lambda suit: suit_sort_value(masks[suit], counts[suit]), reverse=True)
+    key = 0
+    for suit in suits:
+        key = (key << 16) | suit_sort_value(masks[suit], counts[suit])
+    canonical_suits = {suit: suitsArray[slot] for (slot, suit) in enumerate(suits)}
+    return (key, canonical_suits)
+
+# Order of cards in canonical hand: rank high to low, then canonical suit.
+def canonical_card_order(card, canonical_suits):
+    return (-card.value, suitsArray.index(canonical_suits[card.suit]))
+
+# Cards --> (key, positions) where positions[i] is the position in the dealt hand, of canonical card i.
+def canonical_hand_positions(cards):
+    (key, canonical_suits) = canonical_hand_key(cards)
+    positions = sorted(range(len(cards)), key=lambda position: canonical_card_order(cards[position], canonical_suits))
+    return (key, tuple(positions))
+
+# Canonical key --> cards for the canonical hand, in canonical order. This is the hand we give the model.
+def canonical_hand_from_key(key):
+    cards = []
+    for slot in range(len(suitsArray)):
+        ranks_mask = (key >> (16 * (len(suitsArray) - 1 - slot))) & 0x1fff
+        cards += [Card(suit=suitsArray[slot], value=value) for value in ranksArray if ranks_mask & (1 << value)]
+    cards.sort(key=lambda card: (-card.value, suitsArray.index(card.suit)))
+    return cards
+
+# Sorted keys of all canonical 5-card hands. Vectorized over all 2,598,960 hands [card index = 13 * suit slot + value]
+def all_canonical_hand_keys():
+    num_cards = len(suitsArray) * len(ranksArray)
+    hands = np.fromiter(itertools.chain.from_iterable(itertools.combinations(range(num_cards), 5)), dtype=np.int64).reshape(-1, 5)
+    suit_slots = hands // len(ranksArray)
+    rank_bits = np.left_shift(1, hands % len(ranksArray))
+    suit_values = np.zeros((len(hands), len(suitsArray)), dtype=np.uint64)
+    for slot in range(len(suitsArray)):
+        in_suit = (suit_slots == slot)
+        suit_values[:, slot] = ((in_suit.sum(axis=1) << 13) | (rank_bits * in_suit).sum(axis=1)).astype(np.uint64)
+    suit_values = np.sort(suit_values, axis=1)[:, ::-1]
+    keys = np.zeros(len(hands), dtype=np.uint64)
+    for slot in range(len(suitsArray)):
+        keys = (keys << np.uint64(16)) | suit_values[:, slot]
+    return np.unique(keys)
+
+# For canonical positions --> 32 indices, to read draw values for dealt hand, from values for canonical hand.
+DRAW_VALUES_REMAP_CACHE = {}
+def draw_values_remap(positions):
+    if positions not in DRAW_VALUES_REMAP_CACHE:
+        canonical_position = {position: i for (i, position) in enumerate(positions)}
+        DRAW_VALUES_REMAP_CACHE[positions] = np.array([DRAW_PATTERN_INDEX[frozenset([canonical_position[position] for position in pattern])] for pattern in all_draw_patterns])
+    return DRAW_VALUES_REMAP_CACHE[positions]
+
+def write_draw_value_table(filename, keys, values):
+    (keys_filename, values_filename) = draw_table_filenames(filename)
+    np.save(keys_filename, keys)
+    np.save(values_filename, values)
+    print('wrote draw table for %d hands x %d draws to %s, %s' % (len(keys), len(DRAW_TABLE_NUM_DRAWS), keys_filename, values_filename))
+
+# Lookup 32 draw values for any hand, instead of evaluate_single_hand() on the draw model.
+class DrawValueTable(object):
+    def __init__(self, filename):
+        now = time.time()
+        (keys_filename, values_filename) = draw_table_filenames(filename)
+        self.keys = np.load(keys_filename, mmap_mode='r')
+        self.values = np.load(values_filename, mmap_mode='r')
+        assert self.values.shape == (len(self.keys), len(DRAW_TABLE_NUM_DRAWS), DRAW_TABLE_NUM_VALUES), 'bad draw table shape %s' % str(self.values.shape)
+        print('loaded draw table %s (%d hands) in %.2fs' % (filename, len(self.keys), time.time() - now))
+
+    # Cards in dealt order --> 32 values, same as draw model output for these cards [values for draws 0-31]
+    def lookup(self, cards, num_draws = 1):
+        (key, positions) = canonical_hand_positions(cards)
+        row = np.searchsorted(self.keys, np.uint64(key))
+        if row >= len(self.keys) or self.keys[row] != np.uint64(key):
+            raise KeyError('hand %s not in draw table' % hand_string(cards))
+        draw = DRAW_TABLE_NUM_DRAWS.index(min(max(num_draws, 1), 3))
+        return np.asarray(self.values[row, draw])[draw_values_remap(positions)]
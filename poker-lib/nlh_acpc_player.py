@@ -18,11 +18,14 @@ from poker_util import *
 # Import only the draw-functions that we need.
 from draw_poker import holdem_cards_input_from_string
 from triple_draw_poker_full_output import build_model
+from triple_draw_poker_full_output import INFERENCE_BATCH_SIZE # build models for play with any batch size
 from triple_draw_poker_full_output import predict_model # outputs result for [BATCH x data]
 from triple_draw_poker_full_output import evaluate_single_hand # single hand... returns 32-point vector
 from triple_draw_poker_full_output import evaluate_single_event # just give it the 26x17x17 bits... and get a vector back
 from triple_draw_poker_full_output import evaluate_single_holdem_hand # for a holdem hand, returns 0-1.0 value vs random, and some odds
 from triple_draw_poker_full_output import expand_parameters_input_to_match # expand older models, to work on larger input (just zero-fill layer)
+from triple_draw_poker_full_output import load_numpy_play_model # pickled params, quantized NumPy model, or model store
+from triple_draw_poker_full_output import load_model_param_values # pickled params, or model store (memory-mapped)
 
 # We can't just import all of play_triple_draw
 from play_triple_draw import TripleDrawAIPlayer
@@ -40,6 +43,7 @@ parser.add_argument('-output', '--output', help='output CSV') # CSV output file,
 parser.add_argument('--human_player', action='store_true', help='pass for p2 = human player') # Declare if we want a human competitor? (as player_2)
 parser.add_argument('-CNN_old_model', '--CNN_old_model', default=None, help='pass for p2 = old model (or second model)') # useful, if we want to test two CNN models against each other.
 parser.add_argument('-CNN_other_old_model', '--CNN_other_old_model', default=None, help='pass for p2 = other old model (or 3rd model)') # and a third model, 
+parser.add_argument('--numpy_model', action='store_true', help='run models with NumPy forward pass. No Theano graphs to compile, much faster startup')
 args = parser.parse_args()
 
 # For testing CNN models (Holdem only)
@@ -127,9 +131,11 @@ if args:
     bets_model_filename = args.CNN_model
 
     print('Attempting to read holdem_model from %s' % holdem_model_filename)
-    if holdem_model_filename and os.path.isfile(holdem_model_filename):
+    if args.numpy_model and holdem_model_filename and os.path.exists(holdem_model_filename):
+        holdem_output_layer = load_numpy_play_model(holdem_model_filename)
+    elif holdem_model_filename and os.path.exists(holdem_model_filename):
         print('\nExisting holdem model in file %s. Attempt to load it!\n' % holdem_model_filename)
-        all_param_values_from_file = np.load(holdem_model_filename)
+        all_param_values_from_file = load_model_param_values(holdem_model_filename)
         expand_parameters_input_to_match(all_param_values_from_file, zero_fill = True)
 
         for layer_param in all_param_values_from_file:
@@ -142,6 +148,7 @@ if args:
             HAND_TO_MATRIX_PAD_SIZE, 
             HAND_TO_MATRIX_PAD_SIZE,
             STANDARD_OUTPUT_LENGTH,
+            batch_size=INFERENCE_BATCH_SIZE,
         )
 
         #print('filling model with shape %s, with %d params' % (str(output_layer.get_output_shape()), len(all_param_values_from_file)))
@@ -157,9 +164,11 @@ if args:
     bets_output_layer = None
     bets_input_layer = None
     print('Attempting to read CNN_model from %s' % bets_model_filename)
-    if bets_model_filename and os.path.isfile(bets_model_filename):
+    if args.numpy_model and bets_model_filename and os.path.exists(bets_model_filename):
+        bets_output_layer = load_numpy_play_model(bets_model_filename)
+    elif bets_model_filename and os.path.exists(bets_model_filename):
         print('\nExisting *bets* model in file %s. Attempt to load it!\n' % bets_model_filename)
-        bets_all_param_values_from_file = np.load(bets_model_filename)
+        bets_all_param_values_from_file = load_model_param_values(bets_model_filename)
         expand_parameters_input_to_match(bets_all_param_values_from_file, zero_fill = True)
 
         # Size must match exactly!
@@ -167,6 +176,7 @@ if args:
             HAND_TO_MATRIX_PAD_SIZE, 
             HAND_TO_MATRIX_PAD_SIZE,
             ARRAY_OUTPUT_LENGTH,
+            batch_size=INFERENCE_BATCH_SIZE,
         )
 
         #print('filling model with shape %s, with %d params' % (str(bets_output_layer.get_output_shape()), len(bets_all_param_values_from_file)))
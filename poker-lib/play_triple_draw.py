@@ -1,6 +1,10 @@
 import sys
 import gc
 import csv
+import copy
+import itertools
+import threading
+import functools
 import logging
 import math
 import time
@@ -18,10 +22,16 @@ from poker_lib import *
 from holdem_lib import * # if we want to support Holdem hands and game sim
 from poker_util import *
 from draw_poker_lib import * 
+from deuce_draw_oracle import exact_final_draw_values # exact 32-point vector for the final draw
+from draw_value_table import DrawValueTable # draw model output, precomputed for all hands
 
 from draw_poker import cards_input_from_string
 from draw_poker import hand_input_from_context
 from draw_poker import holdem_cards_input_from_string
+from draw_poker import deuce_cards_indices_from_string
+from draw_poker import holdem_cards_indices_from_string
+from draw_poker import event_record_from_context
+from draw_poker import expand_event_records # same batch expander (event record -> input bits) as used in training
 from triple_draw_poker_full_output import build_model
 from triple_draw_poker_full_output import build_nopool_model
 from triple_draw_poker_full_output import build_fully_connected_model
@@ -30,6 +40,14 @@ from triple_draw_poker_full_output import evaluate_single_hand # single hand...
 from triple_draw_poker_full_output import evaluate_single_event # just give it the 26x17x17 bits... and get a vector back
 from triple_draw_poker_full_output import evaluate_single_holdem_hand # for a holdem hand, returns 0-1.0 value vs random, and some odds
 from triple_draw_poker_full_output import expand_parameters_input_to_match # expand older models, to work on larger input (just zero-fill layer)
+from triple_draw_poker_full_output import INFERENCE_BATCH_SIZE # build models for play with any batch size
+from triple_draw_poker_full_output import load_numpy_play_model # pickled params, quantized NumPy model, or model store
+from triple_draw_poker_full_output import load_model_param_values # pickled params, or model store (memory-mapped)
+from triple_draw_poker_full_output import build_ensemble_predictor # all mixed models, evaluated in one pass
+from triple_draw_poker_full_output import print_prediction_cache_stats
+from inference_broker import LockstepBatcher # run many tables at once, batching their model calls
+from inference_broker import InferenceBrokerContext # ...or as free-running threads, batching model calls through brokers
+from inference_broker import INFERENCE_BROKER_BATCH_SIZE
 # from triple_draw_poker_full_output import evaluate_batch_hands # much faster to evaluate a batch of hands
 
 print('parsing command line args %s' % sys.argv)
@@ -50,6 +68,10 @@ parser.add_argument('-CNN_old_model', '--CNN_old_model', default=None, help='pas
 parser.add_argument('-CNN_old_model_tag', '--CNN_old_model_tag', default=None, help='name for CNN_old_model (compare_models format)') 
 parser.add_argument('-CNN_other_old_model', '--CNN_other_old_model', default=None, help='pass for p2 = other old model (or 3rd model)') # and a third model, 
 parser.add_argument('-compare_models', '--compare_models', action='store_true', help="pass for model A vs model B. Needs to input exactly two models") # Useful for A/B testing. Should auto-detect when a model is DNN or CNN. Leave model_2 empty for comp with heuristic. Crashes if 3 models given.
+parser.add_argument('--tables', type=int, default=1, help='self-play this many tables in lockstep, batching model calls across tables')
+parser.add_argument('--threaded', action='store_true', help='with --tables, run tables as free threads, batching model calls through inference brokers (not in lockstep)')
+parser.add_argument('--draw_table', default=None, help='precomputed draw model table (from build_draw_value_table.py). Lookup draw values, instead of draw model')
+parser.add_argument('--numpy_model', action='store_true', help='run all models with NumPy forward pass. No Theano graphs to compile, much faster startup')
 parser.add_argument('-hand_history', '--hand_history', default=None, help='shortcut to generate CSV from ACPC file (line per hand). NLH only') # Instead of fresh hands, give hand history, and generate CSV
 args = parser.parse_args()
 
@@ -70,6 +92,7 @@ models and final hand evaluations, to accomodate any other draw game.
 # TODO: Do this from command line... but then need to ensure that all done correctly.
 # Better yet, outside global constants class (modified from command line, etc)
 # [default format is 'deuce']
+USE_NUMPY_MODELS = args.numpy_model # Run models with NumPy forward pass, instead of compiled Theano graph?
 CARDS_CANONICAL_FORM = True # if available. NOTE: Older models my work better w/o canonical form, new models require it
 FORMAT = 'nlh' # 'deuce' # 'holdem' # 'deuce'
 # TODO: allow 'holdem' (limit) vs 'nlh' from command line
@@ -138,12 +161,15 @@ NUM_DRAW_MODEL_RATE = 1.0 # 0.7 # how often do we use num_draw model? Just use c
 NUM_DRAW_MODEL_RATE_REDUCE_BY_DRAW = 0.4 # 0.3 # Use model on the final draw, but perhaps less on previous draws...
 NUM_DRAW_MODEL_NOISE_FACTOR = 0.2 # Add noise to predictions... but just a little. 
 FAVOR_DEFAULT_NUM_DRAW_MODEL = True # Enable, to boost # of draw cards preferred by 0-32 model. Else, too noisy... but strong preference for other # of cards still matters.
+# On the final draw, replace 0-32 model guess with exact values (enumerate all replacement cards). Useful as oracle, to benchmark draws.
+USE_EXACT_FINAL_DRAW_VALUES = False
 
 INCLUDE_HAND_CONTEXT = True # False 17 or so extra "bits" of context. Could be set, could be zero'ed out.
 
 SHOW_HUMAN_DEBUG = True # Show debug, based on human player...
 SHOW_MACHINE_DEBUG_AGAINST_HUMAN = False # True, to see machine logic when playing (will reveal hand)
 USE_MIXED_MODEL_WHEN_AVAILABLE = True # When possible, including against human, use 2 or 3 models, and choose randomly which one decides actions.
+USE_MODEL_ENSEMBLE = True # With mixed models, evaluate all of them in one pass (one input, one call), then use the chosen model's output.
 RETRY_FOLD_ACTION = True # If we get a model that says fold preflop... try again. But just once. We should avoid raise/fold pre
 ADJUST_VALUES_TO_FIX_IMPOSSIBILITY = True # Do we fix impossile values? Like check < 0.0, or calling on river > pot + bet
 # TODO: Cap adjustment from RAW_FOLD_VALUE? Or apply it with a discount...
@@ -311,6 +337,7 @@ class TripleDrawAIPlayer():
         # This is the draw model. Also, outputs the heuristic (value) of a hand, given # of draws left.
         self.output_layer = None # for draws
         self.input_layer = None
+        self.draw_table = None # draw model values, precomputed. If given, use instead of output_layer
         self.holdem_output_layer = None # simimilary for holdem (if applies)
         self.holdem_input_layer = None
         self.bets_output_layer = None 
@@ -319,6 +346,7 @@ class TripleDrawAIPlayer():
         self.old_bets_output_model = False # "old" model used for NIPS... should be set from the outside
         self.other_old_bets_output_model = False # the "other" old bets model [CNN3 vs CNN5, etc]
         self.bets_output_array = [] # if we use *multiple* models, and choose randomly between them
+        self.bets_ensemble = None # all models in bets_output_array, evaluated together. Output for each model.
         self.use_action_percent_model = False # Make moves from CNN action-values (with noise added), or from action percentages from CNN?
         self.is_dense_model = False # neural network is DNN?
         self.is_human = False
@@ -384,7 +412,13 @@ class TripleDrawAIPlayer():
             print('dealt %s for draw %s' % (hand_string_dealt, num_draws))
 
         # Get 32-length vector for each possible draw, from the model.
-        hand_draws_vector = evaluate_single_hand(self.output_layer, hand_string_dealt, num_draws = num_draws, input_layer=self.input_layer) #, test_batch=self.test_batch)
+        # On the final draw, we can instead count exact values, for all possible replacement cards.
+        if USE_EXACT_FINAL_DRAW_VALUES and num_draws == 1:
+            hand_draws_vector = exact_final_draw_values(self.draw_hand.dealt_cards)
+        elif self.draw_table:
+            hand_draws_vector = self.draw_table.lookup(self.draw_hand.dealt_cards, num_draws = num_draws)
+        else:
+            hand_draws_vector = evaluate_single_hand(self.output_layer, hand_string_dealt, num_draws = num_draws, input_layer=self.input_layer) #, test_batch=self.test_batch)
         if debug:
             print('All 32 values: %s' % str(hand_draws_vector))
         # For further debug, and to use outside suggestion of #draw... select best draw for each 0-5 cards kept
@@ -569,8 +603,11 @@ class TripleDrawAIPlayer():
         if self.is_human:
             return
 
-        # Get 32-length vector for each possible draw, from the model.
-        hand_draws_vector = evaluate_single_hand(self.output_layer, hand_string_dealt, num_draws = max(num_draws, 1), input_layer=self.input_layer) #, test_batch=self.test_batch)
+        # Get 32-length vector for each possible draw, from the model (or precomputed table).
+        if self.draw_table:
+            hand_draws_vector = self.draw_table.lookup(self.cards, num_draws = max(num_draws, 1))
+        else:
+            hand_draws_vector = evaluate_single_hand(self.output_layer, hand_string_dealt, num_draws = max(num_draws, 1), input_layer=self.input_layer) #, test_batch=self.test_batch)
 
         # Except for num_draws == 0, value is value of the best draw...
         if num_draws >= 1:
@@ -627,9 +664,7 @@ class TripleDrawAIPlayer():
                 hand_string_dealt = hand_string(self.draw_hand.final_hand)
 
             # Input related to the hand
-            cards_input = cards_input_from_string(hand_string_dealt, include_num_draws=True, 
-                                                  num_draws=num_draws_left, include_full_hand = True, 
-                                                  include_hand_context = False)
+            cards_indices = deuce_cards_indices_from_string(hand_string_dealt)
 
             # TODO: This should be a util function.
             bets_string = ''
@@ -659,10 +694,11 @@ class TripleDrawAIPlayer():
                 if self.is_dense_model:
                     print('~ DNN model ~')
                 print('context %s' % ([hand_string_dealt, num_draws_left, has_button, pot_size, bets_string, cards_kept, opponent_cards_kept, all_rounds_bets_string]))
-            hand_context_input = hand_input_from_context(position=has_button, pot_size=pot_size, bets_string=bets_string,
-                                                         cards_kept=cards_kept, opponent_cards_kept=opponent_cards_kept,
-                                                         all_rounds_bets_string=all_rounds_bets_string)
-            full_input = np.concatenate((cards_input, hand_context_input), axis = 0)
+            # Encode as event record, and expand with the same encoder used in training.
+            event_record = event_record_from_context(cards_indices, num_draws=num_draws_left, position=has_button, pot_size=pot_size, bets_string=bets_string,
+                                                     cards_kept=cards_kept, opponent_cards_kept=opponent_cards_kept,
+                                                     all_rounds_bets_string=all_rounds_bets_string)
+            full_input = expand_event_records(event_record)[0]
             
             """
             # What do input bits look like?
@@ -680,7 +716,10 @@ class TripleDrawAIPlayer():
                 """
 
             # TODO: Rewrite with input and output layer... so that we can avoid putting all this data into Theano.shared()
-            bets_vector = evaluate_single_event(bets_layer, full_input, input_layer = bets_input_layer)
+            if self.bets_ensemble:
+                bets_vector = evaluate_single_event(self.bets_ensemble, full_input)[index]
+            else:
+                bets_vector = evaluate_single_event(bets_layer, full_input, input_layer = bets_input_layer)
 
             # Show the values for all draws [0, 5] cards kept.
             # For action %... normalize the vector to show action %%.
@@ -768,7 +807,7 @@ class TripleDrawAIPlayer():
                 flop_string = hand_string(self.holdem_hand.community.flop)
                 turn_string = hand_string(self.holdem_hand.community.turn)
                 river_string = hand_string(self.holdem_hand.community.river)
-                cards_input = holdem_cards_input_from_string(cards_string, flop_string, turn_string, river_string, include_hand_context = False, use_canonical_form = CARDS_CANONICAL_FORM)
+                (cards_indices, num_draws_left) = holdem_cards_indices_from_string(cards_string, flop_string, turn_string, river_string, use_canonical_form = CARDS_CANONICAL_FORM)
             else:
                 num_draws_left = 3
                 if round == PRE_DRAW_BET_ROUND:
@@ -786,9 +825,7 @@ class TripleDrawAIPlayer():
                     hand_string_dealt = hand_string(self.draw_hand.final_hand)
 
                 # Input related to the hand
-                cards_input = cards_input_from_string(hand_string_dealt, include_num_draws=True, 
-                                                      num_draws=num_draws_left, include_full_hand = True, 
-                                                      include_hand_context = False)
+                cards_indices = deuce_cards_indices_from_string(hand_string_dealt)
 
             # TODO: This should be a util function.
             # NOTE: 'Actions' can be objects, with "type", or a string...
@@ -857,10 +894,11 @@ class TripleDrawAIPlayer():
                 format = 'holdem_events'
             elif FORMAT == 'nlh':
                 format = 'nlh_events'
-            hand_context_input = hand_input_from_context(position=has_button, pot_size=pot_size, bets_string=bets_string,
-                                                         cards_kept=cards_kept, opponent_cards_kept=opponent_cards_kept,
-                                                         all_rounds_bets_string=all_rounds_bets_string, format=format)
-            full_input = np.concatenate((cards_input, hand_context_input), axis = 0)
+            # Encode as event record, and expand with the same encoder used in training.
+            event_record = event_record_from_context(cards_indices, num_draws=num_draws_left, position=has_button, pot_size=pot_size, bets_string=bets_string,
+                                                     cards_kept=cards_kept, opponent_cards_kept=opponent_cards_kept,
+                                                     all_rounds_bets_string=all_rounds_bets_string, format=format)
+            full_input = expand_event_records(event_record, format=format)[0]
 
             ###########################
             """
@@ -884,7 +922,10 @@ class TripleDrawAIPlayer():
             #############################
 
             # TODO: Rewrite with input and output layer... so that we can avoid putting all this data into Theano.shared()
-            bets_vector = evaluate_single_event(bets_layer, full_input, input_layer = bets_input_layer)
+            if self.bets_ensemble:
+                bets_vector = evaluate_single_event(self.bets_ensemble, full_input)[index]
+            else:
+                bets_vector = evaluate_single_event(bets_layer, full_input, input_layer = bets_input_layer)
 
             # Show all the raw returns from training. [0:5] -> values of actions [5:10] -> probabilities recommended
             # NOTE: Actions are good, and useful, and disconnected from values... but starting with CNN7 only!
@@ -1930,6 +1971,7 @@ def game_round(round, cashier, player_button=None, player_blind=None,
     # "theano-cache purge" --> on GPU
     # "theano-cache clear" --> enough on CPU
     # TODO: How to do this, in-code??
+    # NOTE: Models now predict through compiled functions (see model_predictor), so graph no longer grows per decision.
     if round > 0 and round % 100 == 1:
         now = time.time()
         print('--> wait for manual garbage collection...')
@@ -2040,6 +2082,12 @@ def game_round(round, cashier, player_button=None, player_blind=None,
 
 # Generate neural net models, for players:
 # return (player_one, player_two)
+# Load model params, expand to current input & output size, and run as NumPy model. No Theano graph to build or compile.
+# NOTE: Input layer stays None. evaluate_single_event() etc predict with the NumPy model directly.
+def load_numpy_player_model(model_filename):
+    print('\nExisting model in file %s. Load it as NumPy model!\n' % model_filename)
+    return load_numpy_play_model(model_filename)
+
 def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
                            bets_model_filename=None, old_bets_model_filename=None, other_old_bets_model_filename=None,
                            human_player=None, compare_models=None):
@@ -2095,9 +2143,11 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
     # TODO: model loading should be a function!
     output_layer = None
     input_layer = None
-    if draw_model_filename and os.path.isfile(draw_model_filename):
+    if USE_NUMPY_MODELS and draw_model_filename and os.path.exists(draw_model_filename):
+        output_layer = load_numpy_player_model(draw_model_filename)
+    elif draw_model_filename and os.path.exists(draw_model_filename):
         print('\nExisting model in file %s. Attempt to load it!\n' % draw_model_filename)
-        all_param_values_from_file = np.load(draw_model_filename)
+        all_param_values_from_file = load_model_param_values(draw_model_filename)
         print('loaded %s params' % len(all_param_values_from_file))
         expand_parameters_input_to_match(all_param_values_from_file, zero_fill = True)
 
@@ -2106,6 +2156,7 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
             HAND_TO_MATRIX_PAD_SIZE, 
             HAND_TO_MATRIX_PAD_SIZE,
             ARRAY_OUTPUT_LENGTH,
+            batch_size=INFERENCE_BATCH_SIZE,
         )
 
         #print('filling model with shape %s, with %d params' % (str(output_layer.get_output_shape()), len(all_param_values_from_file)))
@@ -2116,12 +2167,19 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
     else:
         print('No model provided or loaded. Expect error if model required. %s', draw_model_filename)
 
+    # Precomputed draw model values, for all hands. Used instead of the draw model, if provided.
+    draw_table = None
+    if args.draw_table:
+        draw_table = DrawValueTable(args.draw_table)
+
     # Similarly, unpack model for Holdem, if provided.
     holdem_output_layer = None
     holdem_input_layer = None
-    if holdem_model_filename and os.path.isfile(holdem_model_filename):
+    if USE_NUMPY_MODELS and holdem_model_filename and os.path.exists(holdem_model_filename):
+        holdem_output_layer = load_numpy_player_model(holdem_model_filename)
+    elif holdem_model_filename and os.path.exists(holdem_model_filename):
         print('\nExisting holdem model in file %s. Attempt to load it!\n' % holdem_model_filename)
-        all_param_values_from_file = np.load(holdem_model_filename)
+        all_param_values_from_file = load_model_param_values(holdem_model_filename)
         expand_parameters_input_to_match(all_param_values_from_file, zero_fill = True)
 
         for layer_param in all_param_values_from_file:
@@ -2134,6 +2192,7 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
             HAND_TO_MATRIX_PAD_SIZE, 
             HAND_TO_MATRIX_PAD_SIZE,
             ARRAY_OUTPUT_LENGTH,
+            batch_size=INFERENCE_BATCH_SIZE,
         )
 
         #print('filling model with shape %s, with %d params' % (str(output_layer.get_output_shape()), len(all_param_values_from_file)))
@@ -2149,9 +2208,11 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
     bets_output_layer = None
     bets_input_layer = None
     bets_layers = None
-    if bets_model_filename and os.path.isfile(bets_model_filename):
+    if USE_NUMPY_MODELS and bets_model_filename and os.path.exists(bets_model_filename):
+        bets_output_layer = load_numpy_player_model(bets_model_filename)
+    elif bets_model_filename and os.path.exists(bets_model_filename):
         print('\nExisting *bets* model in file %s. Attempt to load it!\n' % bets_model_filename)
-        bets_all_param_values_from_file = np.load(bets_model_filename)
+        bets_all_param_values_from_file = load_model_param_values(bets_model_filename)
         print('loaded %s params' % len(bets_all_param_values_from_file))
         expand_parameters_input_to_match(bets_all_param_values_from_file, zero_fill = True)
 
@@ -2163,12 +2224,14 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
                  HAND_TO_MATRIX_PAD_SIZE, 
                  HAND_TO_MATRIX_PAD_SIZE,
                  ARRAY_OUTPUT_LENGTH,
+                 batch_size=INFERENCE_BATCH_SIZE,
                  )
         elif len(bets_all_param_values_from_file) == 16:
             bets_output_layer, bets_input_layer, bets_layers  = build_nopool_model(
                  HAND_TO_MATRIX_PAD_SIZE, 
                  HAND_TO_MATRIX_PAD_SIZE,
                  ARRAY_OUTPUT_LENGTH,
+                 batch_size=INFERENCE_BATCH_SIZE,
                  num_filters=64,
                  )
         else:
@@ -2176,6 +2239,7 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
                 HAND_TO_MATRIX_PAD_SIZE, 
                 HAND_TO_MATRIX_PAD_SIZE,
                 ARRAY_OUTPUT_LENGTH,
+                batch_size=INFERENCE_BATCH_SIZE,
                 )
 
         #print('filling model with shape %s, with %d params' % (str(bets_output_layer.get_output_shape()), len(bets_all_param_values_from_file)))
@@ -2190,9 +2254,11 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
     old_bets_output_layer = None
     old_bets_input_layer = None
     old_bets_layers = None
-    if old_bets_model_filename and os.path.isfile(old_bets_model_filename):
+    if USE_NUMPY_MODELS and old_bets_model_filename and os.path.exists(old_bets_model_filename):
+        old_bets_output_layer = load_numpy_player_model(old_bets_model_filename)
+    elif old_bets_model_filename and os.path.exists(old_bets_model_filename):
         print('\nExisting *old bets* model in file %s. Attempt to load it!\n' % old_bets_model_filename)
-        old_bets_all_param_values_from_file = np.load(old_bets_model_filename)
+        old_bets_all_param_values_from_file = load_model_param_values(old_bets_model_filename)
         expand_parameters_input_to_match(old_bets_all_param_values_from_file, zero_fill = True)
 
         # Size must match exactly!
@@ -2203,12 +2269,14 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
                  HAND_TO_MATRIX_PAD_SIZE, 
                  HAND_TO_MATRIX_PAD_SIZE,
                  ARRAY_OUTPUT_LENGTH,
+                 batch_size=INFERENCE_BATCH_SIZE,
                  )
         else:
             old_bets_output_layer, old_bets_input_layer, old_bets_layers = build_model(
                 HAND_TO_MATRIX_PAD_SIZE, 
                 HAND_TO_MATRIX_PAD_SIZE,
                 ARRAY_OUTPUT_LENGTH,
+                batch_size=INFERENCE_BATCH_SIZE,
                 )
         #print('filling model with shape %s, with %d params' % (str(old_bets_output_layer.get_output_shape()), len(old_bets_all_param_values_from_file)))
         lasagne.layers.set_all_param_values(old_bets_output_layer, old_bets_all_param_values_from_file)
@@ -2222,9 +2290,11 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
     other_old_bets_output_layer = None
     other_old_bets_input_layer = None
     other_old_bets_layers = None
-    if other_old_bets_model_filename and os.path.isfile(other_old_bets_model_filename):
+    if USE_NUMPY_MODELS and other_old_bets_model_filename and os.path.exists(other_old_bets_model_filename):
+        other_old_bets_output_layer = load_numpy_player_model(other_old_bets_model_filename)
+    elif other_old_bets_model_filename and os.path.exists(other_old_bets_model_filename):
         print('\nExisting *old bets* model in file %s. Attempt to load it!\n' % other_old_bets_model_filename)
-        other_old_bets_all_param_values_from_file = np.load(other_old_bets_model_filename)
+        other_old_bets_all_param_values_from_file = load_model_param_values(other_old_bets_model_filename)
         expand_parameters_input_to_match(other_old_bets_all_param_values_from_file, zero_fill = True)
 
         # Size must match exactly!
@@ -2233,12 +2303,14 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
                  HAND_TO_MATRIX_PAD_SIZE, 
                  HAND_TO_MATRIX_PAD_SIZE,
                  ARRAY_OUTPUT_LENGTH,
+                 batch_size=INFERENCE_BATCH_SIZE,
                  )
         else:
             other_old_bets_output_layer, other_old_bets_input_layer, other_old_bets_layers = build_model(
                 HAND_TO_MATRIX_PAD_SIZE, 
                 HAND_TO_MATRIX_PAD_SIZE,
                 ARRAY_OUTPUT_LENGTH,
+                batch_size=INFERENCE_BATCH_SIZE,
                 )
         #print('filling model with shape %s, with %d params' % (str(other_old_bets_output_layer.get_output_shape()), len(other_old_bets_all_param_values_from_file)))
         lasagne.layers.set_all_param_values(other_old_bets_output_layer, other_old_bets_all_param_values_from_file)
@@ -2254,6 +2326,7 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
     # TODO: Perform massive cleanup, removing passing input, output layers for everything... just layers[0] and layers[-1] should suffice.
     player_one.output_layer = output_layer
     player_one.input_layer = input_layer
+    player_one.draw_table = draw_table
     player_one.holdem_output_layer = holdem_output_layer
     player_one.holdem_input_layer = holdem_input_layer
     player_one.bets_output_layer = bets_output_layer
@@ -2290,12 +2363,15 @@ def generate_player_models(draw_model_filename=None, holdem_model_filename=None,
         if other_old_bets_output_layer:
             player_one.bets_output_array.append([other_old_bets_output_layer, other_old_bets_input_layer])
         print('loaded player_one with %d-mixed model!' % len(player_one.bets_output_array))
+        if USE_MODEL_ENSEMBLE:
+            player_one.bets_ensemble = build_ensemble_predictor(player_one.bets_output_array)
 
     # Player 2 plays the least late model... unless player 1 is playing a mixed bag.
     # NOTE: This sounds confusing, but is not. We need to test vs human (with mixed model, if given)
     # Otherwise, we want to test the latest model, against the mix. Or the latest model, against the oldest given.
     player_two.output_layer = output_layer
     player_two.input_layer = input_layer
+    player_two.draw_table = draw_table
     player_two.holdem_output_layer = holdem_output_layer
     player_two.holdem_input_layer = holdem_input_layer
     if not compare_models:
@@ -2520,6 +2596,115 @@ def play(sample_size, output_file_name=None, draw_model_filename=None, holdem_mo
         pass
 
     print('completed %d rounds of heads up play' % round)
+    print_prediction_cache_stats()
+    sys.stdout.flush()
+
+# Copy of player, to sit at another table. Shares the models, but keeps its own hand state.
+def copy_player_for_table(player):
+    table_player = copy.copy(player)
+    table_player.cards = []
+    table_player.bet_val_vector = []
+    table_player.act_val_vector = []
+    table_player.num_draw_vector = []
+    return table_player
+
+# CSV writer shared by threads. One event line at a time.
+class LockedCSVWriter(object):
+    def __init__(self, csv_writer):
+        self.csv_writer = csv_writer
+        self.lock = threading.Lock()
+
+    def writerow(self, row):
+        with self.lock:
+            self.csv_writer.writerow(row)
+
+# Self-play on num_tables tables at once. Each table plays hands like play().
+# In lockstep (default), a table waits at every model call, until all tables want a prediction.
+# Then each model evaluates all pending decisions as one batch (see LockstepBatcher). Same hands every run, for same seed.
+# If threaded, tables run as free threads, and model calls wait only for a broker batch to fill, or its deadline (see InferenceBrokerContext).
+# NOTE: AI players only. No human player, or hand histories.
+def play_tables(sample_size, num_tables, output_file_name=None, draw_model_filename=None, holdem_model_filename=None,
+                bets_model_filename=None, old_bets_model_filename=None, other_old_bets_model_filename=None, compare_models=None,
+                threaded=False):
+    (player_one, player_two) = generate_player_models(draw_model_filename=draw_model_filename, 
+                                                      holdem_model_filename=holdem_model_filename,
+                                                      bets_model_filename=bets_model_filename, 
+                                                      old_bets_model_filename=old_bets_model_filename, 
+                                                      other_old_bets_model_filename=other_old_bets_model_filename, 
+                                                      human_player=False, 
+                                                      compare_models=compare_models)
+
+    if FORMAT == 'holdem' or FORMAT == 'nlh':
+        cashier = HoldemCashier()
+    else:
+        cashier = DeuceLowball()
+
+    csv_header_map = CreateMapFromCSVKey(TRIPLE_DRAW_EVENT_HEADER)
+    csv_writer=None
+    bufsize = 0
+    if output_file_name:
+        output_file = open(output_file_name, 'a', bufsize)
+        csv_writer = csv.writer(output_file)
+        csv_writer.writerow(TRIPLE_DRAW_EVENT_HEADER)
+        if threaded:
+            csv_writer = LockedCSVWriter(csv_writer)
+
+    # Hand numbers and results shared by all tables. In lockstep, tables take turns (never run at the same time), so no lock needed.
+    # Threaded, count() and list append() are atomic (GIL), so still no lock. Only the CSV writer needs one.
+    hand_numbers = itertools.count(1)
+    player_one_results = []
+    player_two_results = []
+    sb_results = []
+    bb_results = []
+
+    def play_table(table_player_one, table_player_two):
+        for round in hand_numbers:
+            if round >= sample_size:
+                return
+            # Switch button every other hand, as in play()
+            if round % 2:
+                (bb_result, sb_result) = game_round(round, cashier, player_button=table_player_one, player_blind=table_player_two,
+                                                    csv_writer=csv_writer, csv_header_map=csv_header_map,
+                                                    player_button_average = np.mean(player_one_results),
+                                                    player_blind_average = np.mean(player_two_results))
+                player_one_results.append(sb_result)
+                player_two_results.append(bb_result)
+            else:
+                (bb_result, sb_result) = game_round(round, cashier, player_button=table_player_two, player_blind=table_player_one,
+                                                    csv_writer=csv_writer, csv_header_map=csv_header_map,
+                                                    player_button_average = np.mean(player_two_results),
+                                                    player_blind_average = np.mean(player_one_results))
+                player_two_results.append(sb_result)
+                player_one_results.append(bb_result)
+            sb_results.append(sb_result)
+            bb_results.append(bb_result)
+
+    tables = []
+    for table in range(num_tables):
+        table_player_one = copy_player_for_table(player_one)
+        table_player_two = copy_player_for_table(player_two)
+        table_player_one.opponent = table_player_two
+        table_player_two.opponent = table_player_one
+        tables.append(functools.partial(play_table, table_player_one, table_player_two))
+
+    now = time.time()
+    if threaded:
+        # Each table waits on one prediction at a time, so a batch never has more inputs than tables.
+        batcher = InferenceBrokerContext(max_batch_size=min(num_tables, INFERENCE_BROKER_BATCH_SIZE))
+        batcher.run_threads(tables)
+    else:
+        batcher = LockstepBatcher()
+        batcher.run_tables(tables)
+
+    seconds = time.time() - now
+    print('completed %d hands of heads up play, on %d tables (%s), in %.1f seconds (%.1f hands/s)' % (len(sb_results), num_tables, 'threaded' if threaded else 'lockstep',
+                                                                                                     seconds, len(sb_results) / max(seconds, 0.001)))
+    batcher.print_stats()
+    print_prediction_cache_stats()
+    print('BB results mean %.2f stdev %.2f (%s)' % (np.mean(bb_results), np.std(bb_results), len(bb_results)))
+    print('SB results mean %.2f stdev %.2f (%s)' % (np.mean(sb_results), np.std(sb_results), len(sb_results)))
+    print('p1 results (%s) mean %.2f stdev %.2f (%s)' % (player_one.player_tag(), np.mean(player_one_results), np.std(player_one_results), len(player_one_results)))
+    print('p2 results (%s) mean %.2f stdev %.2f (%s)' % (player_two.player_tag(), np.mean(player_two_results), np.std(player_two_results), len(player_two_results)))
     sys.stdout.flush()
 
 if __name__ == '__main__':
@@ -2553,6 +2738,18 @@ if __name__ == '__main__':
     # Alternatively, load ACPC histories (NLH only) 
     hand_history_filename = args.hand_history
 
+    # Many tables at once, in lockstep (or threaded)? Self-play only.
+    if args.tables > 1 and not (human_player or hand_history_filename):
+        play_tables(sample_size=samples, num_tables=args.tables, output_file_name=output_file_name,
+                    draw_model_filename=draw_model_filename,
+                    holdem_model_filename = holdem_model_filename,
+                    bets_model_filename=bets_model_filename,
+                    old_bets_model_filename=old_bets_model_filename,
+                    other_old_bets_model_filename=other_old_bets_model_filename,
+                    compare_models=compare_models,
+                    threaded=args.threaded)
+        sys.exit(0)
+
     # TODO: Take num samples from command line.
     play(sample_size=samples, output_file_name=output_file_name,
          draw_model_filename=draw_model_filename, 
@@ -0,0 +1,42 @@
+import csv
+import os
+import sys
+
+import pytest
+
+# Tests import modules from learning/ and poker-lib/ the same way the scripts do (run from learning/, with poker-lib on the path).
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [os.path.join(ROOT_DIR, 'poker-lib'), os.path.join(ROOT_DIR, 'learning')]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# Logged events from before bet sizes and Monte Carlo stats were saved. Add those columns (bet faced = bet made, neutral odds)
+# so that the current event parser reads it.
+EVENTS_FILENAME = os.path.join(ROOT_DIR, 'data', '40k_triple_draw_events.csv')
+EXTRA_COLUMNS = ['bet_faced', 'stack_size', 'bet_this_street', 'allin_vs_oppn', 'stdev_vs_oppn', 'allin_vs_random', 'stdev_vs_random', 'allin_categories_vector']
+FIXTURE_ROWS = 4000
+
+def write_events_fixture(filename, rows = FIXTURE_ROWS, extra_columns = True):
+    from poker_lib import HIGH_HAND_CATEGORIES
+    csv_reader = csv.reader(open(EVENTS_FILENAME, 'rb'))
+    csv_key = csv_reader.next()
+    with open(filename, 'wb') as f:
+        csv_writer = csv.writer(f, lineterminator='\n')
+        csv_writer.writerow(csv_key + (EXTRA_COLUMNS if extra_columns else []))
+        written = 0
+        for row in csv_reader:
+            if len(row) != len(csv_key):
+                continue
+            if extra_columns:
+                bet_size = row[csv_key.index('bet_size')]
+                row = row + [bet_size, '10000.0', bet_size, '0.5', '0.1', '0.5', '0.1', str([0.1] * len(HIGH_HAND_CATEGORIES))]
+            csv_writer.writerow(row)
+            written += 1
+            if written >= rows:
+                break
+    return filename
+
+# Deuce events CSV, which parses to a few thousand examples.
+@pytest.fixture(scope='session')
+def events_filename(tmpdir_factory):
+    return write_events_fixture(str(tmpdir_factory.mktemp('events').join('events.csv')))
@@ -0,0 +1,50 @@
+import numpy as np
+import lasagne
+import theano
+import theano.tensor as T
+
+from triple_draw_poker_full_output import save_checkpoint
+from triple_draw_poker_full_output import load_checkpoint
+from triple_draw_poker_full_output import dropout_random_states
+
+NUM_STEPS = 3
+
+# Small network with dropout, and training function. Training state is params & momentum, and dropout random streams.
+def build_training(seed = 0):
+    lasagne.random.set_rng(np.random.RandomState(seed))
+    input_layer = lasagne.layers.InputLayer((None, 8))
+    hidden = lasagne.layers.DenseLayer(input_layer, num_units=16)
+    dropout = lasagne.layers.DropoutLayer(hidden, p=0.5)
+    output_layer = lasagne.layers.DenseLayer(dropout, num_units=3, nonlinearity=None)
+    targets = T.matrix('targets')
+    loss = T.mean((lasagne.layers.get_output(output_layer) - targets) ** 2)
+    updates = lasagne.updates.nesterov_momentum(loss, lasagne.layers.get_all_params(output_layer), 0.01, 0.9)
+    train = theano.function([input_layer.input_var, targets], loss, updates=updates)
+    training_state = list(updates.keys()) + dropout_random_states([output_layer])
+    return (train, training_state, output_layer)
+
+def training_batch():
+    rng = np.random.RandomState(1)
+    return (rng.rand(32, 8).astype(theano.config.floatX), rng.rand(32, 3).astype(theano.config.floatX))
+
+def test_dropout_random_states_found():
+    (train, training_state, output_layer) = build_training()
+    assert len(dropout_random_states([output_layer])) > 0
+
+# Resumed training (same masks, params and momentum) gives exactly the same losses as training straight through.
+def test_resume_from_checkpoint_same_dropout(tmpdir):
+    out_file = str(tmpdir.join('model.pickle'))
+    (X, targets) = training_batch()
+    (train, training_state, output_layer) = build_training()
+    for step in range(NUM_STEPS):
+        train(X, targets)
+    save_checkpoint(out_file, training_state, epoch=1).join()
+    lasagne_rng_state = lasagne.random.get_rng().get_state()
+    losses = [float(train(X, targets)) for step in range(NUM_STEPS)]
+
+    # New network, with different initial params and dropout seeds.
+    (train, training_state, output_layer) = build_training(seed=1)
+    assert load_checkpoint(out_file, training_state) == 1
+    assert np.array_equal(lasagne.random.get_rng().get_state()[1], lasagne_rng_state[1])
+    resumed_losses = [float(train(X, targets)) for step in range(NUM_STEPS)]
+    assert resumed_losses == losses
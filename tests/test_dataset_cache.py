@@ -0,0 +1,52 @@
+import json
+import os
+import random
+
+import numpy as np
+
+from draw_poker import load_poker_csv_cached
+from draw_poker import save_dataset_artifact
+from draw_poker import load_dataset_artifact
+
+from conftest import FIXTURE_ROWS
+
+def load_cached(filename, cache_dir):
+    return load_poker_csv_cached(filename=filename, max_input=FIXTURE_ROWS, keep_all_data=True, format='deuce_events', include_hand_context=True,
+                                 pack_inputs=True, sparse_inputs=False, cache_dir=cache_dir)
+
+def random_states():
+    return (random.getstate(), np.random.get_state())
+
+def assert_same_random_states(states, other_states):
+    assert states[0] == other_states[0]
+    for (value, other_value) in zip(states[1], other_states[1]):
+        assert np.array_equal(value, other_value)
+
+# Same random state after load, whether the data set is parsed and cached, or memory-mapped from cache.
+def test_cache_does_not_change_random_state(events_filename, tmpdir):
+    cache_dir = str(tmpdir)
+    random.seed(5)
+    np.random.seed(5)
+    states = random_states()
+    parsed = load_cached(events_filename, cache_dir)
+    assert_same_random_states(states, random_states())
+    cached = load_cached(events_filename, cache_dir)
+    assert_same_random_states(states, random_states())
+    num_hands = parsed[0]
+    assert num_hands > 0 and cached[0] == num_hands
+    for (parsed_array, cached_array) in zip(parsed[1:], cached[1:]):
+        assert isinstance(cached_array, np.memmap)
+        assert np.array_equal(parsed_array[:num_hands], cached_array)
+
+# Two processes parse the same data set, and save it. Second rename fails, so it keeps the first artifact.
+def test_save_artifact_already_saved(events_filename, tmpdir):
+    cache_dir = str(tmpdir)
+    data = load_cached(events_filename, cache_dir)
+    [artifact_name] = os.listdir(cache_dir)
+    path = os.path.join(cache_dir, artifact_name)
+    with open(os.path.join(path, 'manifest.json')) as f:
+        cache_key = json.load(f)['key']
+    num_hands = data[0]
+    assert not save_dataset_artifact(path, cache_key, data, range(num_hands), [False] * num_hands)
+    assert os.listdir(cache_dir) == [artifact_name]
+    assert load_dataset_artifact(path, cache_key)[0] == num_hands
@@ -0,0 +1,60 @@
+import multiprocessing
+import os
+import time
+
+from draw_poker import add_dataset_store_shard
+from draw_poker import load_dataset_store_manifest
+from draw_poker import lock_dataset_store
+from draw_poker import unlock_dataset_store
+
+from conftest import write_events_fixture
+
+STORE_ROWS = 500
+
+def add_shard(filename, store_dir):
+    add_dataset_store_shard(filename, source='self_play', store_dir=store_dir, max_input=STORE_ROWS, keep_all_data=True, format='deuce_events',
+                            include_hand_context=True, pack_inputs=True, workers=0)
+
+def events_files(tmpdir, count):
+    return [write_events_fixture(str(tmpdir.join('events_%d.csv' % i)), rows=STORE_ROWS + i) for i in range(count)]
+
+def start_adding(filenames, store_dir):
+    processes = [multiprocessing.Process(target=add_shard, args=(filename, store_dir)) for filename in filenames]
+    for process in processes:
+        process.start()
+    return processes
+
+def saved_artifacts(store_dir):
+    return [name for name in os.listdir(store_dir) if os.path.isdir(os.path.join(store_dir, name)) and '.tmp' not in name]
+
+def join_all(processes):
+    for process in processes:
+        process.join(120)
+        assert process.exitcode == 0
+
+# Writer waits for the store lock, before updating store.json
+def test_add_shard_waits_for_lock(tmpdir):
+    store_dir = str(tmpdir.mkdir('store'))
+    [filename] = events_files(tmpdir, 1)
+    lock_file = lock_dataset_store(store_dir)
+    try:
+        processes = start_adding([filename], store_dir)
+        # Artifact is written without the lock. Then the writer blocks.
+        deadline = time.time() + 120
+        while not saved_artifacts(store_dir) and time.time() < deadline:
+            time.sleep(0.1)
+        time.sleep(1.0)
+        assert processes[0].is_alive()
+        assert load_dataset_store_manifest(store_dir)['shards'] == []
+    finally:
+        unlock_dataset_store(lock_file)
+    join_all(processes)
+    assert len(load_dataset_store_manifest(store_dir)['shards']) == 1
+
+# Concurrent writers all get their shards in store.json
+def test_concurrent_add_shards(tmpdir):
+    store_dir = str(tmpdir.mkdir('store'))
+    filenames = events_files(tmpdir, 4)
+    join_all(start_adding(filenames, store_dir))
+    shards = load_dataset_store_manifest(store_dir)['shards']
+    assert sorted(shard['filename'] for shard in shards) == sorted(filenames)
@@ -0,0 +1,135 @@
+import time
+import numpy as np
+import pytest
+import lasagne
+
+from inference_broker import InferenceBrokerContext
+from inference_broker import current_broker_context
+from inference_broker import LockstepBatcher
+from triple_draw_poker_full_output import build_fully_connected_model
+from triple_draw_poker_full_output import predict_with_model
+from triple_draw_poker_full_output import model_predictor
+from triple_draw_poker_full_output import PredictionCache
+from triple_draw_poker_full_output import DEFAULT_LEAKY_UNITS
+from triple_draw_poker_full_output import FULL_INPUT_LENGTH
+from triple_draw_poker_full_output import HAND_TO_MATRIX_PAD_SIZE
+from triple_draw_poker_full_output import ARRAY_OUTPUT_LENGTH
+from numpy_model import NumpyModel
+
+NUM_THREADS = 8
+MAX_DELAY = 5.0 # long enough that the batch flushes on size, never on deadline
+
+# float32 outputs depend (slightly) on batch size
+def assert_close(output, expected):
+    assert np.allclose(output, expected, rtol=1e-4, atol=1e-5)
+
+# Records the size of each predict() call.
+class CountingPredictor(object):
+    def __init__(self):
+        self.batch_sizes = []
+
+    def predict(self, batch):
+        self.batch_sizes.append(len(batch))
+        return batch * 2.0
+
+class CountingNumpyModel(NumpyModel):
+    def __init__(self, *args, **kwargs):
+        NumpyModel.__init__(self, *args, **kwargs)
+        self.batch_sizes = []
+
+    def predict(self, batch):
+        self.batch_sizes.append(len(batch))
+        return NumpyModel.predict(self, batch)
+
+# Small random model, and inputs for it [with expected outputs, from one direct predict()]
+def counting_model(num_inputs):
+    (output_layer, input_layer) = build_fully_connected_model(HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE, ARRAY_OUTPUT_LENGTH, batch_size=None)[:2]
+    model = CountingNumpyModel(lasagne.layers.get_all_param_values(output_layer), leaky_units=DEFAULT_LEAKY_UNITS)
+    inputs = np.random.RandomState(0).rand(num_inputs, FULL_INPUT_LENGTH, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE).astype(np.float32)
+    return (model, inputs, NumpyModel.predict(model, inputs))
+
+def test_concurrent_requests_share_one_predict():
+    predictor = CountingPredictor()
+    context = InferenceBrokerContext(max_batch_size=NUM_THREADS, max_delay=MAX_DELAY)
+    results = [None] * NUM_THREADS
+    def play(i):
+        assert current_broker_context() is context
+        results[i] = context.predict(predictor, np.array([[i, -i]], dtype=np.float32))
+    context.run_threads([lambda i=i: play(i) for i in range(NUM_THREADS)])
+    assert predictor.batch_sizes == [NUM_THREADS]
+    for i in range(NUM_THREADS):
+        assert np.array_equal(results[i], np.array([[2 * i, -2 * i]], dtype=np.float32))
+    assert current_broker_context() is None
+
+# A failed thread is re-raised from run_threads(), after the other threads finish.
+def test_thread_error_reaches_caller():
+    predictor = CountingPredictor()
+    context = InferenceBrokerContext(max_batch_size=NUM_THREADS, max_delay=0.01)
+    results = [None] * NUM_THREADS
+    def play(i):
+        if i == 3:
+            raise ValueError('table %d crashed' % i)
+        results[i] = context.predict(predictor, np.array([[i]], dtype=np.float32))
+    with pytest.raises(ValueError, match='table 3 crashed'):
+        context.run_threads([lambda i=i: play(i) for i in range(NUM_THREADS)])
+    assert [i for i in range(NUM_THREADS) if results[i] is None] == [3]
+
+# Outside run_threads(), predict_with_model() calls the model directly. Inside, threads share one predict().
+def test_predict_with_model_uses_broker_context():
+    (model, inputs, expected) = counting_model(NUM_THREADS + 1)
+
+    assert current_broker_context() is None
+    assert_close(predict_with_model(model, None, inputs[-1:]), expected[-1:])
+    assert model.batch_sizes == [1]
+
+    context = InferenceBrokerContext(max_batch_size=NUM_THREADS, max_delay=MAX_DELAY)
+    results = [None] * NUM_THREADS
+    def play(i):
+        results[i] = predict_with_model(model, None, inputs[i:i + 1])
+    context.run_threads([lambda i=i: play(i) for i in range(NUM_THREADS)])
+    assert model.batch_sizes == [1, NUM_THREADS]
+    for i in range(NUM_THREADS):
+        assert_close(results[i], expected[i:i + 1])
+
+# Cache hit from a broker thread returns right away. No broker started, no wait for a batch that will not fill.
+def test_cache_hit_skips_broker():
+    (model, inputs, expected) = counting_model(1)
+    assert isinstance(model_predictor(model, None), PredictionCache)
+    predict_with_model(model, None, inputs) # cache it
+    context = InferenceBrokerContext(max_batch_size=NUM_THREADS, max_delay=MAX_DELAY)
+    results = []
+    def play():
+        now = time.time()
+        results.append(predict_with_model(model, None, inputs))
+        results.append(time.time() - now)
+    context.run_threads([play])
+    assert_close(results[0], expected)
+    assert results[1] < MAX_DELAY / 5
+    assert not context.brokers
+    assert model.batch_sizes == [1]
+
+# Cache hit in lockstep play returns within the table's turn. Only the misses wait for the round.
+def test_cache_hit_skips_lockstep_round():
+    (model, inputs, expected) = counting_model(3)
+    predict_with_model(model, None, inputs[:1]) # cache first input
+    batcher = LockstepBatcher()
+    results = {}
+    batches_before_hit = []
+    def play_table(table):
+        if table == 0:
+            results[(0, 'hit')] = predict_with_model(model, None, inputs[:1])
+            batches_before_hit.append(batcher.stats['batches'])
+            results[(0, 'mixed')] = predict_with_model(model, None, inputs[:2]) # one hit, one miss
+            results[(0, 'hit again')] = predict_with_model(model, None, inputs[:1])
+            batches_before_hit.append(batcher.stats['batches'])
+        else:
+            results[(1, 'miss')] = predict_with_model(model, None, inputs[2:3])
+    batcher.run_tables([lambda table=table: play_table(table) for table in range(2)])
+    # First hit returned before any round was predicted. Last hit did not add a round.
+    assert batches_before_hit == [0, 1]
+    assert batcher.stats['batches'] == 1
+    assert model.batch_sizes == [1, 2] # warm up, then one round: miss from table 0, and from table 1
+    assert_close(results[(0, 'hit')], expected[:1])
+    assert_close(results[(0, 'mixed')], expected[:2])
+    assert_close(results[(0, 'hit again')], expected[:1])
+    assert_close(results[(1, 'miss')], expected[2:3])
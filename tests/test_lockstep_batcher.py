@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+from inference_broker import LockstepBatcher
+from inference_broker import current_lockstep_batcher
+
+NUM_TABLES = 6
+NUM_ROUNDS = 5
+
+# Records every batch it is asked to predict.
+class CountingPredictor(object):
+    def __init__(self):
+        self.batches = []
+
+    def predict(self, batch):
+        self.batches.append(batch.copy())
+        return batch * 2.0
+
+# Each round, half of the tables ask one model, half the other. Input row encodes (table, round).
+def run_lockstep(num_tables = NUM_TABLES, num_rounds = NUM_ROUNDS):
+    predictors = [CountingPredictor(), CountingPredictor()]
+    results = {}
+    def play_table(table):
+        for round in range(num_rounds):
+            batch = np.array([[table, round], [table, -round]], dtype=np.float32)
+            results[(table, round)] = current_lockstep_batcher().predict(predictors[(table + round) % 2], batch)
+    batcher = LockstepBatcher()
+    batcher.run_tables([lambda table=table: play_table(table) for table in range(num_tables)])
+    return (predictors, results, batcher)
+
+def test_one_predict_per_round_per_model():
+    (predictors, results, batcher) = run_lockstep()
+    for predictor in predictors:
+        assert len(predictor.batches) == NUM_ROUNDS
+        assert [len(batch) for batch in predictor.batches] == [NUM_TABLES] * NUM_ROUNDS # 2 rows from half of the tables
+    assert batcher.stats['batches'] == 2 * NUM_ROUNDS
+    assert batcher.stats['requests'] == NUM_TABLES * NUM_ROUNDS
+
+def test_tables_get_own_rows():
+    (predictors, results, batcher) = run_lockstep()
+    for table in range(NUM_TABLES):
+        for round in range(NUM_ROUNDS):
+            assert np.array_equal(results[(table, round)], np.array([[2 * table, 2 * round], [2 * table, -2 * round]], dtype=np.float32))
+
+def test_same_batches_every_run():
+    runs = [run_lockstep()[0] for run in range(3)]
+    for predictors in runs[1:]:
+        for (predictor, first_predictor) in zip(predictors, runs[0]):
+            assert len(predictor.batches) == len(first_predictor.batches)
+            for (batch, first_batch) in zip(predictor.batches, first_predictor.batches):
+                assert np.array_equal(batch, first_batch)
+
+def test_table_error_reaches_caller():
+    predictor = CountingPredictor()
+    finished = []
+    def play_table(table):
+        for round in range(NUM_ROUNDS):
+            if table == 2 and round == 1:
+                raise ValueError('table %d crashed' % table)
+            current_lockstep_batcher().predict(predictor, np.array([[table]], dtype=np.float32))
+        finished.append(table)
+    batcher = LockstepBatcher()
+    with pytest.raises(ValueError, match='table 2 crashed'):
+        batcher.run_tables([lambda table=table: play_table(table) for table in range(NUM_TABLES)])
+    # Other tables play on, without the failed table
+    assert sorted(finished) == [table for table in range(NUM_TABLES) if table != 2]
+    assert [len(batch) for batch in predictor.batches] == [NUM_TABLES] + [NUM_TABLES - 1] * (NUM_ROUNDS - 1)
@@ -0,0 +1,122 @@
+import os
+import glob
+import shutil
+import threading
+import numpy as np
+import pytest
+import lasagne
+
+from triple_draw_poker_full_output import build_model
+from triple_draw_poker_full_output import DEFAULT_LEAKY_UNITS
+from triple_draw_poker_full_output import FULL_INPUT_LENGTH
+from triple_draw_poker_full_output import HAND_TO_MATRIX_PAD_SIZE
+from triple_draw_poker_full_output import ARRAY_OUTPUT_LENGTH
+from numpy_model import NumpyModel
+from numpy_model import write_model_store
+from numpy_model import is_model_store
+from numpy_model import load_model_store
+from numpy_model import load_model_store_params
+from numpy_model import load_model_store_manifest
+
+NUM_EXAMPLES = 8
+NUM_REPLACEMENTS = 6
+
+def random_param_values(seed = 0):
+    output_layer = build_model(HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE, ARRAY_OUTPUT_LENGTH, batch_size=None)[0]
+    rng = np.random.RandomState(seed)
+    return [(rng.normal(size=value.shape) * 0.1).astype(np.float32) for value in lasagne.layers.get_all_param_values(output_layer)]
+
+def random_inputs():
+    return np.random.RandomState(1).rand(NUM_EXAMPLES, FULL_INPUT_LENGTH, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE).astype(np.float32)
+
+def store_versions(path):
+    return glob.glob('%s.v*' % path)
+
+@pytest.mark.parametrize('weight_type', ['float32', 'int8'])
+def test_write_then_load(tmpdir, weight_type):
+    path = str(tmpdir.join('test.model'))
+    all_param_values = random_param_values()
+    model = NumpyModel(all_param_values, leaky_units=DEFAULT_LEAKY_UNITS, weight_type=weight_type)
+    write_model_store(path, all_param_values, model, metadata={'source': 'test'})
+    assert is_model_store(path)
+    assert load_model_store_manifest(path)['source'] == 'test'
+
+    loaded_model = load_model_store(path)
+    assert loaded_model.weight_type == weight_type
+    assert loaded_model.weight_bytes() == model.weight_bytes()
+    for (layer, loaded_layer) in zip(model.layers, loaded_model.layers):
+        for (array, loaded_array) in zip(layer[1:], loaded_layer[1:]):
+            if isinstance(array, np.ndarray):
+                assert isinstance(loaded_array, np.memmap) and not loaded_array.flags.writeable
+                assert loaded_array.dtype == array.dtype and np.array_equal(loaded_array, array)
+            else:
+                assert loaded_array == array
+    inputs = random_inputs()
+    assert np.array_equal(loaded_model.predict(inputs), model.predict(inputs))
+    for (values, loaded_values) in zip(all_param_values, load_model_store_params(path)):
+        assert np.array_equal(values, loaded_values)
+
+# Replacing a store swaps the link to a new version, and removes the old version. Models already loaded keep working.
+def test_replace_store(tmpdir):
+    path = str(tmpdir.join('test.model'))
+    inputs = random_inputs()
+    first_params = random_param_values(seed = 0)
+    write_model_store(path, first_params, NumpyModel(first_params, leaky_units=DEFAULT_LEAKY_UNITS))
+    first_loaded = load_model_store(path)
+    first_output = first_loaded.predict(inputs)
+    second_params = random_param_values(seed = 1)
+    second_model = NumpyModel(second_params, leaky_units=DEFAULT_LEAKY_UNITS)
+    write_model_store(path, second_params, second_model)
+    assert os.path.islink(path)
+    assert len(store_versions(path)) == 1
+    assert np.array_equal(load_model_store(path).predict(inputs), second_model.predict(inputs))
+    assert np.array_equal(first_loaded.predict(inputs), first_output)
+    assert sorted(os.listdir(str(tmpdir))) == sorted(['test.model', os.path.basename(store_versions(path)[0])])
+
+# Store written as plain directory (before versions) is replaced too.
+def test_replace_plain_directory_store(tmpdir):
+    path = str(tmpdir.join('test.model'))
+    all_param_values = random_param_values()
+    model = NumpyModel(all_param_values, leaky_units=DEFAULT_LEAKY_UNITS)
+    write_model_store(path, all_param_values, model)
+    version_path = os.path.realpath(path)
+    os.remove(path)
+    os.rename(version_path, path)
+    assert not os.path.islink(path) and is_model_store(path)
+    write_model_store(path, all_param_values, model)
+    assert os.path.islink(path) and is_model_store(path)
+    assert sorted(os.listdir(str(tmpdir))) == sorted(['test.model', os.path.basename(store_versions(path)[0])])
+
+# Workers load the store while it is replaced, again and again. Every load sees one whole version: no missing files, no mixed versions.
+def test_load_while_replacing(tmpdir):
+    path = str(tmpdir.join('test.model'))
+    inputs = random_inputs()
+    versions = [random_param_values(seed = seed) for seed in range(2)]
+    models = [NumpyModel(all_param_values, leaky_units=DEFAULT_LEAKY_UNITS) for all_param_values in versions]
+    outputs = [model.predict(inputs) for model in models]
+    write_model_store(path, versions[0], models[0])
+    done = threading.Event()
+    loads = []
+    errors = []
+    def load_loop():
+        while not done.is_set():
+            try:
+                output = load_model_store(path).predict(inputs)
+                params = load_model_store_params(path)
+            except Exception as error:
+                errors.append(error)
+                continue
+            output_matches = any([np.array_equal(output, version_output) for version_output in outputs])
+            params_match = any([all([np.array_equal(values, version_values) for (values, version_values) in zip(params, version)]) for version in versions])
+            loads.append(output_matches and params_match)
+    readers = [threading.Thread(target=load_loop) for i in range(3)]
+    for reader in readers:
+        reader.start()
+    for i in range(NUM_REPLACEMENTS):
+        write_model_store(path, versions[(i + 1) % 2], models[(i + 1) % 2])
+    done.set()
+    for reader in readers:
+        reader.join()
+    assert not errors
+    assert loads and all(loads)
+    assert len(store_versions(path)) == 1
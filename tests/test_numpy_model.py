@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+import lasagne
+import theano
+
+from triple_draw_poker_full_output import build_model
+from triple_draw_poker_full_output import build_nopool_model
+from triple_draw_poker_full_output import build_fat_model
+from triple_draw_poker_full_output import build_fully_connected_model
+from triple_draw_poker_full_output import DEFAULT_LEAKY_UNITS
+from triple_draw_poker_full_output import FULL_INPUT_LENGTH
+from triple_draw_poker_full_output import HAND_TO_MATRIX_PAD_SIZE
+from triple_draw_poker_full_output import ARRAY_OUTPUT_LENGTH
+from numpy_model import NumpyModel
+from numpy_model import numpy_model_architecture
+from numpy_model import conv2d_valid
+from numpy_model import max_pool_2x2
+
+NUM_EXAMPLES = 16
+ARCHITECTURES = [('model', build_model), ('nopool', build_nopool_model), ('fat', build_fat_model), ('fully_connected', build_fully_connected_model)]
+
+def random_inputs(shape, seed = 0):
+    return np.random.RandomState(seed).rand(*shape).astype(np.float32)
+
+# Random weights and biases (biases are 0.0 at init), so that both sides of (leaky) ReLU are hit.
+def randomize_params(output_layer, seed = 0):
+    rng = np.random.RandomState(seed)
+    for param in lasagne.layers.get_all_params(output_layer):
+        value = param.get_value()
+        fan_in = np.prod(value.shape[1:]) if value.ndim > 1 else 1
+        param.set_value((rng.normal(size=value.shape) / np.sqrt(fan_in)).astype(value.dtype))
+
+def lasagne_predict(output_layer, input_layer, inputs):
+    predict = theano.function([input_layer.input_var], lasagne.layers.get_output(output_layer, deterministic=True))
+    return predict(inputs.astype(theano.config.floatX))
+
+def assert_close(numpy_output, lasagne_output):
+    assert numpy_output.shape == lasagne_output.shape
+    scale = max(np.abs(lasagne_output).max(), 1.0)
+    assert np.allclose(numpy_output, lasagne_output, rtol=1e-4, atol=1e-5 * scale)
+
+@pytest.mark.parametrize('architecture,build_function', ARCHITECTURES)
+def test_numpy_model_matches_lasagne(architecture, build_function):
+    # build_model() also returns side output layers, if TRAIN_SIDE_OUTPUTS. Not part of the NumPy model.
+    (output_layer, input_layer) = build_function(HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE, ARRAY_OUTPUT_LENGTH, batch_size=None)[:2]
+    randomize_params(output_layer)
+    all_param_values = lasagne.layers.get_all_param_values(output_layer)
+    assert numpy_model_architecture(all_param_values) == architecture
+    inputs = random_inputs((NUM_EXAMPLES, FULL_INPUT_LENGTH, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE))
+    model = NumpyModel(all_param_values, leaky_units=DEFAULT_LEAKY_UNITS)
+    assert_close(model.predict(inputs), lasagne_predict(output_layer, input_layer, inputs))
+
+# Convolution flips filters. Asymmetric filters (and non-square) catch a missing or doubled flip.
+@pytest.mark.parametrize('filter_size', [(3, 3), (5, 5), (2, 3)])
+def test_conv_filter_flip(filter_size):
+    input_layer = lasagne.layers.InputLayer((None, 4, 9, 8))
+    conv_layer = lasagne.layers.Conv2DLayer(input_layer, num_filters=6, filter_size=filter_size, nonlinearity=None)
+    randomize_params(conv_layer)
+    (W, b) = lasagne.layers.get_all_param_values(conv_layer)
+    W = W.astype(np.float32)
+    inputs = random_inputs((NUM_EXAMPLES, 4, 9, 8))
+    (num_filters, channels, filter_height, filter_width) = W.shape
+    W_columns = np.ascontiguousarray(W[:, :, ::-1, ::-1].transpose(2, 3, 1, 0).reshape(filter_height * filter_width * channels, num_filters))
+    numpy_output = conv2d_valid(np.ascontiguousarray(inputs.transpose(0, 2, 3, 1)), W_columns, b.astype(np.float32), filter_size).transpose(0, 3, 1, 2)
+    assert_close(numpy_output, lasagne_predict(conv_layer, input_layer, inputs))
+
+# ignore_border=False pools odd rows and columns by themselves. Negative inputs, so that padding must not win the max.
+@pytest.mark.parametrize('height,width', [(13, 13), (7, 8), (8, 8), (1, 3)])
+def test_max_pool_ignore_border_false(height, width):
+    input_layer = lasagne.layers.InputLayer((None, 3, height, width))
+    pool_layer = lasagne.layers.MaxPool2DLayer(input_layer, pool_size=(2, 2), ignore_border=False)
+    inputs = random_inputs((NUM_EXAMPLES, 3, height, width)) - 2.0
+    numpy_output = max_pool_2x2(inputs.transpose(0, 2, 3, 1)).transpose(0, 3, 1, 2)
+    assert_close(numpy_output, lasagne_predict(pool_layer, input_layer, inputs))
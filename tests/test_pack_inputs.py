@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+from draw_poker import empty_event_records
+from draw_poker import expand_event_records
+from draw_poker import empty_training_inputs
+from draw_poker import pack_training_inputs
+from draw_poker import unpack_training_inputs
+from draw_poker import training_inputs_are_binary
+from draw_poker import NLH_BETS_MATRIX_SCALE
+from draw_poker import NLH_POT_MATRIX_SCALE
+from draw_poker import EVENT_INPUT_MAX_CARDS
+
+NUM_EXAMPLES = 200
+
+# Random event records, encoded as training inputs. For NLH, bets & pot sizes that are not whole multiples of the plane scale.
+def random_event_inputs(format, seed = 0):
+    rng = np.random.RandomState(seed)
+    records = empty_event_records(NUM_EXAMPLES)
+    for i in range(NUM_EXAMPLES):
+        num_cards = 5 if format == 'deuce_events' else rng.choice([2, 5, 6, 7])
+        cards = -np.ones(EVENT_INPUT_MAX_CARDS, dtype=np.int8)
+        cards[:num_cards] = rng.choice(52, num_cards, replace=False)
+        records['cards'][i] = cards
+    records['num_draws'] = rng.randint(0, 4, size=NUM_EXAMPLES)
+    records['position'] = rng.randint(0, 2, size=NUM_EXAMPLES)
+    if format == 'nlh_events':
+        records['pot_size'] = rng.uniform(0, 40 * NLH_POT_MATRIX_SCALE, size=NUM_EXAMPLES)
+        records['bets'] = rng.randint(0, 40 * NLH_BETS_MATRIX_SCALE, size=records['bets'].shape)
+    else:
+        records['pot_size'] = rng.randint(0, 3000, size=NUM_EXAMPLES)
+        records['bets'] = rng.randint(0, 2, size=records['bets'].shape)
+        records['cards_kept'] = rng.randint(0, 6, size=NUM_EXAMPLES)
+        records['opponent_cards_kept'] = rng.randint(0, 6, size=NUM_EXAMPLES)
+    return expand_event_records(records, format=format)
+
+@pytest.mark.parametrize('format', ['deuce_events', 'holdem_events', 'nlh_events'])
+def test_pack_unpack_round_trip(format):
+    X = random_event_inputs(format)
+    stored = pack_training_inputs(X, empty_training_inputs(NUM_EXAMPLES, format=format, pack_inputs=True))
+    X_unpacked = unpack_training_inputs(stored, format=format)
+    assert X_unpacked.dtype == X.dtype
+    assert np.array_equal(X_unpacked, X)
+    assert stored.nbytes < X.nbytes / 10
+
+def test_nlh_inputs_are_graded():
+    X = random_event_inputs('nlh_events')
+    assert not training_inputs_are_binary('nlh_events')
+    assert np.any((X != 0) & (X != 1))
+
+def test_pack_unpack_slices():
+    X = random_event_inputs('nlh_events', seed=1)
+    stored = pack_training_inputs(X, empty_training_inputs(NUM_EXAMPLES, format='nlh_events', pack_inputs=True))
+    assert np.array_equal(unpack_training_inputs(stored[50:70], format='nlh_events'), X[50:70])
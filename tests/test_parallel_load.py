@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+import draw_poker
+from draw_poker import _load_poker_csv
+from draw_poker import compare_parallel_load
+from draw_poker import poker_csv_event_shards
+
+from conftest import write_events_fixture
+from conftest import FIXTURE_ROWS
+
+SHARD_BLINDS = 200 # several shards, in a small file
+WORKERS = 2
+
+def load_events(filename, workers = 0):
+    return _load_poker_csv(filename=filename, max_input=FIXTURE_ROWS, format='deuce_events', include_hand_context=True,
+                           seed=draw_poker.LOADER_RANDOM_SEED, workers=workers, shard_blinds=SHARD_BLINDS)
+
+def test_fixture_spans_several_shards(events_filename):
+    shards = list(poker_csv_event_shards(events_filename, shard_blinds=SHARD_BLINDS))
+    assert len(shards) > WORKERS
+
+def test_parallel_load_matches_serial(events_filename):
+    serial = load_events(events_filename)
+    parallel = load_events(events_filename, workers=WORKERS)
+    num_hands = serial[0]
+    assert num_hands > 0
+    assert parallel[0] == num_hands
+    for (serial_array, parallel_array) in zip(serial[1:], parallel[1:]):
+        assert serial_array[:num_hands].shape == parallel_array[:num_hands].shape
+        assert np.array_equal(serial_array[:num_hands], parallel_array[:num_hands])
+
+def test_compare_parallel_load(events_filename):
+    assert compare_parallel_load(events_filename, max_input=FIXTURE_ROWS, workers=WORKERS, include_hand_context=True, shard_blinds=SHARD_BLINDS) > 0
+
+def test_compare_parallel_load_raises_if_no_hands(tmpdir):
+    filename = write_events_fixture(str(tmpdir.join('old_events.csv')), rows=100, extra_columns=False)
+    with pytest.raises(ValueError):
+        compare_parallel_load(filename, max_input=FIXTURE_ROWS, workers=WORKERS, include_hand_context=True, shard_blinds=SHARD_BLINDS)
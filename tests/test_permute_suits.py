@@ -0,0 +1,38 @@
+import numpy as np
+
+from draw_poker import permute_suits_batch
+from draw_poker import SUIT_PERMUTATION_CARD_PLANES
+from draw_poker import SUIT_PERMUTATION_ROWS
+from draw_poker import HAND_TO_MATRIX_PAD_SIZE
+
+NUM_EXAMPLES = 64
+NUM_PLANES = SUIT_PERMUTATION_CARD_PLANES + 4
+
+def random_batch(seed = 0):
+    rng = np.random.RandomState(seed)
+    return rng.rand(NUM_EXAMPLES, NUM_PLANES, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE).astype(np.float32)
+
+def test_permute_suits_leaves_input_unchanged():
+    X_batch = random_batch()
+    X_before = X_batch.copy()
+    X_permuted = permute_suits_batch(X_batch, rng=np.random.RandomState(1))
+    assert np.array_equal(X_batch, X_before)
+    assert X_permuted is not X_batch
+    assert not np.array_equal(X_permuted, X_batch)
+
+def test_permute_suits_permutes_card_planes_only():
+    X_batch = random_batch()
+    rng_seed = 2
+    X_permuted = permute_suits_batch(X_batch, rng=np.random.RandomState(rng_seed))
+    rows = SUIT_PERMUTATION_ROWS[np.random.RandomState(rng_seed).randint(len(SUIT_PERMUTATION_ROWS), size=NUM_EXAMPLES)]
+    for i in range(NUM_EXAMPLES):
+        assert np.array_equal(X_permuted[i, :SUIT_PERMUTATION_CARD_PLANES], X_batch[i, :SUIT_PERMUTATION_CARD_PLANES][:, rows[i], :])
+    assert np.array_equal(X_permuted[:, SUIT_PERMUTATION_CARD_PLANES:], X_batch[:, SUIT_PERMUTATION_CARD_PLANES:])
+
+def test_permute_suits_read_only_memmap(tmpdir):
+    filename = str(tmpdir.join('X_train.npy'))
+    np.save(filename, random_batch())
+    X_train = np.load(filename, mmap_mode='r')
+    X_permuted = permute_suits_batch(X_train[:NUM_EXAMPLES // 2], rng=np.random.RandomState(3))
+    assert X_permuted.shape == (NUM_EXAMPLES // 2,) + X_train.shape[1:]
+    assert np.array_equal(np.load(filename), X_train)
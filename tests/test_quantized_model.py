@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import lasagne
+
+from triple_draw_poker_full_output import build_model
+from triple_draw_poker_full_output import build_nopool_model
+from triple_draw_poker_full_output import build_fat_model
+from triple_draw_poker_full_output import build_fully_connected_model
+from triple_draw_poker_full_output import DEFAULT_LEAKY_UNITS
+from triple_draw_poker_full_output import FULL_INPUT_LENGTH
+from triple_draw_poker_full_output import HAND_TO_MATRIX_PAD_SIZE
+from triple_draw_poker_full_output import ARRAY_OUTPUT_LENGTH
+from numpy_model import NumpyModel
+from numpy_model import weight_dot
+from numpy_model import quantize_weight_columns
+
+NUM_EXAMPLES = 16
+BUILD_FUNCTIONS = [build_model, build_nopool_model, build_fat_model, build_fully_connected_model]
+# Max abs error vs float32 model, as fraction of largest output
+QUANTIZED_MAX_ERROR = {'float16': 0.002, 'int8': 0.03}
+WEIGHT_ITEM_SIZE = {'float16': 2, 'int8': 1}
+
+# Random weights and biases, scaled by fan in, so outputs neither vanish nor blow up through the layers.
+def random_param_values(build_function, seed = 0):
+    output_layer = build_function(HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE, ARRAY_OUTPUT_LENGTH, batch_size=None)[0]
+    rng = np.random.RandomState(seed)
+    all_param_values = []
+    for value in lasagne.layers.get_all_param_values(output_layer):
+        fan_in = np.prod(value.shape[1:]) if value.ndim == 4 else (value.shape[0] if value.ndim == 2 else 1)
+        all_param_values.append((rng.normal(size=value.shape) / np.sqrt(fan_in)).astype(np.float32))
+    return all_param_values
+
+def random_inputs(seed = 1):
+    return np.random.RandomState(seed).rand(NUM_EXAMPLES, FULL_INPUT_LENGTH, HAND_TO_MATRIX_PAD_SIZE, HAND_TO_MATRIX_PAD_SIZE).astype(np.float32)
+
+@pytest.mark.parametrize('build_function', BUILD_FUNCTIONS)
+@pytest.mark.parametrize('weight_type', ['float16', 'int8'])
+def test_quantized_model_error_and_size(build_function, weight_type):
+    all_param_values = random_param_values(build_function)
+    full_model = NumpyModel(all_param_values, leaky_units=DEFAULT_LEAKY_UNITS)
+    quantized_model = NumpyModel(all_param_values, leaky_units=DEFAULT_LEAKY_UNITS, weight_type=weight_type)
+    inputs = random_inputs()
+    full_output = full_model.predict(inputs)
+    quantized_output = quantized_model.predict(inputs)
+    assert quantized_output.dtype == np.float32
+    error = np.abs(quantized_output - full_output).max() / np.abs(full_output).max()
+    print('%s %s: max error %.5f' % (build_function.__name__, weight_type, error))
+    assert error < QUANTIZED_MAX_ERROR[weight_type]
+
+    # Weights shrink by item size. Biases stay float32, and int8 adds a float32 scale per unit.
+    expected_bytes = 0
+    for (layer_type, W, b, filter_size, scales) in full_model.layers:
+        if W is not None:
+            expected_bytes += W.size * WEIGHT_ITEM_SIZE[weight_type] + b.nbytes + (W.shape[1] * 4 if weight_type == 'int8' else 0)
+    assert quantized_model.weight_bytes() == expected_bytes
+    assert quantized_model.weight_bytes() < full_model.weight_bytes() * (0.55 if weight_type == 'float16' else 0.3)
+
+# Cast and multiply in row blocks: same result as one multiply with the whole cast matrix, for any block size.
+@pytest.mark.parametrize('weight_type', ['float16', 'int8'])
+@pytest.mark.parametrize('block_bytes', [1, 4 * 1000, 4 * 1000 * 7, 2 ** 30])
+def test_weight_dot_blocks(weight_type, block_bytes):
+    rng = np.random.RandomState(2)
+    x = rng.rand(5, 301).astype(np.float32)
+    (W_columns, scales) = quantize_weight_columns(rng.normal(size=(301, 1000)).astype(np.float32), weight_type)
+    expected = x.dot(W_columns.astype(np.float32))
+    if scales is not None:
+        expected *= scales
+    output = weight_dot(x, W_columns, scales, block_bytes=block_bytes)
+    assert output.dtype == np.float32
+    assert np.allclose(output, expected, rtol=1e-5, atol=1e-4)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+import draw_poker
+from draw_poker import _load_poker_csv
+from draw_poker import dataset_store_sampler
+from draw_poker import sample_dataset_store_rows
+from draw_poker import important_cases_weight
+
+from conftest import FIXTURE_ROWS
+
+NUM_SAMPLES = 50000
+
+def load_events(filename, sample_events):
+    important_cases = []
+    data = _load_poker_csv(filename=filename, max_input=FIXTURE_ROWS, format='deuce_events', include_hand_context=True, seed=draw_poker.LOADER_RANDOM_SEED,
+                           sample_events=sample_events, important_cases=important_cases)
+    return (data, np.array(important_cases[:data[0]], dtype=np.bool_))
+
+# Share of important cases in training data: down-sampled at load time (old loader), vs drawn by weight from all rows in the store.
+@pytest.mark.parametrize('sample_rate', [0.5, 0.1])
+def test_sampler_matches_load_time_sampling(events_filename, monkeypatch, sample_rate):
+    monkeypatch.setattr(draw_poker, 'SAMPLE_RATE_DEUCE_EVENTS', sample_rate)
+    (all_data, all_important) = load_events(events_filename, sample_events=False)
+    (sampled_data, sampled_important) = load_events(events_filename, sample_events=True)
+    assert 0 < np.sum(all_important) < len(all_important)
+    load_time_share = np.mean(sampled_important)
+
+    # Row index in place of X, to see which rows the sampler draws
+    (num_hands, X, y, z, m) = all_data
+    shard_data = [({'source': 'self_play'}, (num_hands, np.arange(num_hands), y, z, m), all_important)]
+    sampler = dataset_store_sampler(shard_data, important_weight=important_cases_weight(sample_rate))
+    rows = np.array([row for (row, y_row, z_row, m_row) in sample_dataset_store_rows(shard_data, sampler, NUM_SAMPLES, rng=np.random.RandomState(0))])
+    sampler_share = np.mean(all_important[rows])
+
+    # Expected share, from rows kept by the old loader
+    expected_share = np.sum(all_important) / (np.sum(all_important) + sample_rate * np.sum(~all_important))
+    print('sample rate %.2f: important share %.3f load time, %.3f sampler, %.3f expected' % (sample_rate, load_time_share, sampler_share, expected_share))
+    assert abs(sampler_share - expected_share) < 0.01
+    assert abs(load_time_share - expected_share) < 0.05
+    assert abs(sampler_share - load_time_share) < 0.05